@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+""" BENCHMARK CROSSMATCH
+
+    Compares cross matching of reference stars with extracted sources by
+    SkyCoord.match_to_catalog_sky (as used before in the flux calibration
+    steps) and by stonetools.crossmatch.
+
+    A synthetic field (default 50000 sources in 0.5 x 0.5 degrees, i.e. a
+    globular cluster like M5) is matched with a reference catalog of stars
+    near source positions. The match is done once per filter (default 4
+    filters, the sources of each filter are slightly offset as in the
+    frames of a full field reduction). The KD-tree of the reference stars
+    is built once and queried with the sources of each frame, as done
+    with the trees of the reference catalog tiles (stonetools.refcat).
+    The indices of matches within the 1 pixel match distance of the flux
+    calibration are checked to be the same for both methods.
+
+    Usage (with the pipeline source folder in PYTHONPATH):
+      python benchmark_crossmatch.py [--sources 50000] [--refs 20000] [--filters 4]
+
+    @author: agent
+"""
+
+import time
+import argparse
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from stonetools import crossmatch
+from stonetools.refcat import RefCatalog, angdist
+
+def makefield(nsources, nrefs, size = 0.5, ra = 229.638, dec = 2.081):
+    """ Returns source and reference positions (degrees), the references
+        are randomly offset source positions plus random stars.
+    """
+    rng = np.random.default_rng(1)
+    sra = ra + (rng.random(nsources) - 0.5) * size / np.cos(np.radians(dec))
+    sdec = dec + (rng.random(nsources) - 0.5) * size
+    pick = rng.choice(nsources, nrefs // 2, replace = False)
+    offset = 0.5 / 3600.
+    rra = np.concatenate((sra[pick] + rng.normal(0, offset, len(pick)),
+                          ra + (rng.random(nrefs - len(pick)) - 0.5) * size))
+    rdec = np.concatenate((sdec[pick] + rng.normal(0, offset, len(pick)),
+                           dec + (rng.random(nrefs - len(pick)) - 0.5) * size))
+    return sra, sdec, rra, rdec
+
+class ArrayFetcher(object):
+    """ Fetcher for RefCatalog with the reference stars in memory
+    """
+
+    def __init__(self, ra, dec):
+        self.ra, self.dec = ra, dec
+
+    def fetch(self, ra, dec, radius):
+        inside = angdist(ra, dec, self.ra, self.dec) <= radius
+        return {'ra': self.ra[inside], 'dec': self.dec[inside]}
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Cross match benchmark')
+    parser.add_argument('--sources', type = int, default = 50000, help = 'number of sources')
+    parser.add_argument('--refs', type = int, default = 20000, help = 'number of reference stars')
+    parser.add_argument('--filters', type = int, default = 4, help = 'matches per field')
+    args = parser.parse_args()
+    sra, sdec, rra, rdec = makefield(args.sources, args.refs)
+    # Source positions of the frames of each filter
+    rng = np.random.default_rng(2)
+    frames = [(sra + rng.normal(0, 0.1 / 3600., len(sra)),
+               sdec + rng.normal(0, 0.1 / 3600., len(sdec))) for i in range(args.filters)]
+    maxdist = 0.76 / 3600. # match distance of the flux calibration (1 pixel)
+    # SkyCoord matching (new SkyCoord objects and tree for each filter)
+    t0 = time.perf_counter()
+    skymatches = []
+    for fra, fdec in frames:
+        seo_radec = SkyCoord(ra = fra * u.deg, dec = fdec * u.deg)
+        GSC_radec = SkyCoord(ra = rra * u.deg, dec = rdec * u.deg)
+        idxsky, d2dsky, d3d = GSC_radec.match_to_catalog_sky(seo_radec)
+        skymatches.append((idxsky, d2dsky.deg))
+    tsky = time.perf_counter() - t0
+    # KD-tree matching (reference tree reused for all filters)
+    t0 = time.perf_counter()
+    matcher = crossmatch.CrossMatcher(rra, rdec)
+    kdmatches = [matcher.catalognearest(fra, fdec, maxdist) for fra, fdec in frames]
+    tkd = time.perf_counter() - t0
+    # Compare matches within maxdist
+    same, maxdiff = [], 0.
+    for (idxsky, d2dsky), (idx, d2d) in zip(skymatches, kdmatches):
+        mask = d2dsky < maxdist
+        same.append(np.mean(idx[mask] == idxsky[mask]))
+        maxdiff = max(maxdiff, np.max(np.abs(d2d[mask] - d2dsky[mask])) * 3600.)
+        maxdiff = maxdiff if np.array_equal(mask, d2d < maxdist) else np.inf
+    same = np.mean(same)
+    print('%d sources, %d reference stars, %d filters' % (args.sources, args.refs, args.filters))
+    print('  match_to_catalog_sky: %8.3f s' % tsky)
+    print('  crossmatch:           %8.3f s (%.1fx)' % (tkd, tsky / tkd))
+    print('  same index for %.4f%% of matched stars, max distance difference %.2e arcsec' %
+          (100. * same, maxdiff))
+    # Reference catalog cone with tiles (tile trees kept, the source tree
+    # is made once per cone), tiles are loaded before timing
+    refcat = RefCatalog(ArrayFetcher(rra, rdec), '', 0.2)
+    refcat.cone(229.638, 2.081, 0.36)
+    t0 = time.perf_counter()
+    conematches = [refcat.cone(229.638, 2.081, 0.36, fra, fdec, maxdist) for fra, fdec in frames]
+    tcone = time.perf_counter() - t0
+    print('  refcat cone (%d tiles): %8.3f s (%.1fx)' %
+          (len(refcat.matchers), tcone, tsky / tcone))
+    # Radius queries
+    t0 = time.perf_counter()
+    qi, ci, dist = matcher.pairs(sra, sdec, 2. / 3600.)
+    print('  pairs within 2 arcsec: %d in %.3f s' % (len(qi), time.perf_counter() - t0))
+
+if __name__ == '__main__':
+    main()
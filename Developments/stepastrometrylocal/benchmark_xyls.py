@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+""" BENCHMARK ASTROMETRY XYLS
+
+    Compares the time of StepAstrometryLocal solving from the image with
+    solving from the SEP source table (xylsource option).
+
+    The frame is reduced with StepSrcExtPy first. Then for each path the
+    data is given a file name in a new temporary folder, so the image path
+    includes saving the image (as in pipe modes without save before the
+    astrometry step). The astrometry.net command and other settings are
+    taken from the configuration file. The step logs the time for the
+    input and for astrometry, the total time and the center of the
+    solutions are printed here.
+
+    Usage (with the pipeline source folder in PYTHONPATH):
+      python benchmark_xyls.py frame.fits [--config pipeconf.txt] [--table HTS]
+
+    @author: agent
+"""
+
+import os
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from darepype.drp import DataFits
+from stonesteps.stepsrcextpy import StepSrcExtPy
+from stonesteps.stepastrometrylocal import StepAstrometryLocal
+
+config = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', '..', 'config', 'pipeconf_SEO.txt')
+
+def main():
+    parser = argparse.ArgumentParser(description = 'StepAstrometryLocal image vs source table benchmark')
+    parser.add_argument('frame', help = 'FITS file to solve (i.e. after StepHotpix)')
+    parser.add_argument('--config', default = config, help = 'pipeline configuration file')
+    parser.add_argument('--table', default = 'HTS', help = 'source table to solve from')
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO, format = '%(name)s %(message)s')
+    data = DataFits(config = args.config)
+    data.load(args.frame)
+    data = StepSrcExtPy()(data)
+    # No cache, so both paths search
+    data.config['astrometrylocal']['solvecache'] = ''
+    print('  input         time[s]  RA            DEC')
+    for xylsource in ['', args.table]:
+        folder = tempfile.mkdtemp()
+        try:
+            run = data.copy()
+            run.filename = os.path.join(folder, os.path.split(args.frame)[1])
+            t0 = time.perf_counter()
+            out = StepAstrometryLocal()(run, xylsource = xylsource)
+            runtime = time.perf_counter() - t0
+            print('  %-12s  %7.2f  %-12s  %-12s' % (xylsource or 'image', runtime,
+                                                    out.getheadval('RA'), out.getheadval('DEC')))
+        finally:
+            shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main()
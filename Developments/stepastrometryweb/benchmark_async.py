@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+""" BENCHMARK ASTROMETRYWEB ASYNC
+
+    Compares solving the frames of a run one after the other (upload a
+    frame, wait for its solution, then the next frame as StepAstrometryWeb
+    does) with StepAstrometryWebAsync on all frames at once. Both use the
+    local mock server (novamock.py), so no network or API key is needed.
+
+    Synthetic frames with an HTS source table are made in memory.
+
+    Usage (with the pipeline source folder in PYTHONPATH):
+      python benchmark_async.py [--frames 12] [--solvetime 5] [--slots 4]
+
+    @author: agent
+"""
+
+import os
+import time
+import logging
+import argparse
+import numpy as np
+from astropy.io import fits
+from darepype.drp import DataFits
+from stonesteps.stepastrometrywebasync import StepAstrometryWebAsync
+import novamock
+
+config = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', '..', 'config', 'pipeconf_SEO.txt')
+
+def makeframe(index, rng):
+    """ Returns a frame with RA/Dec and an HTS table with random sources
+    """
+    data = DataFits(config = config)
+    data.image = np.zeros((1024, 1024), dtype = np.float32)
+    data.filename = 'frame%02d_SEP.fits' % index
+    data.setheadval('RA', '%02d:30:00' % (index % 24))
+    data.setheadval('DEC', '+20:00:00')
+    cols = [fits.Column(name = 'ID', format = 'D', array = np.arange(1., 201.)),
+            fits.Column(name = 'X', format = 'D', array = rng.uniform(0, 1024, 200)),
+            fits.Column(name = 'Y', format = 'D', array = rng.uniform(0, 1024, 200)),
+            fits.Column(name = 'Uncalibrated Flux', format = 'D', array = rng.uniform(1, 1e4, 200))]
+    table = fits.BinTableHDU.from_columns(cols)
+    data.tableset(table.data, 'HTS', table.header)
+    return data
+
+def main():
+    parser = argparse.ArgumentParser(description = 'StepAstrometryWebAsync benchmark with mock server')
+    parser.add_argument('--frames', type = int, default = 12, help = 'number of frames')
+    parser.add_argument('--solvetime', type = float, default = 5., help = 'mock server time per job')
+    parser.add_argument('--slots', type = int, default = 4, help = 'mock server concurrent jobs')
+    parser.add_argument('--port', type = int, default = 8089, help = 'mock server port')
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.WARNING)
+    server = novamock.serve(args.port, args.solvetime, args.slots)
+    rng = np.random.default_rng(1)
+    frames = [makeframe(i, rng) for i in range(args.frames)]
+    options = {'apiurl': 'http://localhost:%d/' % args.port, 'pollinterval': 0.5}
+    try:
+        # One frame after the other
+        t0 = time.perf_counter()
+        sequential = [StepAstrometryWebAsync()([data], **options)[0] for data in frames]
+        tseq = time.perf_counter() - t0
+        # All frames at once
+        t0 = time.perf_counter()
+        concurrent = StepAstrometryWebAsync()(frames, **options)
+        tconc = time.perf_counter() - t0
+    finally:
+        server.shutdown()
+    same = all(a.getheadval('RA') == b.getheadval('RA') and 'CTYPE1' in b.header
+               for a, b in zip(sequential, concurrent))
+    print('%d frames, mock solve time %.1f s, %d server slots' %
+          (args.frames, args.solvetime, args.slots))
+    print('  one after the other: %6.1f s' % tseq)
+    print('  all at once (async): %6.1f s' % tconc)
+    print('  same solutions: %s' % same)
+
+if __name__ == '__main__':
+    main()
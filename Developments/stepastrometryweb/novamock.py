@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+""" NOVA MOCK SERVER
+
+    A local stand-in for the astrometry.net web API (nova) to test and
+    benchmark StepAstrometryWebAsync (and stonetools.novaclient) offline.
+
+    The subset of the API used by the pipeline is implemented:
+      POST api/login            -> session key
+      POST api/upload           -> submission id (image or source list)
+      GET  api/submissions/<id> -> list of jobs (empty for subdelay seconds)
+      GET  api/jobs/<id>        -> status: solving, success or failure
+      GET  wcs_file/<id>        -> WCS header (FITS file)
+
+    Nothing is solved: a job takes solvetime seconds, the server solves
+    up to slots jobs at the same time (further jobs wait in a queue). The
+    solution is a TAN WCS centered on center_ra / center_dec of the
+    upload (0, 0 if missing) with the mean of scale_lower and scale_upper
+    as pixel scale (arcsec/pixel). Uploads without image size (source
+    lists without image_width / image_height) fail as on the real server.
+
+    Usage:
+      python novamock.py [--port 8080] [--solvetime 10] [--slots 4]
+    then set apiurl = http://localhost:8080/ for the astrometrywebasync step.
+
+    @author: agent
+"""
+
+import io
+import json
+import time
+import email.parser
+import email.policy
+import argparse
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from astropy.io import fits
+
+class NovaMock(object):
+    """ State of the mock server: submissions and jobs
+    """
+
+    def __init__(self, solvetime = 10., slots = 4, subdelay = 1.):
+        self.solvetime = solvetime
+        self.subdelay = subdelay
+        self.slots = [0.] * slots # time when each slot is free
+        self.lock = threading.Lock()
+        self.submissions = {} # subid: (upload time, jobid)
+        self.jobs = {} # jobid: (done time, WCS header or None)
+
+    def upload(self, args, filedata):
+        """ Adds a submission and its job, returns the submission id
+        """
+        now = time.time()
+        header = None
+        try:
+            hdus = fits.open(io.BytesIO(filedata))
+            if hdus[0].data is not None:
+                height, width = hdus[0].data.shape[-2:]
+            else:
+                width, height = args['image_width'], args['image_height']
+            scale = (float(args.get('scale_lower', 1.)) + float(args.get('scale_upper', 1.))) / 2.
+            header = fits.Header()
+            header['WCSAXES'] = 2
+            header['CTYPE1'], header['CTYPE2'] = 'RA---TAN', 'DEC--TAN'
+            header['CRVAL1'] = float(args.get('center_ra', 0.))
+            header['CRVAL2'] = float(args.get('center_dec', 0.))
+            header['CRPIX1'], header['CRPIX2'] = width / 2. + 0.5, height / 2. + 0.5
+            header['CD1_1'], header['CD1_2'] = -scale / 3600., 0.
+            header['CD2_1'], header['CD2_2'] = 0., scale / 3600.
+            header['IMAGEW'], header['IMAGEH'] = width, height
+        except Exception:
+            pass
+        with self.lock:
+            # Queue the job on the first free slot
+            slot = min(range(len(self.slots)), key = lambda i: self.slots[i])
+            start = max(now + self.subdelay, self.slots[slot])
+            self.slots[slot] = start + self.solvetime
+            subid = len(self.submissions) + 1
+            jobid = 1000 + subid
+            self.submissions[subid] = (now, jobid)
+            self.jobs[jobid] = (start + self.solvetime, header)
+        return subid
+
+    def submission(self, subid):
+        uploadtime, jobid = self.submissions[subid]
+        return {'jobs': [jobid] if time.time() > uploadtime + self.subdelay else [],
+                'job_calibrations': []}
+
+    def jobstatus(self, jobid):
+        donetime, header = self.jobs[jobid]
+        if time.time() < donetime:
+            return 'solving'
+        return 'success' if header is not None else 'failure'
+
+class Handler(BaseHTTPRequestHandler):
+    """ HTTP request handler for the mock server (self.server.mock is
+        the NovaMock object)
+    """
+
+    def reply(self, content, ctype = 'application/json'):
+        if not isinstance(content, bytes):
+            content = json.dumps(content).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        mock = self.server.mock
+        parts = self.path.strip('/').split('/')
+        try:
+            if parts[:2] == ['api', 'submissions']:
+                self.reply(mock.submission(int(parts[2])))
+            elif parts[:2] == ['api', 'jobs']:
+                self.reply({'status': mock.jobstatus(int(parts[2]))})
+            elif parts[0] == 'wcs_file':
+                out = io.BytesIO()
+                fits.PrimaryHDU(header = mock.jobs[int(parts[1])][1]).writeto(out)
+                self.reply(out.getvalue(), 'application/fits')
+            else:
+                self.send_error(404)
+        except (KeyError, ValueError, IndexError, TypeError):
+            self.send_error(404)
+
+    def do_POST(self):
+        mock = self.server.mock
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        ctype = self.headers.get('Content-Type', '')
+        fields = {}
+        if ctype.startswith('multipart/form-data'):
+            message = email.parser.BytesParser(policy = email.policy.HTTP).parsebytes(
+                b'Content-Type: ' + ctype.encode() + b'\r\n\r\n' + body)
+            for part in message.iter_parts():
+                fields[part.get_param('name', header = 'content-disposition')] = \
+                    part.get_payload(decode = True)
+        else:
+            fields = {k: v[0].encode() for k, v in urllib.parse.parse_qs(body.decode()).items()}
+        args = json.loads(fields.get('request-json', b'{}'))
+        service = self.path.strip('/').split('/')[-1]
+        if service == 'login':
+            self.reply({'status': 'success', 'session': 'mocksession'})
+        elif service == 'upload' and 'file' in fields:
+            self.reply({'status': 'success', 'subid': mock.upload(args, fields['file'])})
+        else:
+            self.reply({'status': 'error', 'errormessage': 'unknown request'})
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port = 8080, solvetime = 10., slots = 4, subdelay = 1.):
+    """ Starts the mock server in a thread, returns the server (call
+        shutdown() to stop it)
+    """
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    server.mock = NovaMock(solvetime, slots, subdelay)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Mock astrometry.net web API server')
+    parser.add_argument('--port', type = int, default = 8080, help = 'server port')
+    parser.add_argument('--solvetime', type = float, default = 10., help = 'time per job (seconds)')
+    parser.add_argument('--slots', type = int, default = 4, help = 'jobs solved at the same time')
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(('localhost', args.port), Handler)
+    server.mock = NovaMock(args.solvetime, args.slots)
+    print('Mock astrometry.net server on http://localhost:%d/' % args.port)
+    server.serve_forever()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+""" BENCHMARK BIASDARKFLAT
+
+    Compares per-frame time and peak memory of StepBiasDarkFlat with the
+    standard calibration (fused = F) and the fused calibration (fused = T).
+
+    Synthetic masters and raw frames (default 4096 x 4096) are written to
+    a temporary folder. The masters are loaded before timing starts, so
+    the numbers are for the correction of a frame only. Peak memory is the
+    largest memory allocated during the correction (from tracemalloc,
+    numpy reports its arrays to it).
+
+    Usage (with the pipeline source folder in PYTHONPATH):
+      python benchmark_bdf.py [--size 4096] [--frames 5]
+
+    @author: agent
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from astropy.io import fits
+from darepype.drp import DataFits
+from stonesteps.stepbiasdarkflat import StepBiasDarkFlat
+
+config = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', '..', 'config', 'pipeconf_SEO.txt')
+
+def makefiles(folder, size):
+    """ Writes master bias, dark, flat and a raw image into folder
+    """
+    rng = np.random.default_rng(1)
+    head = fits.Header()
+    head['XBIN'] = 1
+    head['FILTER'] = 'r'
+    head['DATE-OBS'] = '2026-10-18T20:00:00'
+    for name, level, noise, exptime in [('Bias', 1000., 5., 0.),
+                                        ('Dark', 20., 2., 60.),
+                                        ('Flat', 1., 0.02, 1.)]:
+        os.makedirs(os.path.join(folder, name))
+        head['EXPTIME'] = exptime
+        image = rng.normal(level, noise, (size, size)).astype(np.float32)
+        fits.writeto(os.path.join(folder, name, 'master.fits'), image, head)
+    head['EXPTIME'] = 30.
+    image = rng.normal(3000., 50., (size, size)).astype(np.uint16)
+    fits.writeto(os.path.join(folder, 'raw_RAW.fits'), image, head)
+
+def measure(step, data, frames, fused):
+    """ Runs step on data frames times, returns the mean time per frame
+        and the peak memory (MB) during the runs.
+    """
+    step(data, fused = fused) # loads the masters (and precomputes them for fused mode)
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(frames):
+        out = step(data, fused = fused)
+        del out
+    elapsed = (time.perf_counter() - start) / frames
+    peak = tracemalloc.get_traced_memory()[1] / 2.**20
+    tracemalloc.stop()
+    return elapsed, peak
+
+def execute():
+    """ Runs the benchmark
+    """
+    parser = argparse.ArgumentParser(description='Benchmark StepBiasDarkFlat')
+    parser.add_argument('--size', default = 4096, type=int,
+                        help='image size in pixels (default = 4096)')
+    parser.add_argument('--frames', default = 5, type=int,
+                        help='number of frames to correct per mode (default = 5)')
+    args = parser.parse_args()
+    folder = tempfile.mkdtemp()
+    try:
+        makefiles(folder, args.size)
+        os.environ['MASTER_BDF_FOLDER'] = folder
+        data = DataFits(config = config)
+        data.load(os.path.join(folder, 'raw_RAW.fits'))
+        print('Frame size %d x %d, %d frames per mode' % (args.size, args.size, args.frames))
+        results = {}
+        for fused in [False, True]:
+            step = StepBiasDarkFlat()
+            results[fused] = measure(step, data, args.frames, fused)
+            print('fused = %-5s  %7.3f s/frame  peak memory %7.1f MB' %
+                  ((str(fused),) + results[fused]))
+        print('Speedup %.1fx, memory %.1fx less' %
+              (results[False][0] / results[True][0], results[False][1] / results[True][1]))
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    execute()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+""" BENCHMARK RGB
+
+    Reports time and peak memory (RSS) of StepRGB and compares the JPEG
+    files of different settings with the first one.
+
+    Synthetic i, r and g frames (default 4096 x 4096, big endian float32
+    as saved by the pipeline) are written to a temporary folder. Each
+    setting is run in a new python process, so the peak RSS is the peak
+    of that run. The RSS after loading the frames is reported too, the
+    difference is the memory used by the step.
+
+    Settings are given as JSON dictionaries of step parameters, the
+    default compares exact and subsampled percentiles. To compare with
+    another version of the step, give a folder with that version of
+    steprgb.py with --stepfolder (used for the first setting only).
+
+    Usage (with the pipeline source folder in PYTHONPATH):
+      python benchmark_rgb.py [--size 4096] [--stepfolder folder]
+                              ['{"usetrilogy": true}' '{"percenttolerance": 0.001}' ...]
+
+    @author: agent
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from astropy.io import fits
+from PIL import Image
+
+stepfolder = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', '..', 'source', 'stonesteps')
+config = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', '..', 'config', 'pipeconf_SEO.txt')
+
+# Script to run the step, prints: time, RSS after load, peak RSS, jpeg name
+runscript = '''
+import sys, time, json, resource
+sys.path.insert(0, sys.argv[1])
+from darepype.drp import DataFits
+from steprgb import StepRGB
+def rss():
+    # VmHWM on linux (ru_maxrss of a subprocess includes the parent's RSS at fork)
+    try:
+        with open('/proc/self/status') as status:
+            return [float(line.split()[1]) for line in status if line.startswith('VmHWM')][0] / 2.**10
+    except (OSError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2.**20 if sys.platform == 'darwin' else 2.**10)
+datalist = []
+for filename in sys.argv[4:]:
+    data = DataFits(config = sys.argv[2])
+    data.load(filename)
+    data.image
+    datalist.append(data)
+loadrss = rss()
+step = StepRGB()
+t0 = time.perf_counter()
+out = step(datalist, **json.loads(sys.argv[3]))
+runtime = time.perf_counter() - t0
+name = out[-1].filenamebegin.rstrip('_-,.') + '.jpg'
+print(runtime, loadrss, rss(), name)
+'''
+
+def makeframes(folder, size, nstars):
+    """ Writes i, r and g frames with background, noise and gaussian stars
+        (same stars with different colors), returns the file names.
+    """
+    rng = np.random.default_rng(1)
+    xs, ys = rng.uniform(8, size - 8, nstars), rng.uniform(8, size - 8, nstars)
+    fluxes = 10**rng.uniform(1.5, 4.5, nstars)
+    yy, xx = np.mgrid[-6:7, -6:7]
+    filenames = []
+    for band, color in [('i-band', 1.3), ('r-band', 1.0), ('g-band', 0.7)]:
+        image = rng.normal(1000., 10., (size, size)).astype(np.float32)
+        # a large faint galaxy so the scaling has something to show
+        gy, gx = np.ogrid[:size, :size]
+        image += (200. * color * np.exp(-((gx - size / 2.)**2 + (gy - size / 2.)**2) /
+                                        (2 * (size / 10.)**2))).astype(np.float32)
+        for x, y, f in zip(xs, ys, fluxes * color**rng.normal(1., 0.5, nstars)):
+            ix, iy = int(x), int(y)
+            image[iy-6:iy+7, ix-6:ix+7] += f / (2 * np.pi * 1.5**2) * \
+                np.exp(-((xx - (x - ix))**2 + (yy - (y - iy))**2) / (2 * 1.5**2))
+        head = fits.Header()
+        head['FILTER'] = band
+        head['OBJECT'] = 'm51'
+        head['OBSERVAT'] = 'StoneEdge'
+        filename = os.path.join(folder, 'm51_%s_WCS.fits' % band[0])
+        fits.writeto(filename, image.astype('>f4'), head)
+        filenames.append(filename)
+    return filenames
+
+def main():
+    parser = argparse.ArgumentParser(description = 'StepRGB time and memory benchmark')
+    parser.add_argument('settings', nargs = '*', default = ['{}', '{"percenttolerance": 0.001}'],
+                        help = 'JSON dictionaries with step parameters')
+    parser.add_argument('--size', type = int, default = 4096, help = 'image size')
+    parser.add_argument('--stars', type = int, default = 20000, help = 'number of stars')
+    parser.add_argument('--stepfolder', default = stepfolder,
+                        help = 'folder with steprgb.py to use for the first setting')
+    args = parser.parse_args()
+    folder = tempfile.mkdtemp()
+    try:
+        filenames = makeframes(folder, args.size, args.stars)
+        print('%d x %d frames with %d stars' % (args.size, args.size, args.stars))
+        print('  time[s]  load RSS[MB]  peak RSS[MB]  step[MB]  max diff  mean diff  setting')
+        reference = None
+        for index, setting in enumerate(args.settings):
+            out = subprocess.run([sys.executable, '-c', runscript,
+                                  args.stepfolder if index == 0 else stepfolder,
+                                  config, setting] + filenames,
+                                 capture_output = True, text = True)
+            if out.returncode:
+                print(out.stderr)
+                continue
+            runtime, loadrss, peak, name = out.stdout.split()[-4:]
+            runtime, loadrss, peak = float(runtime), float(loadrss), float(peak)
+            image = np.asarray(Image.open(name), dtype = float)
+            if reference is None:
+                reference = image
+            if image.shape == reference.shape:
+                diff = np.abs(image - reference)
+                diffs = '%8.0f  %9.3f' % (diff.max(), diff.mean())
+            else:
+                diffs = '%8s  %9s' % ('-', '-')
+            print('  %7.2f  %12.0f  %12.0f  %8.0f  %s  %s' %
+                  (runtime, loadrss, peak, peak - loadrss, diffs, setting))
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main()
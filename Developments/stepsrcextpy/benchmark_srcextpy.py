@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+""" BENCHMARK SRCEXTPY
+
+    Reports time and peak memory (RSS) per frame of StepSrcExtPy.
+
+    A synthetic star field (default 4096 x 4096, big endian float32 as
+    saved by the pipeline) is written to a temporary folder. Each frame is
+    reduced in a new python process, so the peak RSS is the peak of that
+    frame. The RSS after loading the frame is reported
+    too, the difference is the memory used by the step.
+
+    To compare with another version of the step, give a folder with that
+    version of stepsrcextpy.py with --stepfolder.
+
+    Usage (with the pipeline source folder in PYTHONPATH):
+      python benchmark_srcextpy.py [--size 4096] [--stars 20000] [--stepfolder folder]
+
+    @author: agent
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from astropy.io import fits
+
+config = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', '..', 'config', 'pipeconf_SEO.txt')
+
+# Script to reduce one frame, prints: time, RSS after load, peak RSS
+runscript = '''
+import sys, time, resource
+sys.path.insert(0, sys.argv[1])
+from darepype.drp import DataFits
+from stepsrcextpy import StepSrcExtPy
+def rss():
+    # VmHWM on linux (ru_maxrss of a subprocess includes the parent's RSS at fork)
+    try:
+        with open('/proc/self/status') as status:
+            return [float(line.split()[1]) for line in status if line.startswith('VmHWM')][0] / 2.**10
+    except (OSError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2.**20 if sys.platform == 'darwin' else 2.**10)
+data = DataFits(config = sys.argv[2])
+data.load(sys.argv[3])
+data.image
+loadrss = rss()
+step = StepSrcExtPy()
+t0 = time.perf_counter()
+step(data, save_background = sys.argv[4] == 'T', ext_brightfromlow = sys.argv[5] == 'T')
+print(time.perf_counter() - t0, loadrss, rss())
+'''
+
+def makeframe(filename, size, nstars):
+    """ Writes a frame with background, noise and gaussian stars
+    """
+    rng = np.random.default_rng(1)
+    image = rng.normal(1000., 10., (size, size)).astype(np.float32)
+    yy, xx = np.mgrid[-6:7, -6:7]
+    for x, y, f in zip(rng.uniform(8, size - 8, nstars), rng.uniform(8, size - 8, nstars),
+                       10**rng.uniform(1.5, 4.5, nstars)):
+        ix, iy = int(x), int(y)
+        image[iy-6:iy+7, ix-6:ix+7] += f / (2 * np.pi * 1.5**2) * \
+            np.exp(-((xx - (x - ix))**2 + (yy - (y - iy))**2) / (2 * 1.5**2))
+    head = fits.Header()
+    head['XBIN'] = 1
+    fits.writeto(filename, image.astype('>f4'), head)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'StepSrcExtPy time and memory benchmark')
+    parser.add_argument('--size', type = int, default = 4096, help = 'image size')
+    parser.add_argument('--stars', type = int, default = 20000, help = 'number of stars')
+    parser.add_argument('--stepfolder', default = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                               '..', '..', 'source', 'stonesteps'),
+                        help = 'folder with stepsrcextpy.py to use')
+    args = parser.parse_args()
+    folder = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(folder, 'bench_RAW.fits')
+        makeframe(filename, args.size, args.stars)
+        print('%d x %d frame with %d stars, step from %s' %
+              (args.size, args.size, args.stars, os.path.abspath(args.stepfolder)))
+        print('  save_background  brightfromlow  time[s]  load RSS[MB]  peak RSS[MB]  step[MB]')
+        for background, brightfromlow in [('T', 'F'), ('F', 'F'), ('F', 'T')]:
+            out = subprocess.run([sys.executable, '-c', runscript, args.stepfolder, config,
+                                  filename, background, brightfromlow],
+                                 capture_output = True, text = True, check = True)
+            runtime, loadrss, peak = [float(v) for v in out.stdout.split()[-3:]]
+            print('  %15s  %13s  %7.2f  %12.0f  %12.0f  %8.0f' %
+                  (background, brightfromlow, runtime, loadrss, peak, peak - loadrss))
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main()
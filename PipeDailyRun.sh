@@ -6,12 +6,15 @@
 # Script to automatically run pipeline services. The following things are run:
 #   * Make master bias / darks / flats
 #   * Run all of today's data by using PipeExecuteAutoDay
+#   * Render the color images and contact sheet with PipeRenderRGB
 
 ### Setup
 export PATH=/usr/lib64/qt-3.3/bin:/usr/local/bin:/bin:/usr/bin:/usr/local/sbin:/usr/sbin:/sbin:$HOME/bin:$PATH
 export PYTHONPATH=/data/scripts/DataReduction/source
 
 DRPath=/usr/local/lib/python3.6/site-packages/darepype
+# Number of objects to reduce in parallel (one per core)
+PIPE_WORKERS=$(nproc)
 
 ### Remove TMP files
 rm /tmp/*
@@ -20,9 +23,20 @@ rm /tmp/*
 cd /data/scripts/DataReduction
 /usr/local/bin/python3 $DRPath/drp/pipeline.py --loglevel DEBUG --logfile PipeLineLog.txt --pipemode sortobs -c config/dconf_stars.txt config/pipeconf_SEO.txt >> AstroLog.txt 2>&1
 ### Run Masters
+#   Tiles of the master frames are combined by one thread per core (workers = 0
+#   in the masterbias/masterdark/masterflat sections of pipeconf_SEO.txt)
 /usr/local/bin/python3 $DRPath/drp/pipeline.py --loglevel DEBUG --logfile PipeLineLog.txt --pipemode masterbias -c config/dconf_stars.txt config/pipeconf_SEO.txt >> AstroLog.txt 2>&1
 /usr/local/bin/python3 $DRPath/drp/pipeline.py --loglevel DEBUG --logfile PipeLineLog.txt --pipemode masterdark -c config/dconf_stars.txt config/pipeconf_SEO.txt >> AstroLog.txt 2>&1
 /usr/local/bin/python3 $DRPath/drp/pipeline.py --loglevel DEBUG --logfile PipeLineLog.txt --pipemode masterflat -c config/dconf_stars.txt config/pipeconf_SEO.txt >> AstroLog.txt 2>&1
 
 ### Run Pipeline
-./PipeExecuteAutoDay.py >> AstroLog.txt 2>&1
\ No newline at end of file
+#   If PipeWatchDaemon.py is running, images were reduced as they came in and
+#   are skipped here (see PipeManifest.json in the day folder)
+./PipeExecuteAutoDay.py --workers $PIPE_WORKERS >> AstroLog.txt 2>&1
+
+### Render color images
+#   Renders the color images of all reduced objects with all frames of the night
+#   and makes the contact sheet for the daily summary (<day>_RGBsheet.jpg).
+#   PipeExecuteAutoDay uses a pipeline mode without StepRGB (seo_server_batch),
+#   so each object is only rendered here.
+./PipeRenderRGB.py --workers $PIPE_WORKERS >> AstroLog.txt 2>&1
\ No newline at end of file
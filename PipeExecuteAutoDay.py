@@ -23,14 +23,34 @@ import logging
 import traceback
 import datetime
 import re
+import argparse
+import multiprocessing
+import hashlib
+import json
+import fcntl
 
 # Set system variables
 logfile = '/data/scripts/pipeline/PipeLineLog.txt'
 #logfile = '/Users/atreyopal/Desktop/pipeline/PipeLineLog.txt'
+# Pipeline configuration files
+pipeconf = ['/data/scripts/pipeline/config/pipeconf_SEO.txt',
+            '/data/scripts/pipeline/config/dconf_stars.txt']
+#pipeconf = '/Users/atreyopal/Desktop/pipeline/pipeconf_stonedge_remote.txt'
+# Number of object folders to reduce at the same time (1 = one after the other)
+#   Can be overwritten with the --workers command line option
+workers = 1
+# Per-object log file: saved in the object folder (%s is the object folder name)
+objlogname = '%s_pipelog.txt'
+# Pipeline mode used to reduce the objects
+#   The mode has no StepRGB, color images are made by PipeRenderRGB.py
+pipemode = 'seo_server_batch'
+# Manifest of reduced files: saved in the day folder, used to skip objects
+#   whose input files were already reduced with the same configuration
+manifestname = 'PipeManifest.json'
 
 # Set logging format
-logging.basicConfig(filename = logfile, level = logging.DEBUG,
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s' )
+logfmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(filename = logfile, level = logging.DEBUG, format = logfmt)
 log = logging.getLogger('pipe.ExecuteAutoDay')
 log.info('Starting up')
 
@@ -38,6 +58,7 @@ log.info('Starting up')
 #sys.path.append('/Users/atreyopal/Desktop/pipeline/source/')
 sys.path.append('/data/scripts/pipeline/source/')
 from darepype.drp.pipeline import PipeLine
+from darepype.drp import DataParent
 
 today = datetime.date.today()
 year = str(today.year)
@@ -53,21 +74,20 @@ date = year + '-' + month + '-' + day
 #datefilepath = '/Users/atreyopal/Desktop/pipeline/Examples'
 datefilepath = '/data/images/StoneEdge/0.5meter/'+year+'/'+date
 
-def execute():
+# Pipeline object - one for each worker process (set by initworker)
+pipe = None
+
+def initworker():
+    """ Makes the pipeline object for this process. Used as initializer
+        for the worker pool, each worker keeps its own PipeLine.
+    """
+    global pipe
     # Call the pipeline configuration
-    #pipe = PipeLine(config = '/Users/atreyopal/Desktop/pipeline/pipeconf_stonedge_remote.txt')
-    pipe = PipeLine(config = ['/data/scripts/pipeline/config/pipeconf_SEO.txt',
-                              '/data/scripts/pipeline/config/dconf_stars.txt'])
-    # This version only needs to be executed from a terminal. A specific image folder
-    # (like the ones on the stars base) is specified for the pipeline.  The pipeline
-    # will look in the folder and find any of the sub-folders that contain the FITS images.
-    # It will then automatically take the files it finds and run them through the pipeline.
-    print(sys.argv)
-    if len(sys.argv) > 1:
-        # Load the specified directory -- entered as the second argument in the terminal command
-        topdirectory = str(sys.argv[1])
-    else:
-        topdirectory = datefilepath
+    pipe = PipeLine(config = pipeconf)
+
+def getobjectlist(topdirectory):
+    """ Returns a list of the object folders in topdirectory
+    """
     # Load a list of everything in the specified directory.
     rawlist = os.listdir(topdirectory)
     objectlist = []
@@ -77,70 +97,275 @@ def execute():
         if not '.' in Object:            # This line makes sure to exlude any stray files
             if not 'itzamna' in Object:  # Exclude unsorted files
                 objectlist.append(Object)
+    return objectlist
+
+def israwimage(image):
+    """ Checks if the filename image is a raw image to reduce
+    """
+    # Makes sure the images collected are FITS images, i.e. avoid reducing
+    #     existing data reduction product
+    # This searches image filenames which end with .fits preceeded by
+    #     '_0', 'RAW', 'seo' or 'SRT' with optional '.gz' at the end
+    if not re.search(r'(_0|RAW|seo|SRT)\.fits(?:\.gz)?\Z',image):
+        return False
+    # Ignore dark, flat or bias images
+    if 'dark' in image or 'flat' in image or 'bias' in image or 'pinpoint' in image:
+        return False
+    return True
+
+def getimagelist(fullentry):
+    """ Returns a list of the raw images to reduce in the
+        object folder fullentry
+    """
+    imagelist = []
+    # Run this loop for each file ('image') found in the object folder ('fullentry')
+    for image in os.listdir(fullentry):
+        if israwimage(image):
+            # Adds the correct images to imagelist
+            imagelist.append(os.path.join(fullentry,image))
+    return imagelist
+
+def filehash(filename):
+    """ Returns the SHA1 hex digest of the contents of a file
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def confighash():
+    """ Returns a hash of the pipeline configuration files and pipeline
+        mode. Any change to the configuration makes all files out of date.
+    """
+    sha = hashlib.sha1(pipemode.encode())
+    conflist = pipeconf if isinstance(pipeconf, list) else [pipeconf]
+    for conf in conflist:
+        sha.update(filehash(conf).encode())
+    return sha.hexdigest()
+
+def loadmanifest(topdirectory):
+    """ Loads the manifest of the day folder, returns an empty
+        manifest if there is none (or it can't be read).
+    """
+    manifestfile = os.path.join(topdirectory, manifestname)
+    if not os.path.exists(manifestfile):
+        return {}
+    try:
+        with open(manifestfile) as f:
+            return json.load(f)
+    except Exception as e:
+        log.warning('Unable to read manifest %s (%s) - reducing all files' %
+                    (manifestfile, repr(e)))
+        return {}
+
+def savemanifest(topdirectory, manifest):
+    """ Saves the manifest of the day folder. The file is written under a
+        temporary name first, so an interrupted run leaves the old one intact.
+    """
+    manifestfile = os.path.join(topdirectory, manifestname)
+    with open(manifestfile + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+    os.replace(manifestfile + '.tmp', manifestfile)
+
+def fileinfo(filename, record = None):
+    """ Returns the manifest information (size, mtime, hash) for a file.
+        The content hash is only computed if size or mtime differ
+        from the ones in record.
+    """
+    stat = os.stat(filename)
+    info = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if record and record.get('size') == info['size'] and record.get('mtime') == info['mtime']:
+        info['hash'] = record.get('hash')
+    else:
+        info['hash'] = filehash(filename)
+    return info
+
+def uptodate(imagelist, manifest, chash):
+    """ Checks the images of an object against the manifest. Returns
+        (isuptodate, infos) with infos the current fileinfo of each image.
+        The object is up to date if all images were reduced before with
+        the same contents, pipeline mode and configuration.
+    """
+    isuptodate = True
+    infos = {}
+    for image in imagelist:
+        record = manifest.get(image)
+        infos[image] = fileinfo(image, record)
+        if ( not record or record.get('hash') != infos[image]['hash'] or
+             record.get('pipemode') != pipemode or record.get('config') != chash ):
+            isuptodate = False
+    return isuptodate, infos
+
+def imageoutputs(pipeline, imagelist, outfiles):
+    """ Returns a dictionary with the images of imagelist which went
+        through all pipeline steps and the files in outfiles saved for
+        each of them. A pipe step error for one file only drops that
+        file from the pipeline results (errstop = 0), such images are
+        not returned so they are reduced again on the next run.
+    """
+    def begin(filename):
+        data = DataParent(config = pipeline.config)
+        data.filename = filename
+        return os.path.split(data.filenamebegin)[1]
+    finals = set([begin(data.filename) for data in pipeline.results])
+    outputs = {}
+    for image in imagelist:
+        imgbegin = begin(image)
+        if imgbegin in finals:
+            outputs[image] = [f for f in outfiles if os.path.split(f)[1].startswith(imgbegin)]
+        else:
+            log.warning('Pipeline returned no result for image = %s' % image)
+    return outputs
+
+def runpipe(pipeline, fullentry, imagelist):
+    """ Runs pipeline on the images in imagelist from the object folder
+        fullentry. Errors are logged and not raised, so a failing object
+        does not stop the reduction of the other objects.
+        Returns (entry, success, outputs) with outputs a dictionary of
+        the images which were reduced and the files saved for each of
+        them during this call (see imageoutputs).
+    """
+    entry = os.path.split(fullentry)[1]
+    # Log everything for this object into its own log file as well
+    objhand = logging.FileHandler(os.path.join(fullentry, objlogname % entry))
+    objhand.setFormatter(logging.Formatter(logfmt))
+    logging.getLogger().addHandler(objhand)
+    nout = len(pipeline.outfiles)
+    # Run the pipeline (return with error message)
+    #result = pipe(imagelist)
+    success = True
+    try:
+        #pass
+        result = pipeline(imagelist, pipemode = pipemode, force=True)
+    except Exception as e:
+        success = False
+        log.warning("Pipeline for object = %s returned Error" % entry)
+        log.warning('Found Error = %s' % repr(e))
+        print('Found Error = %s' % repr(e))
+        for tr in reversed(traceback.format_exc().split('\n')):
+            log.warning(tr)
+    finally:
+        logging.getLogger().removeHandler(objhand)
+        objhand.close()
+    outputs = {}
+    if success:
+        outputs = imageoutputs(pipeline, imagelist, pipeline.outfiles[nout:])
+    return entry, success, outputs
+
+def reduceobject(fullentry, imagelist):
+    """ Runs the pipeline of this process on all images in the object
+        folder fullentry, see runpipe().
+    """
+    # Now the program will run the files placed in imagelist through the pipeline.
+    pipe.reset()
+    return runpipe(pipe, fullentry, imagelist)
+
+def execute():
+    # This version only needs to be executed from a terminal. A specific image folder
+    # (like the ones on the stars base) is specified for the pipeline.  The pipeline
+    # will look in the folder and find any of the sub-folders that contain the FITS images.
+    # It will then automatically take the files it finds and run them through the pipeline.
+    print(sys.argv)
+    parser = argparse.ArgumentParser(description='Reduce all objects of a day')
+    # Load the specified directory -- entered as the second argument in the terminal command
+    parser.add_argument('topdirectory', default = datefilepath, type=str, nargs='?',
+                        help='folder with the object folders (default = today)')
+    parser.add_argument('-w', '--workers', default = workers, type=int,
+                        help='number of objects to reduce in parallel (default = %d)' % workers)
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='reduce all objects, even if they are up to date in the manifest')
+    args = parser.parse_args()
+    topdirectory = args.topdirectory
+    # Only one run at a time for each day folder (the driver can be
+    # started every few minutes, a long run may still be going)
+    lockfile = open(os.path.join(topdirectory, manifestname + '.lock'), 'w')
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        log.warning('Other reduction running for %s - exiting' % topdirectory)
+        return
+    objectlist = getobjectlist(topdirectory)
     log.info('Object list = %s' %repr(objectlist))
-    # Run this loop for each object folder ('entry') found in objectlist
-    # THIS IS THE MAIN LOOP OVER ALL OBSERVED OBJECTS
+    # Get the images for each object folder, skip objects that are up to date
+    manifest = loadmanifest(topdirectory)
+    chash = confighash()
+    tasks = []
+    infos = {}
     for entry in objectlist:
-        # The empty list is created here so that it keeps getting rewritten for the pipeline
-        imagelist = []
         # Add the full path the the path for the observation
         fullentry = os.path.join(topdirectory,entry)
-        # Run this loop for each file ('image') found in the object folder ('fullentry')
-        for image in os.listdir(fullentry):
-            # Makes sure the images collected are FITS images, i.e. avoid reducing
-            #     existing data reduction product
-            # This searches image filenames which end with .fits preceeded by
-            #     '_0', 'RAW', 'seo' or 'SRT' with optional '.gz' at the end
-            if not re.search(r'(_0|RAW|seo|SRT)\.fits(?:\.gz)?\Z',image):
-                continue
-            # Ignore dark, flat or bias images
-            if 'dark' in image or 'flat' in image or 'bias' in image or 'pinpoint' in image:
-                continue
-            # Adds the correct images to imagelist
-            imagelist.append(os.path.join(fullentry,image))
+        imagelist = getimagelist(fullentry)
         log.info('Object = %s Image list = %s' % (entry, repr(imagelist)))
         if len(imagelist) == 0 :
             log.warning('Image List is Empty, skipping object = %s' % entry)
             continue
-        # Now the program will run the files placed in imagelist through the pipeline.
-        # It will do this for every entry in objectlist (i.e. for every object)
-        pipe.reset()
-        # Run the pipeline (return with error message)
-        #result = pipe(imagelist)
+        isuptodate, infos[entry] = uptodate(imagelist, manifest, chash)
+        if isuptodate and not args.force:
+            log.info('All images already reduced, skipping object = %s' % entry)
+            continue
+        tasks.append((fullentry, imagelist))
+    # Run the pipeline for each object folder ('entry') which needs reduction
+    #   All images of an object are reduced together (StepRGB needs all filters)
+    # THIS IS THE MAIN LOOP OVER ALL OBSERVED OBJECTS
+    nworkers = max(1, min(args.workers, len(tasks)))
+    if nworkers == 1:
+        initworker()
+        results = [reduceobject(fullentry, imagelist) for fullentry, imagelist in tasks]
+    else:
+        # Each worker process has its own PipeLine object and reduces
+        # one object folder at a time
+        log.info('Reducing %d objects with %d workers' % (len(tasks), nworkers))
+        pool = multiprocessing.Pool(nworkers, initializer = initworker)
         try:
-            #pass
-            result = pipe(imagelist, pipemode = 'seo_server',force=True)
-        except Exception as e:
-            log.warning("Pipeline for object = %s returned Error" % entry)
-            log.warning('Found Error = %s' % repr(e))
-            print('Found Error = %s' % repr(e))
-            try:
-                trb = traceback.format_exc().split('\n').reverse()
-                for tr in trb:
-                    log.warning(tr)
-            except Exception as f:
-                log.warning('Unable to print traceback')
-                print(traceback.format_exc(),trb)
-
-
-# Run the setup code in an error with reporting traceback
-#execute()
-try:
-    #pass
-    execute()
-except Exception as e:
-    log.error('Found Error = %s' % repr(e))
+            results = pool.starmap(reduceobject, tasks, chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+    # Update the manifest with the successfully reduced images
+    #   (failed objects and images are tried again on the next run)
+    for entry, success, outputs in results:
+        for image, info in infos[entry].items():
+            if image not in outputs:
+                continue
+            info['pipemode'] = pipemode
+            info['config'] = chash
+            info['outputs'] = outputs[image]
+            manifest[image] = info
+    savemanifest(topdirectory, manifest)
+    failed = [entry for entry, success, outputs in results if not success]
+    if len(failed):
+        log.warning('Pipeline failed for objects = %s' % repr(failed))
+    log.info('Reduced %d objects, %d failed, %d skipped' %
+             (len(results), len(failed), len(objectlist) - len(tasks)))
+
+
+if __name__ == '__main__':
+    # Run the setup code in an error with reporting traceback
+    #execute()
     try:
-        trb = traceback.format_exc().split('\n').reverse()
-        for tr in trb:
+        #pass
+        execute()
+    except Exception as e:
+        log.error('Found Error = %s' % repr(e))
+        for tr in reversed(traceback.format_exc().split('\n')):
             log.error(tr)
-    except Exception as f:
-        log.warning('Unable to print traceback')
-        print(traceback.format_exc(),trb)
-    raise e
+        raise e
 
 ''' 
 HISTORY:
+2026/10/18: Split out runpipe() and israwimage() for use by PipeWatchDaemon.py
+2026/10/18: Use pipeline mode seo_server_batch (no StepRGB), the color images
+            are made after the reduction by PipeRenderRGB.py.
+2026/10/18: Only images which went through all pipeline steps are added to
+            the manifest (imageoutputs), images dropped by a step error are
+            reduced again on the next run.
+2026/10/18: Added manifest of reduced files (PipeManifest.json in the day
+            folder), objects with unchanged inputs and configuration are
+            skipped. Use --force to reduce everything.
+2026/10/18: Added --workers option to reduce object folders in parallel, each
+            worker process has its own PipeLine. Each object also logs into
+            its own log file in the object folder.
 2017/06/23: This version processes all inputs into the pipeine instead of just 3
             inputs, so StepMakeRGB can get the desired  3 best inputs for a jpg
             image -- Atreyo Pal
@@ -0,0 +1,182 @@
+#!/usr/local/bin/python3
+
+# Below is the "default" python path, the one above is necessary on stars.
+#!/usr/bin/env python
+
+''' PIPE RENDER RGB
+    ===============
+
+    Renders the color images of all reduced objects of a day folder in
+    one run and makes a contact sheet of them for the daily summary.
+
+    An object is reduced if its folder has reduced files (file names
+    ending with _FCAL.fits, see suffix). The objects are rendered with
+    StepRGB (settings from the makergb section of the pipeline
+    configuration) in a pool of worker processes, each worker keeps its
+    StepRGB object (and the loaded label fonts) between objects. Each
+    JPEG is encoded once, StepRGB links or copies it to the folderpaths.
+
+    The contact sheet (%s_RGBsheet.jpg with the day folder name) is saved
+    in the day folder. It uses the thumbnails if StepRGB makes them
+    (thumbsize), the color images otherwise.
+
+    The same lock file as PipeExecuteAutoDay is used, the script exits
+    if a reduction of the day is running.
+
+    Usage:
+      PipeRenderRGB.py [topdirectory] [--workers N] [--sheetonly]
+'''
+
+import os
+import sys
+import time
+import logging
+import argparse
+import traceback
+import multiprocessing
+import fcntl
+
+# Import settings and functions from the daily reduction script
+#   (this also sets up logging into the pipeline log file)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import PipeExecuteAutoDay as autoday
+from darepype.drp import DataFits
+from stonesteps.steprgb import StepRGB
+from stonetools.contactsheet import contactsheet
+
+### Settings
+# Reduced files used for the color images end with _suffix.fits
+suffix = 'FCAL'
+# Name of the contact sheet in the day folder (%s is the day folder name)
+sheetname = '%s_RGBsheet.jpg'
+# Size (pixels) of the images on the contact sheet
+tilesize = 256
+# Number of images per row on the contact sheet
+sheetcols = 6
+
+log = logging.getLogger('pipe.RenderRGB')
+
+# StepRGB object - one for each worker process (set by initworker)
+step = None
+
+def initworker():
+    """ Makes the StepRGB object for this process. Used as initializer
+        for the worker pool.
+    """
+    global step
+    step = StepRGB()
+
+def getrgbfiles(fullentry):
+    """ Returns a list of the reduced files in the object folder fullentry
+    """
+    return sorted([os.path.join(fullentry, f) for f in os.listdir(fullentry)
+                   if f.endswith('_%s.fits' % suffix)])
+
+def jpegnames(filename):
+    """ Returns the names of the color image and the thumbnail StepRGB
+        makes from the reduced file filename.
+    """
+    data = DataFits(config = autoday.pipeconf)
+    data.filename = filename
+    imgname = data.filenamebegin
+    if imgname[-1] in '_-,.': imgname=imgname[:-1]
+    return imgname + '.jpg', imgname + '_thumb.jpg'
+
+def renderobject(fullentry, filelist):
+    """ Renders the color image of the object folder fullentry from the
+        files in filelist. Errors are logged and not raised. Returns
+        (entry, image) with the file name of the color image or None.
+    """
+    entry = os.path.split(fullentry)[1]
+    try:
+        datalist = []
+        for filename in filelist:
+            data = DataFits(config = autoday.pipeconf)
+            data.load(filename)
+            datalist.append(data)
+        dataout = step(datalist)
+        return entry, jpegnames(dataout[-1].filename)[0]
+    except Exception as e:
+        log.warning('StepRGB for object = %s returned Error = %s' % (entry, repr(e)))
+        for tr in reversed(traceback.format_exc().split('\n')):
+            log.warning(tr)
+        return entry, None
+
+def execute():
+    parser = argparse.ArgumentParser(description='Render the color images of all objects of a day')
+    parser.add_argument('topdirectory', default = autoday.datefilepath, type=str, nargs='?',
+                        help='folder with the object folders (default = today)')
+    parser.add_argument('-w', '--workers', default = autoday.workers, type=int,
+                        help='number of objects to render in parallel (default = %d)' % autoday.workers)
+    parser.add_argument('-s', '--sheetonly', action='store_true',
+                        help='only make the contact sheet from the existing color images')
+    args = parser.parse_args()
+    topdirectory = args.topdirectory
+    lockfile = open(os.path.join(topdirectory, autoday.manifestname + '.lock'), 'w')
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        log.warning('Reduction running for %s - exiting' % topdirectory)
+        return
+    starttime = time.time()
+    tasks = []
+    for entry in sorted(autoday.getobjectlist(topdirectory)):
+        fullentry = os.path.join(topdirectory, entry)
+        filelist = getrgbfiles(fullentry)
+        if len(filelist):
+            tasks.append((fullentry, filelist))
+        else:
+            log.info('No reduced files, skipping object = %s' % entry)
+    if args.sheetonly:
+        # The color image is named after the file used for red
+        results = []
+        for fullentry, filelist in tasks:
+            images = [jpegnames(filename)[0] for filename in filelist]
+            images = [image for image in images if os.path.exists(image)]
+            if len(images):
+                results.append((os.path.split(fullentry)[1], images[0]))
+    else:
+        nworkers = max(1, min(args.workers, len(tasks)))
+        if nworkers == 1:
+            initworker()
+            results = [renderobject(fullentry, filelist) for fullentry, filelist in tasks]
+        else:
+            log.info('Rendering %d objects with %d workers' % (len(tasks), nworkers))
+            pool = multiprocessing.Pool(nworkers, initializer = initworker)
+            try:
+                results = pool.starmap(renderobject, tasks, chunksize = 1)
+            finally:
+                pool.close()
+                pool.join()
+        failed = [entry for entry, image in results if image is None]
+        if len(failed):
+            log.warning('StepRGB failed for objects = %s' % repr(failed))
+        log.info('Rendered %d objects in %.1f seconds, %d failed' %
+                 (len(results), time.time() - starttime, len(failed)))
+    # Contact sheet: use the thumbnails if they exist
+    images, labels = [], []
+    for entry, image in results:
+        if image is None:
+            continue
+        thumb = image[:-len('.jpg')] + '_thumb.jpg'
+        images.append(thumb if os.path.exists(thumb) else image)
+        labels.append(entry)
+    daystring = os.path.basename(os.path.normpath(topdirectory))
+    contactsheet(images, os.path.join(topdirectory, sheetname % daystring),
+                 tilesize, sheetcols, labels)
+
+if __name__ == '__main__':
+    # Run the setup code in an error with reporting traceback
+    try:
+        execute()
+    except Exception as e:
+        log.error('Found Error = %s' % repr(e))
+        for tr in reversed(traceback.format_exc().split('\n')):
+            log.error(tr)
+        raise e
+
+'''
+HISTORY:
+2026/10/18: First version: render all objects of a day in a process pool,
+            contact sheet of the color images.
+'''
@@ -0,0 +1,368 @@
+#!/usr/local/bin/python3
+
+# Below is the "default" python path, the one above is necessary on stars.
+#!/usr/bin/env python
+
+''' PIPE WATCH DAEMON
+    =================
+
+    Long running service that reduces new images as soon as they are
+    uploaded, instead of waiting for the daily run of PipeDailyRun.sh.
+
+    The daemon watches the day folders (today and the days before, see
+    watchdays) for new files:
+    - New raw images in the itzamna upload folder are sorted into their
+      object folder (pipeline mode sortobs_file, same as mode sortobs but
+      for a single file).
+    - New raw images in an object folder are reduced with the pipeline
+      mode of PipeExecuteAutoDay.
+
+    A file is only used once its size and modification time have not
+    changed for settle seconds (so partially written files are not read).
+    New files are found with inotify (requires the inotify_simple package),
+    if it's not available the folders are polled.
+
+    Each object folder keeps its own PipeLine object between files. New
+    images are added to it without a reset, so only the new image runs
+    through the single input steps. The pipe steps (and the calibration
+    masters they loaded) stay in memory.
+
+    The pipeline mode has no StepRGB (a new PipeLine, i.e. after a
+    restart, only has the new images). After new images are reduced the
+    color image is rendered as in PipeRenderRGB from all reduced files in
+    the object folder.
+
+    The daemon uses the same manifest and lock file as PipeExecuteAutoDay,
+    images that were already reduced are skipped. Master bias/dark/flat
+    files are still made by the daily run (they need all calibration
+    images of the day).
+
+    Usage:
+      PipeWatchDaemon.py [--polling] [--settle SEC] [--interval SEC]
+'''
+
+import os
+import sys
+import time
+import logging
+import argparse
+import fcntl
+import collections
+
+# Import settings and functions from the daily reduction script
+#   (this also sets up logging into the pipeline log file)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import PipeExecuteAutoDay as autoday
+from PipeExecuteAutoDay import PipeLine
+import PipeRenderRGB as renderrgb
+
+# inotify is optional, folders are polled if it's missing
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+### Settings
+# Day folder (time-formatted)
+daypath = '/data/images/StoneEdge/0.5meter/%Y/%Y-%m-%d'
+# Number of day folders to watch (1 = today only, 2 = today and yesterday)
+#   Nights go past midnight, so yesterday's folder still gets images
+watchdays = 2
+# Name of the upload folder in the day folder
+uploadname = 'itzamna'
+# Pipeline mode to sort a single uploaded file into its object folder
+sortmode = 'sortobs_file'
+# Time (seconds) a file has to be unchanged before it's used
+settle = 5.0
+# Time (seconds) between checks for new files
+interval = 1.0
+# Maximal number of object PipeLines kept in memory
+maxpipes = 50
+
+log = logging.getLogger('pipe.WatchDaemon')
+
+class FolderWatcher(object):
+    """ Watches a set of folders for new or changed files. Uses inotify
+        if available, otherwise the folders are polled.
+    """
+
+    def __init__(self, usenotify = True):
+        """ Constructor: Set up inotify if requested and available
+        """
+        self.inotify = None
+        if usenotify and INotify != None:
+            self.inotify = INotify()
+            self.watchflags = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        self.watches = {} # folder -> inotify watch descriptor
+        self.known = {} # filepathname -> (size, mtime) for polling
+        log.info('FolderWatcher: Using %s' % ('inotify' if self.inotify else 'polling'))
+
+    def setfolders(self, folders):
+        """ Sets the list of folders to watch. Returns all files in
+            newly watched folders (they may have arrived before).
+        """
+        found = []
+        # Remove old folders
+        for folder in list(self.watches):
+            if folder not in folders:
+                if self.inotify and self.watches[folder] != None:
+                    try:
+                        self.inotify.rm_watch(self.watches[folder])
+                    except OSError:
+                        pass
+                del self.watches[folder]
+                for fname in [f for f in self.known if os.path.dirname(f) == folder]:
+                    del self.known[fname]
+        # Add new folders
+        for folder in folders:
+            if folder in self.watches or not os.path.isdir(folder):
+                continue
+            self.watches[folder] = None
+            if self.inotify:
+                self.watches[folder] = self.inotify.add_watch(folder, self.watchflags)
+            found += self.scan(folder)
+        return found
+
+    def scan(self, folder):
+        """ Returns files in folder which are new or have changed since the
+            last scan.
+        """
+        found = []
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            return found
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            state = (stat.st_size, stat.st_mtime)
+            if self.known.get(entry.path) != state:
+                self.known[entry.path] = state
+                found.append(entry.path)
+        return found
+
+    def changes(self, timeout):
+        """ Waits up to timeout seconds and returns a list of new or
+            changed files.
+        """
+        if self.inotify:
+            folders = dict((wd, folder) for folder, wd in self.watches.items())
+            found = []
+            for event in self.inotify.read(timeout = int(timeout * 1000)):
+                if event.wd in folders and event.name:
+                    found.append(os.path.join(folders[event.wd], event.name))
+            return found
+        time.sleep(timeout)
+        found = []
+        for folder in list(self.watches):
+            found += self.scan(folder)
+        return found
+
+class Debouncer(object):
+    """ Keeps track of files until they have not changed for settle
+        seconds (i.e. they are completely written).
+    """
+
+    def __init__(self, settle):
+        """ Constructor: Initialize list of pending files
+        """
+        self.settle = settle
+        self.pending = {} # filepathname -> (size, mtime, time of last change)
+
+    def add(self, filename):
+        """ Adds a new or changed file
+        """
+        self.pending[filename] = (None, None, time.time())
+
+    def ready(self):
+        """ Returns the pending files which have not changed for settle
+            seconds, they are removed from the pending list.
+        """
+        now = time.time()
+        ready = []
+        for filename, (size, mtime, changed) in list(self.pending.items()):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                # File is gone (i.e. renamed after upload)
+                del self.pending[filename]
+                continue
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                self.pending[filename] = (stat.st_size, stat.st_mtime, now)
+            elif now - changed >= self.settle and stat.st_size > 0:
+                ready.append(filename)
+                del self.pending[filename]
+        return sorted(ready)
+
+class WatchDaemon(object):
+    """ Sorts and reduces new images in the watched day folders
+    """
+
+    def __init__(self, usenotify = True, settle = settle):
+        """ Constructor: Set up watcher and pipelines
+        """
+        self.watcher = FolderWatcher(usenotify)
+        self.debouncer = Debouncer(settle)
+        # Pipeline for sorting uploaded files
+        self.sortpipe = PipeLine(config = autoday.pipeconf)
+        # Pipelines for object folders: fullentry -> PipeLine
+        self.pipes = collections.OrderedDict()
+        self.chash = autoday.confighash()
+        # StepRGB for the color images
+        renderrgb.initworker()
+
+    def dayfolders(self):
+        """ Returns the day folders to watch
+        """
+        now = time.time()
+        return [time.strftime(daypath, time.localtime(now - 86400 * i))
+                for i in range(watchdays)]
+
+    def watchfolders(self):
+        """ Returns all folders to watch: upload and object folders of
+            each day folder.
+        """
+        folders = []
+        for dayfolder in self.dayfolders():
+            if not os.path.isdir(dayfolder):
+                continue
+            # Watch the day folder itself to see new object folders
+            folders.append(dayfolder)
+            upload = os.path.join(dayfolder, uploadname)
+            if os.path.isdir(upload):
+                folders.append(upload)
+            for entry in autoday.getobjectlist(dayfolder):
+                fullentry = os.path.join(dayfolder, entry)
+                if os.path.isdir(fullentry):
+                    folders.append(fullentry)
+        return folders
+
+    def getpipe(self, fullentry):
+        """ Returns the PipeLine for an object folder, makes a new one
+            if needed. The least recently used PipeLine is dropped if
+            there are more than maxpipes.
+        """
+        if fullentry in self.pipes:
+            self.pipes.move_to_end(fullentry)
+        else:
+            self.pipes[fullentry] = PipeLine(config = autoday.pipeconf)
+            while len(self.pipes) > maxpipes:
+                oldentry, oldpipe = self.pipes.popitem(last = False)
+                log.debug('Dropping pipeline for %s' % oldentry)
+        return self.pipes[fullentry]
+
+    def sortfile(self, filename):
+        """ Sorts an uploaded file into its object folder
+        """
+        fname = os.path.split(filename)[1]
+        if not autoday.israwimage(fname):
+            return
+        log.info('Sorting uploaded file %s' % filename)
+        self.sortpipe.reset()
+        try:
+            self.sortpipe([filename], pipemode = sortmode, force = True)
+        except Exception as e:
+            log.warning('Unable to sort file %s: %s' % (filename, repr(e)))
+
+    def reducefiles(self, fullentry, imagelist):
+        """ Reduces new images of an object folder (unless they are up to
+            date in the manifest) and updates the manifest.
+        """
+        dayfolder = os.path.dirname(fullentry)
+        lockfile = open(os.path.join(dayfolder, autoday.manifestname + '.lock'), 'w')
+        try:
+            # Wait if PipeExecuteAutoDay is reducing this day
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            manifest = autoday.loadmanifest(dayfolder)
+            newlist = []
+            infos = {}
+            for image in imagelist:
+                isuptodate, info = autoday.uptodate([image], manifest, self.chash)
+                if not isuptodate:
+                    newlist.append(image)
+                    infos.update(info)
+            if len(newlist) == 0:
+                return
+            log.info('Reducing new images %s' % repr(newlist))
+            start = time.time()
+            entry, success, outputs = autoday.runpipe(self.getpipe(fullentry),
+                                                      fullentry, newlist)
+            if success:
+                # Images dropped by a pipe step error are tried again
+                for image, info in infos.items():
+                    if image not in outputs:
+                        continue
+                    info['pipemode'] = autoday.pipemode
+                    info['config'] = self.chash
+                    info['outputs'] = outputs[image]
+                    manifest[image] = info
+                autoday.savemanifest(dayfolder, manifest)
+                # Color image from all reduced files of the object
+                if len(outputs):
+                    renderrgb.renderobject(fullentry, renderrgb.getrgbfiles(fullentry))
+            else:
+                # Start over for this object next time
+                self.pipes.pop(fullentry, None)
+            log.info('Object = %s reduced %d images in %.1f seconds' %
+                     (entry, len(newlist), time.time() - start))
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
+
+    def process(self, filenames):
+        """ Sorts or reduces files which are ready
+        """
+        # Sort uploaded files first, they show up again in the object folder
+        objfiles = collections.OrderedDict()
+        for filename in filenames:
+            folder, fname = os.path.split(filename)
+            if os.path.split(folder)[1] == uploadname:
+                self.sortfile(filename)
+            elif autoday.israwimage(fname) and os.path.dirname(folder) in self.dayfolders():
+                objfiles.setdefault(folder, []).append(filename)
+        # Reduce the new images of each object together
+        for fullentry, imagelist in objfiles.items():
+            self.reducefiles(fullentry, imagelist)
+
+    def run(self, interval = interval):
+        """ Main loop: Watch folders and process new files
+        """
+        log.info('Watching %s' % repr(self.dayfolders()))
+        while True:
+            for filename in self.watcher.setfolders(self.watchfolders()):
+                self.debouncer.add(filename)
+            for filename in self.watcher.changes(interval):
+                self.debouncer.add(filename)
+            ready = self.debouncer.ready()
+            if len(ready):
+                self.process(ready)
+            # Forget object pipelines of days that are not watched anymore
+            dayfolders = self.dayfolders()
+            for fullentry in list(self.pipes):
+                if os.path.dirname(fullentry) not in dayfolders:
+                    del self.pipes[fullentry]
+
+def execute():
+    """ Reads the arguments and runs the daemon
+    """
+    parser = argparse.ArgumentParser(description='Reduce new images as they are uploaded')
+    parser.add_argument('--polling', action='store_true',
+                        help='poll folders instead of using inotify')
+    parser.add_argument('--settle', default = settle, type=float,
+                        help='seconds a file has to be unchanged before use (default = %.1f)' % settle)
+    parser.add_argument('--interval', default = interval, type=float,
+                        help='seconds between checks for new files (default = %.1f)' % interval)
+    args = parser.parse_args()
+    daemon = WatchDaemon(usenotify = not args.polling, settle = args.settle)
+    daemon.run(interval = args.interval)
+
+if __name__ == '__main__':
+    log.info('Starting up')
+    try:
+        execute()
+    except KeyboardInterrupt:
+        log.info('Stopped')
+    except Exception as e:
+        log.exception('Found Error = %s' % repr(e))
+        raise e
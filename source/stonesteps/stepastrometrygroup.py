@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+""" PIPE STEP ASTROMETRY GROUP - Version 1.0.0
+
+    This pipe step adds WCS information to a set of frames taken at the
+    same pointing (i.e. the g, r and i frames of one observation).
+
+    The frames are grouped by the groupkeys header values and pointing.
+    For each group the frame with the most sources (in the SEP table,
+    default HTS) is solved with StepAstrometryLocal. For the other frames
+    of the group a shift and rotation to the solved frame is fitted from
+    the SEP source lists and the WCS is derived from the solution. A frame
+    is solved with StepAstrometryLocal if too few sources match or the
+    residuals of the fit are too large.
+
+    If the frame with the most sources can't be solved, the next frame
+    (by number of sources) is solved. Frames which can't be solved and
+    whose WCS can't be derived are passed on without WCS.
+
+    Requirements: the frames need a SEP source table (run StepSrcExtPy
+        first), astrometry.net is needed as for StepAstrometryLocal.
+
+    @author: agent
+"""
+
+import os # os library
+import logging # logging object library
+import numpy as np # numpy library
+from astropy import wcs # to get WCS coordinates
+from astropy.wcs.utils import fit_wcs_from_points # to make derived WCS
+from astropy.coordinates import Angle, SkyCoord
+import astropy.units as u
+from darepype.drp import StepMOParent # pipe step parent object
+from stonesteps.stepastrometrylocal import StepAstrometryLocal # to solve frames
+from stonetools.refcat import angdist # angular distance
+from stonetools.starmatch import fittransform # to match source lists
+
+class StepAstrometryGroup(StepMOParent):
+    """ Stone Edge Pipeline Step Astrometry Group Object
+        The object is callable. It requires a valid configuration input
+        (file or object) when it runs.
+    """
+    stepver = '0.1' # pipe step version
+
+    def setup(self):
+        """ ### Names and Parameters need to be Set Here ###
+            Sets the internal names for the function and for saved files.
+            Defines the input parameters for the current pipe step.
+            Setup() is called at the end of __init__
+            The parameters are stored in a list containing the following
+            information:
+            - name: The name for the parameter. This name is used when
+                    calling the pipe step from command line or python shell.
+                    It is also used to identify the parameter in the pipeline
+                    configuration file.
+            - default: A default value for the parameter. If nothing, set
+                       '' for strings, 0 for integers and 0.0 for floats
+            - help: A short description of the parameter.
+        """
+        ### Set Names
+        # Name of the pipeline reduction step
+        self.name='astrometrygroup'
+        # Shortcut for pipeline reduction step and identifier for
+        # saved file names.
+        self.procname = 'WCS'
+        # Set Logger for this pipe step
+        self.log = logging.getLogger('pipe.step.%s' % self.name)
+        ### Set Parameter list
+        # Clear Parameter list
+        self.paramlist = []
+        # Append parameters
+        self.paramlist.append(['table_name', 'HTS',
+                               'Name of the SEP source table to use'])
+        self.paramlist.append(['groupkeys', ['OBJECT', 'XBIN'],
+                               'Header keywords that must match for frames of a group'])
+        self.paramlist.append(['groupradius', 0.1,
+                               'Maximal pointing difference (degrees) for frames of a group'])
+        self.paramlist.append(['nsources', 100,
+                               'Number of brightest sources to use for the fit'])
+        self.paramlist.append(['matchtol', 3.0,
+                               'Tolerance (pixels) to match sources'])
+        self.paramlist.append(['minmatch', 8,
+                               'Minimal number of matched sources for a derived WCS'])
+        self.paramlist.append(['maxresid', 1.0,
+                               'Maximal RMS residual (pixels) for a derived WCS'])
+        # confirm end of setup
+        self.log.debug('Setup: done')
+
+    def pointing(self, data):
+        """ Returns (ra, dec) in degrees from the header or None
+        """
+        try:
+            return (Angle(data.getheadval('RA'), unit=u.hour).degree,
+                    Angle(data.getheadval('DEC'), unit=u.deg).degree)
+        except Exception:
+            return None
+
+    def groups(self, datalist):
+        """ Returns a list of groups (lists of indices of datalist) with
+            matching groupkeys and pointing within groupradius.
+        """
+        groups = []
+        members = [] # (keyvalues, pointing) of the first frame of each group
+        for i, data in enumerate(datalist):
+            keyvals = [str(data.header.get(key, '')) for key in self.getarg('groupkeys')]
+            point = self.pointing(data)
+            for group, (gkeyvals, gpoint) in zip(groups, members):
+                if keyvals == gkeyvals and point is not None and gpoint is not None and \
+                   angdist(point[0], point[1], gpoint[0], gpoint[1]) <= self.getarg('groupradius'):
+                    group.append(i)
+                    break
+            else:
+                groups.append([i])
+                members.append((keyvals, point))
+        return groups
+
+    def sources(self, data):
+        """ Returns the pixel positions (N x 2 array) of the sources of
+            data (the SEP tables are sorted by flux)
+        """
+        try:
+            table = data.tableget(self.getarg('table_name'))
+        except Exception:
+            return np.zeros((0, 2))
+        if table is None:
+            return np.zeros((0, 2))
+        return np.column_stack((np.asarray(table['X'], dtype=float),
+                                np.asarray(table['Y'], dtype=float)))
+
+    def fittransform(self, xy, xyref):
+        """ Fits a rotation and shift which maps positions xy to xyref
+            (N x 2 and M x 2 arrays, not matched). Returns (rotation matrix,
+            shift, rms residual, number of matches) or None.
+        """
+        return fittransform(xy, xyref, self.getarg('matchtol'))
+
+    def derivewcs(self, data, solved):
+        """ Derives the WCS of data from the solved frame, returns the
+            WCS and a message or None and a message if it fails.
+        """
+        n = self.getarg('nsources')
+        fit = self.fittransform(self.sources(data)[:n], self.sources(solved)[:n])
+        if fit is None:
+            return None, 'no source match'
+        rot, shift, rms, nmatch = fit
+        msg = '%d sources, rms=%.2f pixels, rotation=%.3f deg, shift=%.1f,%.1f pixels' % (
+            nmatch, rms, np.degrees(np.arctan2(rot[1, 0], rot[0, 0])), shift[0], shift[1])
+        if nmatch < self.getarg('minmatch') or rms > self.getarg('maxresid'):
+            return None, msg
+        # Map a grid of the frame to the solved frame and fit the WCS
+        wsolved = wcs.WCS(solved.header)
+        ny, nx = data.image.shape[-2:]
+        gx, gy = np.meshgrid(np.linspace(0, nx - 1, 10), np.linspace(0, ny - 1, 10))
+        grid = np.column_stack((gx.ravel(), gy.ravel()))
+        ra, dec = wsolved.all_pix2world(grid.dot(rot.T) + shift, 0).T
+        sipdeg = wsolved.sip.a_order if wsolved.sip is not None else None
+        wfit = fit_wcs_from_points((grid[:, 0], grid[:, 1]), SkyCoord(ra, dec, unit='deg'),
+                                   proj_point='center', projection='TAN', sip_degree=sipdeg)
+        return wfit, msg
+
+    def solve(self, solver, data):
+        """ Solves data with the StepAstrometryLocal object solver.
+            Returns the solved data or None if solving fails.
+        """
+        try:
+            return solver(data)
+        except Exception as error:
+            self.log.warning('Unable to solve %s: %s' % (data.filename, repr(error)))
+            return None
+
+    def run(self):
+        """ Runs the data reduction algorithm. The self.datain is run
+            through the code, the result is in self.dataout.
+        """
+        solver = StepAstrometryLocal()
+        self.dataout = list(self.datain)
+        for group in self.groups(self.datain):
+            # Solve the frame with most sources, if that fails the next one
+            nsources = [len(self.sources(self.datain[i])) for i in group]
+            order = [group[j] for j in np.argsort(nsources, kind='stable')[::-1]]
+            tried = [] # frames which failed to solve
+            best = None
+            for i in order:
+                self.log.info('Solving %s (%d sources) for group of %d frames' %
+                              (self.datain[i].filename, len(self.sources(self.datain[i])),
+                               len(group)))
+                solved = self.solve(solver, self.datain[i])
+                if solved is not None:
+                    self.dataout[i] = solved
+                    best = i
+                    break
+                tried.append(i)
+            if best is None:
+                self.log.warning('No frame of group solved, passing %d frames without WCS' %
+                                 len(group))
+                continue
+            # Derive the WCS for the other frames
+            for i in group:
+                if i == best:
+                    continue
+                data = self.datain[i]
+                wfit, msg = self.derivewcs(data, self.dataout[best])
+                if wfit is None:
+                    if i in tried:
+                        self.log.warning('Unable to derive WCS for %s (%s) -> passing without WCS' %
+                                         (data.filename, msg))
+                        continue
+                    self.log.info('Unable to derive WCS for %s (%s) -> solving' %
+                                  (data.filename, msg))
+                    solved = self.solve(solver, data)
+                    if solved is None:
+                        self.log.warning('Passing %s without WCS' % data.filename)
+                    else:
+                        self.dataout[i] = solved
+                    continue
+                self.log.info('Derived WCS for %s: %s' % (data.filename, msg))
+                data = data.copy()
+                data.header.update(wfit.to_header(relax=True))
+                # Set RA/Dec of the image center (as StepAstrometryLocal)
+                n1 = float( data.header['NAXIS1']/2 )
+                n2 = float( data.header['NAXIS2']/2 )
+                ra, dec = wfit.all_pix2world(n1, n2, 1)
+                data.header['RA'] = Angle(ra,  u.deg).to_string(unit=u.hour, sep=':')
+                data.header['Dec']= Angle(dec, u.deg).to_string(sep=':')
+                data.setheadval('HISTORY', 'Astrometry: WCS from %s' %
+                                os.path.split(self.dataout[best].filename)[1])
+                data.setheadval('HISTORY', 'Astrometry: ' + msg)
+                self.dataout[i] = data
+        self.log.debug('Run: Done')
+
+if __name__ == '__main__':
+    """ Main function to run the pipe step from command line on a file.
+        Command:
+          python stepparent.py input.fits -arg1 -arg2 . . .
+        Standard arguments:
+          --config=ConfigFilePathName.txt : name of the configuration file
+          -t, --test : runs the functionality test i.e. pipestep.test()
+          --loglevel=LEVEL : configures the logging output for a particular level
+          -h, --help : Returns a list of
+    """
+    StepAstrometryGroup().execute()
+
+""" === History ===
+2026-10-18 First version: solve one frame per group, derive WCS of the others
+2026-10-18 Source matching moved to stonetools.starmatch
+2026-10-18 Solve next frame of the group if solving fails, pass frames
+           which can't be solved without WCS
+"""
@@ -19,12 +19,17 @@ import tempfile # temporary file library
 import os # library for operating system calls
 import time # library to manage delay and timeout
 import string # library to join text
+import signal # to stop subprocesses
 import subprocess # library to run subprocesses
+import numpy as np # numpy library
+from concurrent import futures # to run astrometry trials concurrently
 from astropy import wcs # to get WCS coordinates
+from astropy.io import fits # to write WCS files
 from astropy.coordinates import Angle
 import astropy.units as u
 from darepype.drp import DataFits
 from darepype.drp import StepParent
+from stonetools.wcscache import WCSCache, cachekey # cache of WCS solutions
 
 class StepAstrometryLocal(StepParent):
     """ HAWC Pipeline Step Parent Object
@@ -74,15 +79,145 @@ class StepAstrometryLocal(StepParent):
                                'Parameter groups to run if the command fails'])
         self.paramlist.append(['timeout', 300,
                                'Timeout for running astrometry (seconds)'])
+        self.paramlist.append(['xylsource', '',
+                               'Name of the source table (i.e. HTS from StepSrcExtPy) to solve from, ' +
+                               'empty to solve from the image (also used if the table is missing)'])
+        self.paramlist.append(['concurrent', 1,
+                               'Number of downsample / paramoptions trials to run at the same time'])
         self.paramlist.append(['ra', '',
                                'Option to manually set image center RA'])
         self.paramlist.append(['dec', '',
                                'Option to manually set image center DEC'])
         self.paramlist.append(['searchradius', 5,
                                'Only search in indexes within "searchradius" (degrees) of the field center given by --ra and --dec (degrees)'])
+        self.paramlist.append(['solvecache', '',
+                               'Filepathname of the WCS solution cache (SQLite file), empty for no cache'])
+        self.paramlist.append(['cachekeys', ['OBJECT', 'XBIN', 'INSTRUME'],
+                               'Header keywords that must match for a cached solution'])
+        self.paramlist.append(['cacheradius', 0.5,
+                               'Maximal distance (degrees) of cached solution from the field center'])
+        self.paramlist.append(['priortimeout', 30,
+                               'Timeout for the verify run with a cached solution (seconds)'])
         # confirm end of setup
         self.log.debug('Setup: done')
 
+    def start(self, command):
+        """ Starts an astrometry command, returns the process. The process
+            gets its own session, so stop() also stops the programs
+            started by the shell.
+        """
+        # Run the process - see note at the top of the file if using cron
+        self.log.debug('running command = %s' % command)
+        return subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, start_new_session=True)
+
+    def stop(self, process):
+        """ Kills a process started with start() and its children
+        """
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (OSError, AttributeError):
+            process.kill()
+
+    def wait(self, process, timeout):
+        """ Waits until the process is done or the timeout (seconds) is
+            reached, then the process is killed. Returns the return code
+            and the output of the process.
+        """
+        try:
+            output, _ = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.stop(process)
+            output, _ = process.communicate()
+        self.log.debug('command returns %d' % process.returncode)
+        return process.returncode, output.decode(errors='replace')
+
+    def solve(self, command, timeout):
+        """ Runs an astrometry command until it's done or the timeout
+            (seconds) is reached. Returns the return code and output.
+        """
+        return self.wait(self.start(command), timeout)
+
+    def solvetrials(self, trials, timeout):
+        """ Runs astrometry trials, a list of (command, output .new file
+            name, ...) tuples, in order with up to concurrent trials running at
+            the same time. When a trial is successful the running trials
+            are stopped. Returns the index of the successful trial (None if
+            all failed) and the output of that (or the last) trial.
+        """
+        nconcurrent = max(1, self.getarg('concurrent'))
+        pending = list(range(len(trials)))
+        running = {} # future: (trial index, process)
+        success, output = None, ''
+        with futures.ThreadPoolExecutor(max_workers=nconcurrent) as pool:
+            while success is None and (pending or running):
+                # Start trials until all slots are used
+                while pending and len(running) < nconcurrent:
+                    index = pending.pop(0)
+                    process = self.start(trials[index][0])
+                    running[pool.submit(self.wait, process, timeout)] = (index, process)
+                # Wait for the next trial to finish
+                done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                for future in sorted(done, key=lambda f: running[f][0]):
+                    index, process = running.pop(future)
+                    returncode, trialout = future.result()
+                    if success is None:
+                        output = trialout
+                    if returncode == 0 and os.path.exists(trials[index][1]):
+                        self.log.debug('output file valid -> astrometry successful')
+                        if success is None:
+                            success = index
+                    else:
+                        self.log.debug('output file missing -> astrometry failed')
+            # Stop the remaining trials
+            for index, process in running.values():
+                self.stop(process)
+        return success, output
+
+    def writexyls(self, filename):
+        """ Writes the sources of the xylsource table to an xyls file for
+            astrometry.net: X, Y (FITS convention, first pixel is 1) and
+            FLUX columns, brightest source first. Returns the number of
+            sources, no file is written if there are none.
+        """
+        tablename = self.getarg('xylsource')
+        if not len(tablename) or tablename.upper() not in self.datain.tabnames:
+            return 0
+        table = self.datain.tableget(tablename)
+        if len(table) == 0:
+            return 0
+        order = np.argsort(-np.asarray(table['Uncalibrated Flux']), kind='stable')
+        cols = [fits.Column(name='X', format='D', array=np.asarray(table['X'])[order] + 1.),
+                fits.Column(name='Y', format='D', array=np.asarray(table['Y'])[order] + 1.),
+                fits.Column(name='FLUX', format='D',
+                            array=np.asarray(table['Uncalibrated Flux'])[order])]
+        fits.BinTableHDU.from_columns(cols).writeto(filename, overwrite=True)
+        return len(order)
+
+    def solveprior(self, prior, infile, outname, inputoptions):
+        """ Runs astrometry with a cached solution as prior: the solution
+            is verified, if that fails a search is made near the cached
+            center and pixel scale. Returns the return code and output.
+        """
+        # Write the cached solution to a WCS file
+        priorname = os.path.join(os.path.split(infile)[0], outname.replace('.fits', '.prior.wcs'))
+        header = prior['header'].copy()
+        header['IMAGEW'] = self.datain.getheadval('NAXIS1')
+        header['IMAGEH'] = self.datain.getheadval('NAXIS2')
+        fits.PrimaryHDU(header=header).writeto(priorname, overwrite=True)
+        # Make the command (later options overrule the ones in astrocmd)
+        command = self.getarg('astrocmd') % (infile, outname) + inputoptions
+        command += ' --verify %s --ra %f --dec %f --radius %f' % (
+            priorname, prior['ra'], prior['dec'], self.getarg('cacheradius'))
+        command += ' --scale-units arcsecperpix --scale-low %f --scale-high %f' % (
+            0.95 * prior['scale'], 1.05 * prior['scale'])
+        if not len(inputoptions):
+            command += ' --downsample %d' % self.getarg('downsample')[0]
+        try:
+            return self.solve(command, self.getarg('priortimeout'))
+        finally:
+            os.remove(priorname)
+
     def run(self):
         """ Runs the data reduction algorithm. The self.datain is run
             through the code, the result is in self.dataout.
@@ -96,13 +231,29 @@ class StepAstrometryLocal(StepParent):
         fp.close()
         # Add input file path to ouput file and make new name
         outpath = os.path.split(self.datain.filename)[0]
-        outnewname = os.path.join(outpath, outname.replace('.fits','.new') )
-        outwcsname = os.path.join(outpath, outname.replace('.fits','.wcs') )
-        # Make sure input data exists as file
-        if not os.path.exists(self.datain.filename) :
-            self.datain.save()
-        # Make command string
-        rawcommand = self.getarg('astrocmd') % (self.datain.filename, outname)
+        outbase = os.path.join(outpath, outname.replace('.fits','') )
+        outnewname = outbase + '.new'
+        outwcsname = outbase + '.wcs'
+        # Input for astrometry: the source table as xyls file or the image
+        inputtime = time.time()
+        xylsname = outbase + '.xyls'
+        nsources = self.writexyls(xylsname)
+        if nsources:
+            # Astrometry only writes the .wcs file (no .new image)
+            infile = xylsname
+            height, width = self.datain.image.shape[-2:]
+            inputoptions = ' --width %d --height %d --x-column X --y-column Y' % (width, height)
+            solvedext = '.wcs'
+            inputstring = '%s table (%d sources)' % (self.getarg('xylsource'), nsources)
+        else:
+            # Make sure input data exists as file
+            if not os.path.exists(self.datain.filename) :
+                self.datain.save()
+            infile = self.datain.filename
+            inputoptions = ''
+            solvedext = '.new'
+            inputstring = 'image'
+        inputtime = time.time() - inputtime
 
         # get estimated RA and DEC center values from the config file or input FITS header
         raopt = self.getarg('ra')
@@ -122,47 +273,77 @@ class StepAstrometryLocal(StepParent):
             except:
                 dec = ''
 
+        searchoptions = ''
         if (ra != '') and (dec != ''):
         # update command parameters to use these values
-            rawcommand = rawcommand + ' --ra %f --dec %f --radius %f' % (ra, dec, self.getarg('searchradius'))         
+            searchoptions = ' --ra %f --dec %f --radius %f' % (ra, dec, self.getarg('searchradius'))
         else:
             self.log.debug('FITS header missing RA/DEC -> searching entire sky')
 
         ### Run Astrometry:
-        #   This loop tries the downsample and param options until the fit is successful
-        #    need either --scale-low 0.5 --scale-high 2.0 --sort-column FLUX
-        #             or --guess-scale
+        starttime = time.time()
         downsamples = self.getarg('downsample')
         paramoptions = self.getarg('paramoptions')
-        for option in range(len(downsamples)*len(paramoptions)):
-        #for downsample in self.getarg('downsample'):
-            downsample = downsamples[option%len(downsamples)]
-            paramoption = paramoptions[option//len(downsamples)]
-            # Add options to command
-            command = rawcommand + ' --downsample %d' % downsample + ' ' + paramoption
-            optionstring = "Downsample=%s Paramopts=%s" % (downsample, paramoption[:10])
-            # Run the process - see note at the top of the file if using cron
-            process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
-                                       stderr=subprocess.STDOUT)
-            self.log.debug('running command = %s' % command)
-            # Wait for the process to be finished or timeout to be reached
-            timeout = time.time() + self.getarg('timeout')
-            while time.time() < timeout and process.poll() == None:
-                time.sleep(1)
-            poll = process.poll()
-            if poll == None:
-                process.kill()
-                time.sleep(1)
-            poll = process.poll()
-            self.log.debug('command returns %d' % poll)
-            if poll == 0 and os.path.exists(outnewname):
-                self.log.debug('output file valid -> astrometry successful')
-                break
-            else:             
-                self.log.debug('output file missing -> astrometry failed')
+        #   First try a cached solution for this target and setup as prior
+        solved = False
+        cache = None
+        if len(self.getarg('solvecache')):
+            cache = WCSCache(os.path.expandvars(self.getarg('solvecache')))
+            key = cachekey(self.datain.header, self.getarg('cachekeys'))
+            prior = None
+            if (ra != '') and (dec != ''):
+                prior = cache.lookup(key, ra, dec, self.getarg('cacheradius'))
+            if prior is not None:
+                self.log.debug('Found cached solution %.3f deg from field center' % prior['distance'])
+                downsample = downsamples[0]
+                optionstring = 'Cached prior (verify)'
+                returncode, output = self.solveprior(prior, infile, outname, inputoptions)
+                solved = returncode == 0 and os.path.exists(outbase + solvedext)
+                if solved:
+                    self.log.info('Solved with cached solution in %d seconds' % (time.time() - starttime))
+                else:
+                    self.log.debug('Verify with cached solution failed -> full search')
+            else:
+                self.log.debug('No cached solution for %s' % key)
+        #   Try the downsample and param options until the fit is successful
+        #    need either --scale-low 0.5 --scale-high 2.0 --sort-column FLUX
+        #             or --guess-scale
+        #   Each trial has its own output file names (trials can run concurrently)
+        #   Downsampling is only used for images
+        if not solved:
+            if nsources:
+                downsamples = [0]
+            trials = []
+            for option in range(len(downsamples)*len(paramoptions)):
+                downsample = downsamples[option%len(downsamples)]
+                paramoption = paramoptions[option//len(downsamples)]
+                trialname = outname.replace('.fits', '_%d.fits' % option)
+                trialbase = os.path.join(outpath, trialname.replace('.fits', ''))
+                # Add options to command
+                command = self.getarg('astrocmd') % (infile, trialname) + inputoptions + searchoptions
+                optionstring = "Paramopts=%s" % paramoption[:10]
+                if downsample:
+                    command += ' --downsample %d' % downsample
+                    optionstring = "Downsample=%s " % downsample + optionstring
+                command += ' ' + paramoption
+                trials.append((command, trialbase + solvedext, trialbase, downsample, optionstring))
+            success, output = self.solvetrials(trials, self.getarg('timeout'))
+            # Use the output files of the successful (or last) trial
+            option = len(trials) - 1 if success is None else success
+            outbase, downsample, optionstring = trials[option][2:]
+            outnewname = outbase + '.new'
+            outwcsname = outbase + '.wcs'
+            # Remove output files of other trials (in case they finished too)
+            if self.getarg('delete_temp'):
+                for trial in trials[:option] + trials[option+1:]:
+                    for name in [trial[2] + '.new', trial[2] + '.wcs']:
+                        if os.path.exists(name):
+                            os.remove(name)
+        solvetime = time.time() - starttime
+        self.log.info('Timing: input from %s %.2f seconds, astrometry %.2f seconds' %
+                      (inputstring, inputtime, solvetime))
         # Print the output from astrometry (cut if necessary)
         if self.getarg('verbose'):
-            output = process.stdout.read().decode()
             if len(output) > 1000:
                 outlines = output.split('\n')
                 output = outlines[:10]+['...','...']+outlines[-7:]
@@ -173,19 +354,27 @@ class StepAstrometryLocal(StepParent):
         # Read output file
         self.dataout = self.datain.copy()
         tempobj = DataFits(config=self.config)
-        self.log.debug('Opening astrometry.net output file %s' % outnewname)
+        self.log.debug('Opening astrometry.net output file %s' % (outbase + solvedext))
         try:
-            tempobj.load(outnewname)
-            self.dataout.header = tempobj.header
-            self.dataout.image = tempobj.image
-            self.dataout.filename = self.datain.filename
+            if nsources:
+                # Solved from a table: add the WCS to the header
+                w = wcs.WCS(fits.getheader(outwcsname))
+                self.dataout.header.update(w.to_header(relax=True))
+            else:
+                tempobj.load(outnewname)
+                self.dataout.header = tempobj.header
+                self.dataout.image = tempobj.image
+                self.dataout.filename = self.datain.filename
         except Exception as error:
             self.log.error("Unable to open astrometry. output file = %s"
                            % outname)
             raise error
         self.log.debug('Successful parameter options = %s' % optionstring)
         # Add history message
-        histmsg = 'Astrometry.Net: At downsample = %d, search took %d seconds' % (downsample, time.time() - timeout + 300)
+        if nsources:
+            histmsg = 'Astrometry.Net: From %s, search took %d seconds' % (inputstring, solvetime)
+        else:
+            histmsg = 'Astrometry.Net: At downsample = %d, search took %d seconds' % (downsample, solvetime)
         self.dataout.setheadval('HISTORY', histmsg)
         # Add RA from astrometry
         w = wcs.WCS(self.dataout.header)
@@ -199,10 +388,14 @@ class StepAstrometryLocal(StepParent):
         self.dataout.header['RA'] = Angle(ra,  u.deg).to_string(unit=u.hour, sep=':')
         self.dataout.header['Dec']= Angle(dec, u.deg).to_string(sep=':')
         self.dataout.setheadval('HISTORY', 'Astrometry: Paramopts = ' + optionstring)
+        # Store the solution in the cache
+        if cache is not None:
+            cache.store(key, float(ra), float(dec), w.to_header(relax=True))
         # Delete temporary files
         if self.getarg('delete_temp'):
-            os.remove(outnewname)
-            os.remove(outwcsname)
+            for name in [outnewname, outwcsname, xylsname]:
+                if os.path.exists(name):
+                    os.remove(name)
         self.log.debug('Run: Done')
     
 if __name__ == '__main__':
@@ -218,6 +411,16 @@ if __name__ == '__main__':
     StepAstrometryLocal().execute()
 
 """ === History ===
+2026-10-18 agent: - Added xylsource option to solve from the SEP source table
+                  (written as xyls file) instead of the image. The image
+                  is not saved and astrometry.net skips source detection.
+                - Log timing of input and astrometry
+2026-10-18 agent: - Added concurrent option to run several downsample /
+                  paramoptions trials at the same time, each trial has
+                  its own output files. Processes are waited for instead
+                  of polled every second.
+2026-10-18 agent: - Added cache of WCS solutions (stonetools.wcscache), cached
+                  solutions are verified before running a full search
 2018-10-12 MGB: - Add code to try different --downsample factors
                 - Add timeout for running astrometry.net
                 - Renamed StepAstrometry from StepAstrometrica
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+""" PIPE STEP ASTROMETRYWEB ASYNC - Version 1.0.0
+
+    This pipe step uploads the source tables (or images) of all frames
+    of a run to the website Astrometry.net and updates the WCS
+    information of the frames as the solutions arrive.
+
+    Unlike StepAstrometryWeb, which waits for the solution of each frame
+    before uploading the next, all frames are uploaded first, then the
+    status of all jobs is polled at the same time (with a pool of worker
+    threads) until all frames are solved, failed or the timeout is
+    reached. Frames without solution are passed on unchanged.
+
+    Errors are handled for each frame: a frame whose upload fails is
+    passed on unchanged, a failed status request (i.e. a connection
+    error) is retried at the next poll up to pollretries times in a row.
+
+    An API key must be specified in the config file or as a parameter
+    for the upload to work. The server can be changed with apiurl (i.e.
+    to a local astrometry.net server or a mock server for tests, see
+    Developments/stepastrometryweb).
+
+    @author: agent
+"""
+
+import os # os library
+import time # time library
+import logging # logging object library
+import tempfile # temporary file library
+import numpy as np # numpy library
+import requests # http request library (for exceptions)
+from concurrent.futures import ThreadPoolExecutor # thread pool
+from astropy import wcs # to get WCS coordinates
+from astropy.io import fits # to write source lists
+from astropy.coordinates import Angle
+import astropy.units as u
+from darepype.drp import StepMOParent # pipe step parent object
+from stonetools.novaclient import NovaClient # astrometry.net web API client
+
+class StepAstrometryWebAsync(StepMOParent):
+    """ Stone Edge Pipeline Step Astrometry Web Async Object
+        The object is callable. It requires a valid configuration input
+        (file or object) when it runs.
+    """
+    stepver = '0.1' # pipe step version
+
+    def setup(self):
+        """ ### Names and Parameters need to be Set Here ###
+            Sets the internal names for the function and for saved files.
+            Defines the input parameters for the current pipe step.
+            Setup() is called at the end of __init__
+            The parameters are stored in a list containing the following
+            information:
+            - name: The name for the parameter. This name is used when
+                    calling the pipe step from command line or python shell.
+                    It is also used to identify the parameter in the pipeline
+                    configuration file.
+            - default: A default value for the parameter. If nothing, set
+                       '' for strings, 0 for integers and 0.0 for floats
+            - help: A short description of the parameter.
+        """
+        ### Set Names
+        # Name of the pipeline reduction step
+        self.name='astrometrywebasync'
+        # Shortcut for pipeline reduction step and identifier for
+        # saved file names.
+        self.procname = 'WCS'
+        # Set Logger for this pipe step
+        self.log = logging.getLogger('pipe.step.%s' % self.name)
+        ### Set Parameter list
+        # Clear Parameter list
+        self.paramlist = []
+        # Append parameters
+        self.paramlist.append(['timeout', 900,
+                               'Timeout for the solution of a frame after upload (seconds)'])
+        self.paramlist.append(['pollinterval', 5.,
+                               'Time between status requests of the jobs (seconds)'])
+        self.paramlist.append(['pollretries', 5,
+                               'Number of failed status requests in a row before a frame is dropped'])
+        self.paramlist.append(['workers', 8,
+                               'Number of concurrent uploads and status requests'])
+        self.paramlist.append(['radius', 5.,
+                               'Search within this many degrees of the center RA and Dec'])
+        self.paramlist.append(['scale_lower', 0.5,
+                               'lower scale'])
+        self.paramlist.append(['scale_upper', 2.,
+                               'upper scale'])
+        self.paramlist.append(['scale_units', 'arcsecperpix',
+                               'Image plate scale units'])
+        self.paramlist.append(['api_key', 'XXXXXXXX',
+                               'API key used for interfacing with Astrometry.net'])
+        self.paramlist.append(['apiurl', 'http://nova.astrometry.net/',
+                               'URL of the Astrometry.net server'])
+        self.paramlist.append(['table_name', 'HTS',
+                               'Name of table that should be used when solving, ' +
+                               'the image is uploaded if the table is missing'])
+        # confirm end of setup
+        self.log.debug('Setup: done')
+
+    def submit(self, client, data):
+        """ Uploads the source table (or the image) of data, returns the
+            submission id or None if the upload fails.
+        """
+        try:
+            return self.upload(client, data)
+        except Exception as error:
+            self.log.error('Upload of %s failed: %s' % (data.filename, repr(error)))
+            return None
+
+    def upload(self, client, data):
+        """ Uploads the source table (or the image) of data, returns the
+            submission id.
+        """
+        height, width = data.image.shape[-2:]
+        args = {'publicly_visible': 'n', 'allow_modifications': 'n',
+                'allow_commercial_use': 'n', 'scale_type': 'ul',
+                'scale_lower': self.getarg('scale_lower'),
+                'scale_upper': self.getarg('scale_upper'),
+                'scale_units': self.getarg('scale_units')}
+        try:
+            args['center_ra'] = Angle(data.getheadval('RA'), unit=u.hour).degree
+            args['center_dec'] = Angle(data.getheadval('DEC'), unit=u.deg).degree
+            args['radius'] = self.getarg('radius')
+        except Exception:
+            self.log.debug('No RA/Dec for %s -> searching entire sky' % data.filename)
+        tablename = self.getarg('table_name')
+        if len(tablename) and tablename.upper() in data.tabnames:
+            # Source list: X, Y (FITS convention) brightest first
+            table = data.tableget(tablename)
+            order = np.argsort(-np.asarray(table['Uncalibrated Flux']), kind='stable')
+            cols = [fits.Column(name='X', format='D', array=np.asarray(table['X'])[order] + 1.),
+                    fits.Column(name='Y', format='D', array=np.asarray(table['Y'])[order] + 1.)]
+            args['image_width'], args['image_height'] = width, height
+            with tempfile.TemporaryDirectory() as folder:
+                filename = os.path.join(folder, 'sources.xyls')
+                fits.BinTableHDU.from_columns(cols).writeto(filename)
+                return client.upload(filename, **args)
+        # Image: make sure input data exists as file
+        if not os.path.exists(data.filename):
+            data.save()
+        return client.upload(data.filename, **args)
+
+    def poll(self, client, job):
+        """ Updates the job dictionary (subid, jobid, status, header,
+            errors) of a frame: gets the job id, its status and for a
+            successful job the WCS header. Failed requests are counted in
+            errors, the status is set to failure after more than
+            pollretries failed requests in a row or for an error answer
+            of the server. Returns the job dictionary.
+        """
+        try:
+            if job['jobid'] is None:
+                jobids = client.jobs(job['subid'])
+                if not len(jobids):
+                    job['errors'] = 0
+                    return job
+                job['jobid'] = jobids[0]
+            status = client.jobstatus(job['jobid'])
+            if status == 'success':
+                job['header'] = client.wcsheader(job['jobid'])
+            job['status'] = status
+            job['errors'] = 0
+        except requests.RequestException as error:
+            job['errors'] += 1
+            self.log.warning('Status request for submission %s failed (%d in a row): %s' %
+                             (job['subid'], job['errors'], repr(error)))
+            if job['errors'] > self.getarg('pollretries'):
+                job['status'] = 'failure'
+        except Exception as error:
+            self.log.warning('Status request for submission %s failed: %s' %
+                             (job['subid'], repr(error)))
+            job['status'] = 'failure'
+        return job
+
+    def applywcs(self, data, header):
+        """ Returns a copy of data with the WCS from header and RA/Dec
+            of the image center (as in StepAstrometryWeb).
+        """
+        data = data.copy()
+        data.header.update(wcs.WCS(header).to_header(relax=True))
+        w = wcs.WCS(data.header)
+        n2, n1 = [float(n / 2) for n in data.image.shape[-2:]]
+        ra, dec = w.all_pix2world(n1, n2, 1)
+        data.header['RA'] = Angle(ra,  u.deg).to_string(unit=u.hour, sep=':')
+        data.header['Dec'] = Angle(dec, u.deg).to_string(sep=':')
+        return data
+
+    def run(self):
+        """ Runs the data reduction algorithm. The self.datain is run
+            through the code, the result is in self.dataout.
+        """
+        starttime = time.time()
+        self.dataout = list(self.datain)
+        client = NovaClient(self.getarg('api_key'), self.getarg('apiurl'))
+        client.login()
+        with ThreadPoolExecutor(max_workers=self.getarg('workers')) as pool:
+            # Upload all frames
+            subids = pool.map(lambda data: self.submit(client, data), self.datain)
+            pending = {}
+            for index, subid in enumerate(subids):
+                if subid is None:
+                    continue
+                pending[index] = {'subid': subid, 'jobid': None, 'status': '',
+                                  'header': None, 'errors': 0, 'start': time.time()}
+            self.log.info('Uploaded %d of %d frames in %.1f seconds' %
+                          (len(pending), len(self.datain), time.time() - starttime))
+            # Poll the jobs and apply solutions as they arrive
+            while len(pending):
+                time.sleep(self.getarg('pollinterval'))
+                indices = list(pending)
+                for index, job in zip(indices, pool.map(lambda i: self.poll(client, pending[i]),
+                                                        indices)):
+                    filename = self.datain[index].filename
+                    if job['status'] == 'success':
+                        try:
+                            data = self.applywcs(self.datain[index], job['header'])
+                        except Exception as error:
+                            self.log.error('Invalid WCS solution for %s: %s' %
+                                           (filename, repr(error)))
+                            del pending[index]
+                            continue
+                        data.setheadval('HISTORY',
+                            'Astrometry.net: job %s solved in %d seconds' %
+                            (job['jobid'], time.time() - job['start']))
+                        self.dataout[index] = data
+                        self.log.info('Solved %s (job %s)' % (filename, job['jobid']))
+                    elif job['status'] == 'failure':
+                        self.log.error('Failed to find WCS solution for %s' % filename)
+                    elif time.time() - job['start'] > self.getarg('timeout'):
+                        self.log.error('Timeout waiting for WCS solution for %s' % filename)
+                    else:
+                        continue
+                    del pending[index]
+        self.log.info('Astrometry for %d frames took %.1f seconds' %
+                      (len(self.datain), time.time() - starttime))
+        self.log.debug('Run: Done')
+
+if __name__ == '__main__':
+    """ Main function to run the pipe step from command line on a file.
+        Command:
+          python stepparent.py input.fits -arg1 -arg2 . . .
+        Standard arguments:
+          --config=ConfigFilePathName.txt : name of the configuration file
+          -t, --test : runs the functionality test i.e. pipestep.test()
+          --loglevel=LEVEL : configures the logging output for a particular level
+          -h, --help : Returns a list of
+    """
+    StepAstrometryWebAsync().execute()
+
+""" === History ===
+2026-10-18 First version: upload all frames, poll the jobs concurrently
+2026-10-18 Errors of uploads and status requests only drop the affected
+           frame, status requests are retried (pollretries)
+"""
@@ -5,7 +5,8 @@
     This module defines the pipeline step that corrects raw image files by subtracting
     a bias image, subtracting a dark-charge image, and dividing by a flat image.
     
-    It uses StepLoadAux functions to call the following files:
+    It uses StepLoadAux functions (with the calibration cache in
+    stonetools.calcache) to call the following files:
         - masterbias: a median or mean average of zero-exposure dark images
         - masterdark : the difference between a median or mean average of  dark images
             with exposure similar to the exposure of the raw image and a masterbias image
@@ -25,9 +26,9 @@ import logging # logging object library
 from astropy.io import fits #package to recognize FITS files
 from darepype.drp import DataFits # pipeline data object class
 from darepype.drp import StepParent # pipestep stepparent object class
-from darepype.tools.steploadaux import StepLoadAux # pipestep steploadaux object class
+from stonetools.calcache import calcache, StepLoadAuxCache # calibration cache
 
-class StepBiasDarkFlat(StepLoadAux, StepParent):
+class StepBiasDarkFlat(StepLoadAuxCache, StepParent):
     """ Pipeline Step Object to calibrate Bias/Dark/Flat files
     """
     
@@ -95,6 +96,11 @@ class StepBiasDarkFlat(StepLoadAux, StepParent):
         self.paramlist.append(['intermediate', False,
             'Set to T to include the result of bias, dark, and flat'
             'subtraction'])
+        self.paramlist.append(['fused', False,
+            'Set to T to apply bias, dark and flat in one float32 pass '
+            'with precomputed masters (ignored if intermediate = T)'])
+        self.paramlist.append(['blockrows', 256,
+            'Number of image rows processed at a time in fused mode'])
         # Set root names for loading parameters with StepLoadAux.
         self.loadauxsetup('bias')
         self.loadauxsetup('dark')
@@ -122,9 +128,8 @@ class StepBiasDarkFlat(StepLoadAux, StepParent):
             self.log.error('Bias calibration image not found.')
             raise RuntimeError('No bias file loaded')
         
-        # Load bias object
-        bias = DataFits(name)
-        bias.load()
+        # Load bias object (from the calibration cache, don't change it)
+        bias = self.loadauxdata(name)
         self.bias = bias.imageget()
 
         # Finish up
@@ -149,8 +154,7 @@ class StepBiasDarkFlat(StepLoadAux, StepParent):
             raise RuntimeError('No dark file loaded')
         
         # Load dark data.
-        dark = DataFits(name)
-        dark.load()
+        dark = self.loadauxdata(name)
         self.dark = dark.imageget()
 
         # Get the dark exposure time from the header of the dark object
@@ -177,8 +181,7 @@ class StepBiasDarkFlat(StepLoadAux, StepParent):
             raise RuntimeError('No flat file loaded')
         
         # Load flat data.
-        flat = DataFits(name)
-        flat.load()
+        flat = self.loadauxdata(name)
         self.flat = flat.imageget()
 
         # Finish up
@@ -250,6 +253,51 @@ class StepBiasDarkFlat(StepLoadAux, StepParent):
         self.log.debug('Corrected flat.')
         return flat_corrected
 
+    def fusedmasters(self):
+        """ Returns the precomputed masters for the fused calibration:
+            (bias, dark rate, inverse normalized flat) as float32 arrays.
+            They are computed once per set of master files and kept in
+            the calibration cache.
+        """
+        def makemasters(biasname, darkname, flatname):
+            self.log.debug('FusedMasters: Computing for %s, %s, %s' %
+                           (biasname, darkname, flatname))
+            bias = np.asarray(self.bias, dtype = np.float32)
+            darkrate = np.asarray(self.dark / self.dark_exp_length, dtype = np.float32)
+            with np.errstate(divide = 'ignore'):
+                invflat = np.asarray(np.median(self.flat) / self.flat, dtype = np.float32)
+            return bias, darkrate, invflat
+        return calcache.derive('bdf_fused', [self.biasname, self.darkname, self.flatname],
+                               makemasters)
+
+    def fused_correct(self, image, img_exposure):
+        """
+        Correct the image with bias, dark and flat in a single pass:
+        (image - bias - img_exposure * darkrate) * invflat
+        The image is processed in blocks of rows in float32 to avoid full
+        frame temporary arrays.
+        Arguments:
+        - image: numpy.ndarray, raw image to be corrected.
+        - img_exposure:  double, exposure time of raw image
+        Returns: numpy.ndarray (float32), corrected image.
+        """
+        self.log.debug('Fused correction...')
+        bias, darkrate, invflat = self.fusedmasters()
+        result = np.array(image, dtype = np.float32)
+        exposure = np.float32(img_exposure)
+        blockrows = max(1, self.getarg('blockrows'))
+        temp = np.empty((blockrows,) + result.shape[1:], dtype = np.float32)
+        for row in range(0, result.shape[0], blockrows):
+            block = slice(row, row + blockrows)
+            out = result[block]
+            tmp = temp[:len(out)]
+            np.multiply(darkrate[block], exposure, out = tmp)
+            np.add(tmp, bias[block], out = tmp)
+            np.subtract(out, tmp, out = out)
+            np.multiply(out, invflat[block], out = out)
+        self.log.debug('Fused correction done.')
+        return result
+
     def run(self):
         """ Runs the correction algorithm. The corrected data is
             returned in self.dataout
@@ -293,9 +341,21 @@ class StepBiasDarkFlat(StepLoadAux, StepParent):
         # to enable saving of intermediate steps as additional HDUs
         save_intermediate_steps = self.getarg('intermediate')
         
-        # Get the image to be corrected, convert to float, and find exposure time.        
-        image = self.datain.image * 1.0
+        # Find exposure time.
         image_exp = self.datain.getheadval('EXPTIME')
+
+        # Fused mode: correct in one pass with the precomputed masters
+        if self.getarg('fused') and not save_intermediate_steps:
+            self.dataout = self.datain.copy()
+            self.dataout.image = self.fused_correct(self.datain.image, image_exp)
+            self.dataout.setheadval('HISTORY', 'BIAS: %s' % self.biasname)
+            self.dataout.setheadval('HISTORY', 'DARK: %s' % self.darkname)
+            self.dataout.setheadval('HISTORY', 'FLAT: %s' % self.flatname)
+            self.dataout.filename = self.datain.filename
+            return
+
+        # Get the image to be corrected, convert to float.
+        image = self.datain.image * 1.0
         
         # Create self.dataout by copying self.datain. This loads the output object
         # with the config and header of the input file and a placeholder image
@@ -366,6 +426,10 @@ if __name__ == '__main__':
     StepBiasDarkFlat().execute()
     
 '''HISTORY:
+2026-10-18 - Added fused mode: one float32 pass with precomputed bias, dark rate and
+             inverse flat
+2026-10-18 - Load master bias/dark/flat through the process-wide calibration cache
+             (stonetools.calcache), shared by all files and objects
 2020-12-04 - Reintroduce the normalized flat code to maintain continuity with prior versions
              of the BDF step. Reorganized the order of saving the HDUs  - Lorenzo Orders
 2020-09-22 - Eliminate unnecesary code and update documentation - Al Harper and Lorenzo Orders
@@ -22,7 +22,6 @@ import scipy # scipy library
 import string # string library
 import logging # logging object library
 import subprocess # running a subprocess library
-import requests # http request library
 import astropy.table # Read astropy tables
 from astropy.io import fits
 from astropy.io import ascii
@@ -35,6 +34,7 @@ matplotlib.use('Agg') # Set pixel image
 import pylab as plt # pylab library for plotting
 from lmfit import minimize, Parameters # For brightness correction fit
 from darepype.drp import StepParent # pipestep stepparent object
+from stonetools.refcat import getcatalog # reference catalog with tile cache
 
 class StepFluxCal(StepParent):
     """ Pipeline Step Object to calibrate Bias/Dark/Flat files
@@ -73,6 +73,15 @@ class StepFluxCal(StepParent):
                                'Mapping from telescope filter names to SDSS filter names. ' +
                                'Data from multiple filters can be calibrated using the same band. ' +
                                'Example: "telg=g|telr=r|telclear=r"'])
+        self.paramlist.append(['catsource', 'gsc',
+                               'Reference catalog: gsc for the Guide Star Catalog web service ' +
+                               'or filepathname of a local catalog file'])
+        self.paramlist.append(['catfolder', '',
+                               'Folder for cached catalog tiles (default = \'\' i.e. memory only)'])
+        self.paramlist.append(['cattilesize', 1.0,
+                               'Size (degrees) of the cached catalog tiles'])
+        self.paramlist.append(['catradius', 0.5,
+                               'Radius (degrees) around the image center for reference stars'])
         self.paramlist.append(['zeropercent', 30.0,
                                'Percentile for BZERO value'])
         self.paramlist.append(['fitplot',False,
@@ -107,13 +116,16 @@ class StepFluxCal(StepParent):
         dec_cent = ' '.join([str(s) for s in dec_center])
         center_coordinates = SkyCoord(ra_cent + ' ' + dec_cent, unit=(u.hourangle, u.deg) )
         self.log.debug('Using RA/Dec = %s / %s' % (center_coordinates.ra, center_coordinates.dec) )
-        # Querry guide star catalog2 with center coordinates
-        gsc2_query = 'http://gsss.stsci.edu/webservices/vo/CatalogSearch.aspx?'
-        gsc2_query += 'RA='+str(center_coordinates.ra.value)
-        gsc2_query += '&DEC='+str(center_coordinates.dec.value)
-        gsc2_query += '&DSN=+&FORMAT=CSV&CAT=GSC241&SR=0.5&'
-        self.log.debug('Running URL = %s' % gsc2_query)
-        gsc2_result = requests.get(gsc2_query)
+        # only select objects less than 0.025 away in distance, get distance value
+        dist_value = 1*0.76*binning/3600. #Maximum distance is 1 pixel
+        # Query guide star catalog2 with center coordinates (from local tile cache)
+        #   and match the sources (nearest source for each guide star, d2d in
+        #   degrees) with the KD-trees of the catalog tiles
+        refcat = getcatalog(self.getarg('catsource'), os.path.expandvars(self.getarg('catfolder')),
+                            self.getarg('cattilesize'))
+        query_table, idx, d2d = refcat.cone(center_coordinates.ra.value, center_coordinates.dec.value,
+                                            self.getarg('catradius'), ra, dec,
+                                            dist_value)
         # Get data from result
         filter_map = self.getarg('filtermap').split('|')
         filter_name = filter_tel = self.datain.getheadval('FILTER')
@@ -125,48 +137,44 @@ class StepFluxCal(StepParent):
                 except:
                     self.log.error("Badly formatted filter mapping. No '=' after %s"
                                    % filter_tel)
-        query_table = astropy.io.ascii.read(gsc2_result.text)
         table_filter = 'SDSS'+filter_name+'Mag'
         table_filter_err = 'SDSS'+filter_name+'MagErr'
         GSC_RA = query_table['ra'][(query_table[table_filter]<22) & (query_table[table_filter]>0)]
         GSC_DEC = query_table['dec'][(query_table[table_filter]<22) & (query_table[table_filter]>0)]
         GSC_Mag = query_table[table_filter][(query_table[table_filter]<22) & (query_table[table_filter]>0)]
         GSC_MagErr = query_table[table_filter_err][(query_table[table_filter]<22) & (query_table[table_filter]>0)]
+        idx = idx[(query_table[table_filter]<22) & (query_table[table_filter]>0)]
+        d2d = d2d[(query_table[table_filter]<22) & (query_table[table_filter]>0)]
         self.log.debug('Received %d entries from Guide Star Catalog' % len(GSC_RA))
-        ### Mach Guide Star Catalog data with data from Source Extractor
-        # Do the matching
-        seo_radec = SkyCoord(ra = ra*u.deg, dec = dec*u.deg)
-        GSC_radec = SkyCoord(ra=GSC_RA*u.deg, dec=GSC_DEC*u.deg)
-        idx, d2d, d3d = GSC_radec.match_to_catalog_sky(seo_radec)
-        # only select objects less than 0.025 away in distance, get distance value
-        dist_value = 1*0.76*binning/3600. #Maximum distance is 1 pixel
-        mask = d2d.value<dist_value
+        mask = d2d<dist_value
         if(np.sum(mask) < 2):
             self.log.warn('Only %d sources match between image and guide star catalog, fit may not work' %
                           np.sum(mask) )
         self.log.debug('Distance_Value = %f, Min(distances) = %f, Mask length = %d' %
-                       ( dist_value, np.min(d2d.value), np.sum(mask) ) )
+                       ( dist_value, np.min(d2d), np.sum(mask) ) )
         ### Calculate the fit correction between the guide star and the extracted values
         # Make lambda function to be minimized
         # The fit finds m_ml and b_ml where
         #     seo_Mag = b_ml + m_ml * GSC_Mag
         nll = lambda *args: -residual(*args)
+        # Get magnitudes of the matched sources
+        match_Mag = seo_Mag[idx]
         # Get errors
         eps_data = np.sqrt(GSC_MagErr**2+seo_MagErr[idx]**2)
         # Make estimate for intercept to give as initial guess
-        b_ml0 = np.median(seo_Mag[idx][mask]-GSC_Mag[mask])
+        b_ml0 = np.median(match_Mag[mask]-GSC_Mag[mask])
         self.log.debug('Offset guess is %f mag' % b_ml0)
         # Calculate distance from that guess and get StdDev of distances
-        guessdistances = np.abs( b_ml0 - ( seo_Mag[idx] - GSC_Mag ) )
+        guessdistances = np.abs( b_ml0 - ( match_Mag - GSC_Mag ) )
         guessdistmed = np.median(guessdistances[mask])
         # Update mask to ignore values with large STDEVS
-        mask = np.logical_and( d2d.value < dist_value, guessdistances < 5 * guessdistmed )
+        mask = np.logical_and( d2d < dist_value, guessdistances < 5 * guessdistmed )
         self.log.debug('Median of distance to guess = %f, Mask length = %d' %
                        ( guessdistmed, np.sum(mask) ) )
         # Solve linear equation
         result = scipy.optimize.minimize(nll, [1, b_ml0],
                                          args=(GSC_Mag[mask],
-                                               seo_Mag[idx][mask],
+                                               match_Mag[mask],
                                                eps_data[mask]))
         m_ml, b_ml = result["x"]
         self.log.info('Fitted offset is %f mag, fitted slope is %f' % (b_ml, m_ml) )
@@ -185,7 +193,7 @@ class StepFluxCal(StepParent):
         cols.append(fits.Column(name='GSC_Mag', format='D',
                                 array=GSC_Mag[mask], unit='magnitude'))
         cols.append(fits.Column(name='Img_Mag', format='D',
-                                array=seo_Mag[idx][mask],
+                                array=match_Mag[mask],
                                 unit='magnitude'))
         cols.append(fits.Column(name='Error', format='D', array=eps_data[mask],
                                 unit='magnitude'))
@@ -237,11 +245,11 @@ class StepFluxCal(StepParent):
             plt.plot(GSC_Mag[mask],m_ml*GSC_Mag[mask]+b_ml)
             plt.plot(GSC_Mag[mask],GSC_Mag[mask]+b_ml0)
             # Plot the datapoints
-            plt.errorbar(GSC_Mag[d2d.value<dist_value],seo_Mag[idx][d2d.value<dist_value],
-                         yerr=np.sqrt(eps_data[d2d.value<dist_value]**2),fmt='o',linestyle='none')
-            plt.errorbar(GSC_Mag[mask],seo_Mag[idx][mask],
+            plt.errorbar(GSC_Mag[d2d<dist_value],match_Mag[d2d<dist_value],
+                         yerr=np.sqrt(eps_data[d2d<dist_value]**2),fmt='o',linestyle='none')
+            plt.errorbar(GSC_Mag[mask],match_Mag[mask],
                          yerr=np.sqrt(eps_data[mask]**2),fmt='o',linestyle='none')
-            #plt.plot(GSC_Mag[d2d.value<dist_value],m_ml*GSC_Mag[d2d.value<dist_value]+zeropoint_fit[1])
+            #plt.plot(GSC_Mag[d2d<dist_value],m_ml*GSC_Mag[d2d<dist_value]+zeropoint_fit[1])
             plt.legend(['LM-fit','Fit-Guess','GuessDistMed Range','d<distval Data','Good Data'])
             plt.ylabel('Source extrator magnitude')
             plt.xlabel('Star catalog magnitude')
@@ -276,4 +284,7 @@ if __name__ == '__main__':
 
 '''HISTORY:
 2018-09-019 - Started based on Amanda's code. - Marc Berthoud
+2026-10-18 - Reference stars from tiled local catalog cache (stonetools.refcat) - agent
+2026-10-18 - Cross match with KD-tree (stonetools.crossmatch) - agent
+2026-10-18 - Cross match with KD-trees of the reference catalog tiles - agent
 '''
@@ -38,13 +38,13 @@
 
 from darepype.drp import DataFits # pipeline data object class
 from darepype.drp.stepmiparent import StepMIParent # pipestep Multi-Input parent
-from darepype.tools.steploadaux import StepLoadAux # pipestep steploadaux object class
+from stonetools.calcache import StepLoadAuxCache # steploadaux with calibration cache and master index
 from astropy.convolution import Gaussian2DKernel, interpolate_replace_nans # For masking/replacing
 import scipy.ndimage as nd
 import numpy as np
 import logging
 
-class StepHdr(StepLoadAux, StepMIParent):
+class StepHdr(StepLoadAuxCache, StepMIParent):
     """ Pipeline Step Object to calibrate Flatfield High Dynamic Range files
     """
     
@@ -306,5 +306,6 @@ if __name__ == '__main__':
     StepHdr().execute()
 
 '''HISTORY:
+2026-10-18 - Use StepLoadAuxCache (calibration cache and master index) - agent
 2022-1-5 - Set up file, most code copied from StepBiasDarkFlat - Marc Berthoud
 '''
\ No newline at end of file
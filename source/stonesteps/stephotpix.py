@@ -3,6 +3,18 @@
 
     Template for StepHotPix in pipeline.
 
+    Hot pixels are replaced by the median of their neighbours. They are
+    found in two ways:
+    - Bad pixel map: Pixels with a high dark rate in the master dark
+      matching the data (camera, binning and date, found with StepLoadAux).
+      The map is made once for each master dark and kept in memory, it's
+      saved as *_BPM.fits file in badpixfolder (if set) for later runs.
+      Instead of searching a dark, a bad pixel map file can be given in
+      hotpixfile.
+    - Frame filter: Pixels that differ from the median filtered image by
+      more than hotsigma standard deviations (optional if a bad pixel map
+      is used).
+
     This module defines the HAWC pipeline step parent object. Pipe steps are
     the modules responsible for all HAWC data reduction. They are called by
     the pipeline and work with pipedata objects. All pipe step objects are
@@ -16,10 +28,15 @@ import os # os library
 import numpy # numpy library
 import scipy.ndimage #scipy sublibrary
 import logging # logging object library
+from astropy.io import fits # to read and write bad pixel maps
 from scipy.ndimage import median_filter #Used to filter hot pixels
 from darepype.drp import StepParent # pipe step parent object
+from stonetools.calcache import calcache, StepLoadAuxCache # steploadaux with calibration cache
+
+# Offsets of the neighbour pixels used to replace bad pixels
+neighbours = [(-1,-1), (-1,0), (-1,1), (0,-1), (0,1), (1,-1), (1,0), (1,1)]
 
-class StepHotpix(StepParent):
+class StepHotpix(StepLoadAuxCache, StepParent):
     """ HAWC Pipeline Step Parent Object
         The object is callable. It requires a valid configuration input
         (file or object) when it runs.
@@ -64,8 +81,102 @@ class StepHotpix(StepParent):
         self.paramlist = []
         # Append parameters
         self.paramlist.append(['hotpixfile', 'search',
-            'Filename for clean file or "search" for searching ' +
-            'file in cleanfolder (default = search)'])
+            'Filename for bad pixel map, "search" to make it from the ' +
+            'master dark found with darkfile or "none" to only use the ' +
+            'frame filter (default = search)'])
+        self.paramlist.append(['badpixfolder', '',
+            'Folder to save and reuse bad pixel maps made from master darks ' +
+            "(default = '' i.e. maps are not saved)"])
+        self.paramlist.append(['badsigma', 10.0,
+            'Pixels with a dark rate more than badsigma robust standard ' +
+            'deviations above the median are bad'])
+        self.paramlist.append(['framefilter', False,
+            'Set to T to also search hot pixels in each frame with a median ' +
+            'filter (always used if there is no bad pixel map)'])
+        self.paramlist.append(['hotsigma', 10.0,
+            'Frame filter: pixels that differ from the median filtered ' +
+            'image by more than hotsigma standard deviations are hot'])
+        # Get parameters for StepLoadAux, replace auxfile with darkfile
+        self.loadauxsetup('dark')
+
+    def makebadpix(self, darkname):
+        """ Returns the bad pixel map (boolean array, True for bad pixels)
+            for the master dark darkname. The map is loaded from
+            badpixfolder if it's there and newer than the dark, else it's
+            made from the dark rate (and saved if badpixfolder is set).
+        """
+        badsigma = self.getarg('badsigma')
+        badpixfolder = os.path.expandvars(self.getarg('badpixfolder'))
+        bpmname = ''
+        if len(badpixfolder):
+            bpmname = os.path.split(darkname)[1].split('.fits')[0] + '_BPM.fits'
+            bpmname = os.path.join(badpixfolder, bpmname)
+            # Use saved map if it's up to date
+            if (os.path.exists(bpmname) and
+                os.path.getmtime(bpmname) >= os.path.getmtime(darkname)):
+                bpmhead = fits.getheader(bpmname)
+                if bpmhead.get('BADSIGMA') == badsigma:
+                    self.log.debug('MakeBadPix: Using %s' % bpmname)
+                    return fits.getdata(bpmname) > 0
+        # Make map from the dark rate
+        dark = calcache.load(darkname, self.config)
+        darkrate = dark.image / float(dark.getheadval('EXPTIME'))
+        median = numpy.nanmedian(darkrate)
+        sigma = 1.4826 * numpy.nanmedian(numpy.abs(darkrate - median))
+        with numpy.errstate(invalid = 'ignore'):
+            badpix = (darkrate > median + badsigma * sigma) | ~numpy.isfinite(darkrate)
+        self.log.info('MakeBadPix: %d bad pixels in %s' % (badpix.sum(), darkname))
+        # Save the map
+        if len(bpmname):
+            header = fits.Header()
+            for key in ['XBIN', 'YBIN', 'DATE-OBS', 'INSTRUME']:
+                if key in dark.header:
+                    header[key] = dark.header[key]
+            header['DARKFILE'] = (os.path.split(darkname)[1], 'Master dark used for map')
+            header['BADSIGMA'] = (badsigma, 'Threshold for bad pixels')
+            os.makedirs(badpixfolder, exist_ok = True)
+            fits.writeto(bpmname, badpix.astype(numpy.uint8), header, overwrite = True)
+            self.log.info('MakeBadPix: Saved %s' % bpmname)
+        return badpix
+
+    def badpixindex(self, badpix):
+        """ Returns the flat indices of the bad pixels, the flat indices
+            of their neighbours, a flag array for the neighbours which
+            can be used (inside the image and not bad) and the image shape.
+        """
+        ys, xs = numpy.nonzero(badpix)
+        ny = numpy.array([ys + dy for dy, dx in neighbours]).T
+        nx = numpy.array([xs + dx for dy, dx in neighbours]).T
+        valid = (ny >= 0) & (ny < badpix.shape[0]) & (nx >= 0) & (nx < badpix.shape[1])
+        ny = numpy.clip(ny, 0, badpix.shape[0] - 1)
+        nx = numpy.clip(nx, 0, badpix.shape[1] - 1)
+        valid &= ~badpix[ny, nx]
+        return (numpy.ravel_multi_index((ys, xs), badpix.shape),
+                numpy.ravel_multi_index((ny, nx), badpix.shape), valid, badpix.shape)
+
+    def loadbadpix(self):
+        """ Returns (bad pixel flat indices, neighbour flat indices, valid
+            neighbour flags, shape) for the bad pixel map matching self.datain.
+            Returns None if there is no bad pixel map.
+        """
+        hotpixfile = os.path.expandvars(self.getarg('hotpixfile'))
+        if hotpixfile.lower() == 'none' or len(hotpixfile) == 0:
+            return None
+        if hotpixfile.lower() == 'search':
+            try:
+                darkname = self.loadauxname('dark', multi = False)
+            except (ValueError, KeyError) as error:
+                # i.e. no matching dark or a missing header keyword
+                self.log.warning('No master dark for bad pixel map: %s - using frame filter only'
+                                 % repr(error))
+                return None
+            name = 'hotpix_bpm_%g_%s' % (self.getarg('badsigma'),
+                                         os.path.expandvars(self.getarg('badpixfolder')))
+            return calcache.derive(name, [darkname],
+                                   lambda dark: self.badpixindex(self.makebadpix(dark)))
+        # Use the given map
+        return calcache.derive('hotpix_bpmfile', [hotpixfile],
+                               lambda bpm: self.badpixindex(fits.getdata(bpm) > 0))
 
     def run(self):
         """ Runs the hot pix removal algorithm. The self.datain is run
@@ -73,20 +184,40 @@ class StepHotpix(StepParent):
             Tolerance is the number of standard deviations used to cutoff
             the hot pixels.
         """
+        # Get the bad pixel map
+        badpix = self.loadbadpix()
         # Copy input to output data
         self.dataout = self.datain.copy()
-        img = self.datain.image
+        img = self.dataout.image
         ''' Cleaning Algorithm '''
-        #Apply a filter that creates a threshold for hotpixels
-        blurred = median_filter(img, size=2)
-        difference = img - blurred
-        threshold = 10*numpy.std(difference)
-        #Find the hotpixels
-        hot_pixels = numpy.nonzero((numpy.abs(difference[1:-1,1:-1])>threshold))
-        hot_pixels = numpy.array(hot_pixels) +1 #ignored the edges
-        #This is the image with the hot pixels removed
-        for y,x in zip(hot_pixels[0],hot_pixels[1]):
-            img[y,x]=blurred[y,x]
+        # Replace pixels of the bad pixel map with the median of good neighbours
+        if badpix is not None and tuple(badpix[3]) != img.shape:
+            self.log.warning('Bad pixel map shape %s does not fit image shape %s - not used' %
+                             (repr(badpix[3]), repr(img.shape)))
+            badpix = None
+        if badpix is not None:
+            badind, nbrind, valid, shape = badpix
+            values = numpy.where(valid, img.ravel()[nbrind], numpy.nan)
+            with numpy.errstate(invalid = 'ignore'):
+                replace = numpy.nanmedian(values, axis = 1) if len(badind) else values[:,0]
+            # Keep pixels with no good neighbour
+            usable = numpy.isfinite(replace)
+            # Index with coordinates, ravel() is a copy if img is not C-contiguous
+            img[numpy.unravel_index(badind[usable], img.shape)] = replace[usable]
+            self.log.debug('Replaced %d pixels from bad pixel map' % usable.sum())
+            self.dataout.setheadval('HISTORY', 'Hotpix: %d pixels from bad pixel map' %
+                                    usable.sum())
+        # Find and replace remaining hot pixels with a median filter
+        if badpix is None or self.getarg('framefilter'):
+            #Apply a filter that creates a threshold for hotpixels
+            blurred = median_filter(img, size=2)
+            difference = img - blurred
+            threshold = self.getarg('hotsigma')*numpy.std(difference)
+            #Find the hotpixels (ignoring the edges) and replace them
+            hot = numpy.zeros(img.shape, dtype = bool)
+            hot[1:-1,1:-1] = numpy.abs(difference[1:-1,1:-1]) > threshold
+            img[hot] = blurred[hot]
+            self.log.debug('Replaced %d pixels from frame filter' % hot.sum())
         ''' Cleaning Algorithm (end) '''
         self.dataout.image = img
         # Set complete flag
@@ -124,4 +255,6 @@ if __name__ == '__main__':
 
 """ === History ===
     2014-06-30 New file created by Neil Stilin from template file by Nicolas Chapman
+    2026-10-18 Vectorized replacement, bad pixel maps made from master darks
+    2026-10-18 Bad pixel replacement works on non C-contiguous images
 """
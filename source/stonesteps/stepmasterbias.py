@@ -11,11 +11,11 @@ import sys # sys library
 import numpy # numpy library
 import logging # logging object library
 import astropy
-import ccdproc # package for reducing optical CCD telescope data 
 import matplotlib.pyplot as plt
 from astropy.io import fits #package to recognize FITS files
 from darepype.drp import StepMIParent
 from darepype.drp import DataFits
+from stonetools.combine import combinefiles # memory limited stack combination
 
 class StepMasterBias(StepMIParent):
     """ Stone Edge Pipeline Step Master Bias Object
@@ -52,7 +52,13 @@ class StepMasterBias(StepMIParent):
         self.paramlist = []
         # Append parameters !!!! WHAT PARAMETERS ARE NEEDED ????? !!!!!
         self.paramlist.append(['combinemethod','median',
-                               'Specifies how the files should be combined - options are median, average, sum'])
+                               'Specifies how the files should be combined - options are median, average, sum, sigmaclip'])
+        self.paramlist.append(['memlimit', 1024,
+                               'Memory limit (MB) for the image tiles while combining'])
+        self.paramlist.append(['clipsigma', 3.0,
+                               'Clipping threshold (standard deviations) for combinemethod = sigmaclip'])
+        self.paramlist.append(['workers', 1,
+                               'Number of threads to subtract and combine image tiles (0 = one per core)'])
         self.paramlist.append(['outputfolder','',
                                'Output directory location - default is the folder of the input files'])
 
@@ -70,11 +76,10 @@ class StepMasterBias(StepMIParent):
             self.log.error('Bias calibration frame not found.')
             raise RuntimeError('No bias file(s) loaded')
         # self.log.debug('Creating master bias frame...')
-        # if there is just one, use it as biasfile or else combine all to make a master bias
-        if (len(filelist) == 1):
-            self.bias = ccdproc.CCDData.read(filelist[0], unit='adu', relax=True)
-        else:
-            self.bias = ccdproc.combine(filelist, method=self.getarg('combinemethod'), unit='adu', add_keyword=True)
+        # Combine all files to make a master bias (in tiles to limit memory use)
+        self.bias = combinefiles(filelist, method=self.getarg('combinemethod'),
+                                 memlimit=self.getarg('memlimit'), sigma=self.getarg('clipsigma'),
+                                 workers=self.getarg('workers'))
         # set output header, put image into output
         self.dataout.header=self.datain[0].header
         self.dataout.imageset(self.bias)
@@ -104,4 +109,6 @@ if __name__ == '__main__':
 """ === History ===
     2018-07-23 New step created based on StepRGB - Matt Merz
     2018-08-02 Updates to documentation, step functionality - Matt Merz
+    2026-10-18 Combine in tiles from memory-mapped files with stonetools.combine
+    2026-10-18 Added workers parameter to combine tiles in parallel
 """
@@ -13,12 +13,12 @@ import sys # sys library
 import numpy # numpy library
 import logging # logging object library
 import astropy
-import ccdproc # package for reducing optical CCD telescope data 
 from darepype.drp import StepMIParent
 from darepype.drp import DataFits
-from darepype.tools.steploadaux import StepLoadAux # pipestep steploadaux object
+from stonetools.combine import combinefiles # memory limited stack combination
+from stonetools.calcache import StepLoadAuxCache # steploadaux with calibration cache and master index
 
-class StepMasterDark(StepLoadAux, StepMIParent):
+class StepMasterDark(StepLoadAuxCache, StepMIParent):
     """ Stone Edge Pipeline Step Master Dark Object
         The object is callable. It requires a valid configuration input
         (file or object) when it runs.
@@ -53,7 +53,13 @@ class StepMasterDark(StepLoadAux, StepMIParent):
         self.paramlist = []
         # Append parameters !!!! WHAT PARAMETERS ARE NEEDED ????? !!!!!
         self.paramlist.append(['combinemethod','median',
-                               'Specifies how the files should be combined - options are median, average, sum'])
+                               'Specifies how the files should be combined - options are median, average, sum, sigmaclip'])
+        self.paramlist.append(['memlimit', 1024,
+                               'Memory limit (MB) for the image tiles while combining'])
+        self.paramlist.append(['clipsigma', 3.0,
+                               'Clipping threshold (standard deviations) for combinemethod = sigmaclip'])
+        self.paramlist.append(['workers', 1,
+                               'Number of threads to subtract and combine image tiles (0 = one per core)'])
         self.paramlist.append(['outputfolder','',
                                'Output directory location - default is the folder of the input files'])
         # Get parameters for StepLoadAux, replace auxfile with biasfile
@@ -67,7 +73,6 @@ class StepMasterDark(StepLoadAux, StepMIParent):
         biaslist = self.loadauxname('bias', multi = False)
         if(len(biaslist) == 0):
             self.log.error('No bias calibration frames found.')
-        self.bias = ccdproc.CCDData.read(biaslist, unit='adu', relax=True)
         # Create empy list for filenames of loaded frames
         filelist=[]
         for fin in self.datain:
@@ -79,17 +84,12 @@ class StepMasterDark(StepLoadAux, StepMIParent):
             self.log.error('Dark calibration frame not found.')
             raise RuntimeError('No dark file(s) loaded')
         self.log.debug('Creating master dark frame...')
-        # Create master frame: if there is just one file, turn it into master bias or else combine all to make master bias
-        if (len(filelist) == 1):
-            self.dark = ccdproc.CCDData.read(filelist[0], unit='adu', relax=True)
-            self.dark = ccdproc.subtract_bias(self.dark, self.bias, add_keyword=False)
-        else:
-            darklist=[]
-            for i in filelist:
-                dark =ccdproc.CCDData.read(i, unit='adu', relax=True)
-                darksubbias = ccdproc.subtract_bias(dark, self.bias, add_keyword=False)
-                darklist.append(darksubbias)
-            self.dark = ccdproc.combine(darklist, method=self.getarg('combinemethod'), unit='adu', add_keyword=True)
+        # Bias subtract and combine all files to make a master dark
+        #   (in tiles to limit memory use)
+        self.dark = combinefiles(filelist, method=self.getarg('combinemethod'),
+                                 memlimit=self.getarg('memlimit'), bias=biaslist,
+                                 sigma=self.getarg('clipsigma'),
+                                 workers=self.getarg('workers'))
         # set output header, put image into output
         self.dataout.header=self.datain[0].header
         self.dataout.imageset(self.dark)
@@ -119,4 +119,7 @@ if __name__ == '__main__':
 """ === History ===
     2018-07-23 New step created based on StepRGB - Matt Merz
     2018-08-02 Updates to documentation, step functionality - Matt Merz
+    2026-10-18 Use StepLoadAuxCache to find masters with the master index
+    2026-10-18 Combine in tiles from memory-mapped files with stonetools.combine
+    2026-10-18 Added workers parameter to combine tiles in parallel
 """
@@ -14,15 +14,15 @@ import sys # sys library
 import numpy # numpy library
 import logging # logging object library
 import astropy
-import ccdproc # package for reducing optical CCD telescope data 
 import matplotlib.pyplot as plt
 from astropy import units as u
 from astropy.io import fits #package to recognize FITS files
 from darepype.drp import StepMIParent
 from darepype.drp import DataFits
-from darepype.tools.steploadaux import StepLoadAux # pipestep steploadaux object
+from stonetools.combine import combinefiles # memory limited stack combination
+from stonetools.calcache import StepLoadAuxCache # steploadaux with calibration cache and master index
 
-class StepMasterFlat(StepLoadAux, StepMIParent):
+class StepMasterFlat(StepLoadAuxCache, StepMIParent):
     """ Stone Edge Pipeline Step Master Flat Object
         The object is callable. It requires a valid configuration input
         (file or object) when it runs.
@@ -57,7 +57,13 @@ class StepMasterFlat(StepLoadAux, StepMIParent):
         self.paramlist = []
         # Append parameters !!!! WHAT PARAMETERS ARE NEEDED ????? !!!!!
         self.paramlist.append(['combinemethod','median',
-                               'Specifies how the files should be combined - options are median, average, sum'])
+                               'Specifies how the files should be combined - options are median, average, sum, sigmaclip'])
+        self.paramlist.append(['memlimit', 1024,
+                               'Memory limit (MB) for the image tiles while combining'])
+        self.paramlist.append(['clipsigma', 3.0,
+                               'Clipping threshold (standard deviations) for combinemethod = sigmaclip'])
+        self.paramlist.append(['workers', 1,
+                               'Number of threads to subtract and combine image tiles (0 = one per core)'])
         self.paramlist.append(['outputfolder','',
                                'Output directory location - default is the folder of the input files'])
         # Get parameters for StepLoadAux, replace auxfile with biasfile
@@ -76,8 +82,6 @@ class StepMasterFlat(StepLoadAux, StepMIParent):
             self.log.error('No bias calibration frames found.')
         if(len(darklist) == 0):
             self.log.error('No bias calibration frames found.')
-        self.bias = ccdproc.CCDData.read(biaslist, unit='adu', relax=True)
-        self.dark = ccdproc.CCDData.read(darklist, unit='adu', relax=True)
         # Create empy list for filenames of loaded frames
         filelist=[]
         for fin in self.datain:
@@ -89,23 +93,16 @@ class StepMasterFlat(StepLoadAux, StepMIParent):
             self.log.error('Flat calibration frame not found.')
             raise RuntimeError('No flat file(s) loaded')
         self.log.debug('Creating master flat frame...')
-        # Create master frame: if there is just one file, turn it into master bias or else combine all to make master bias
-        if (len(filelist) == 1):
-            self.flat = ccdproc.CCDData.read(filelist[0], unit='adu', relax=True)
-            self.flat = ccdproc.subtract_bias(self.flat, self.bias, add_keyword=False)
-            self.flat = ccdproc.subtract_dark(self.flat, self.dark, scale=True, exposure_time='EXPTIME', exposure_unit=u.second, add_keyword=False)
-        else:
-            #bias and dark correct frames
-            flatlist=[]
-            for i in filelist:
-                flat =ccdproc.CCDData.read(i, unit='adu', relax=True)
-                flatsubbias = ccdproc.subtract_bias(flat, self.bias, add_keyword=False)
-                flatsubbiasdark = ccdproc.subtract_dark(flatsubbias, self.dark, scale=True, exposure_time='EXPTIME', exposure_unit=u.second, add_keyword=False)
-                flatlist.append(flatsubbiasdark)
-            #scale the flat component frames to have the same mean value, 10000.0
-            scaling_func = lambda arr: 10000.0/numpy.ma.median(arr)
-            #combine them
-            self.flat = ccdproc.combine(flatlist, method=self.getarg('combinemethod'), scale=scaling_func, unit='adu', add_keyword=False)
+        # Bias and dark subtract, scale the flat component frames to have the same
+        #   median value, 10000.0, and combine them (in tiles to limit memory use)
+        #   A single file is only bias and dark subtracted
+        scaling_func = None
+        if len(filelist) > 1:
+            scaling_func = lambda arr: 10000.0/numpy.median(arr)
+        self.flat = combinefiles(filelist, method=self.getarg('combinemethod'),
+                                 memlimit=self.getarg('memlimit'), bias=biaslist, dark=darklist,
+                                 scale=scaling_func, sigma=self.getarg('clipsigma'),
+                                 workers=self.getarg('workers'))
         # set output header, put image into output
         self.dataout.header=self.datain[0].header
         self.dataout.imageset(self.flat)
@@ -135,4 +132,7 @@ if __name__ == '__main__':
 """ === History ===
     2018-07-23 New step created based on StepRGB - Matt Merz
     2018-08-02 Updates to documentation, step functionality - Matt Merz
+    2026-10-18 Use StepLoadAuxCache to find masters with the master index
+    2026-10-18 Combine in tiles from memory-mapped files with stonetools.combine
+    2026-10-18 Added workers parameter to combine tiles in parallel
 """
@@ -11,13 +11,73 @@ import numpy # numpy library
 import logging # logging object library
 import pylab # pylab library for creating rgb image
 import time # time library for dated folders
-from astropy.visualization import simple_norm # astropy library for image scaling
-from astropy.stats import sigma_clip # astropy library for trilogy image scaling
+import shutil # to copy files
+import sqlite3 # for stretch cache errors
+from concurrent.futures import ThreadPoolExecutor # thread pool
 from PIL import Image # image library for saving rgb file as JPEG
 from PIL import ImageFont # Libraries for adding a label to the color image
 from PIL import ImageDraw
 from darepype.drp import DataFits # pipeline data object
 from darepype.drp import StepMOParent # pipe step parent object
+from stonetools.imagestats import sample, percentiles, blockreduce, clippedstats # fast image statistics
+from stonetools.stretchcache import StretchCache # cache of trilogy stretches
+from stonetools.wcscache import cachekey # cache key from header keywords
+from stonetools.starmatch import fittransform, wcstransform # channel alignment
+from scipy.ndimage import affine_transform # to resample aligned channels
+
+# Label fonts by size (see loadfont)
+fonts = {}
+
+def logy(x, xo, k, r):
+    """ Log function for trilogy scaling: y = log10(k * (x - xo) + 1) / r
+    """
+    return numpy.log10((k * (x - xo)) + 1) / r
+
+def logyfit(xo, xn, xm, noiselum):
+    """ Returns k, r of the trilogy log function (see logy) with
+        logy(xo) = 0, logy(xn) = noiselum and logy(xm) = 1.
+        With t = k * (xm - xo) and r = log10(t + 1), logy(xn) is
+        log(t * a + 1) / log(t + 1) with a = (xn - xo) / (xm - xo), which
+        increases from a (t -> 0) to 1 (t -> inf): t is found by bisection
+        in log(t). If noiselum is outside of that range the closest t in
+        1e-8 .. 1e12 is used.
+    """
+    span = max(xm - xo, 1e-30)
+    a = min(max((xn - xo) / span, 0.), 1.)
+    lo, hi = -8., 12.
+    for _ in range(64):
+        mid = (lo + hi) / 2.
+        t = 10.**mid
+        if numpy.log1p(t * a) / numpy.log1p(t) < noiselum:
+            lo = mid
+        else:
+            hi = mid
+    t = 10.**((lo + hi) / 2.)
+    return t / span, numpy.log10(t + 1.)
+
+def loadfont(size):
+    """ Returns the Sans-Serif font for the labels in size (fonts are
+        kept, so each size is only loaded once per process).
+    """
+    if size in fonts:
+        return fonts[size]
+    try:
+        # This should work on Linux
+        font = ImageFont.truetype('/usr/share/fonts/liberation/LiberationSans-Regular.ttf',size)
+    except:
+        try:
+            # This should work on Mac
+            font = ImageFont.truetype('/Library/Fonts/Arial Unicode.ttf',size)
+        except:
+            try:
+                # This should work on Windows
+                font = ImageFont.truetype('C:\\Windows\\Fonts\\arial.ttf',size)
+            except:
+                # This should work in Colab
+                font = ImageFont.truetype('/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf',size)
+                # If this still doesn't work - then add more code to make it run on YOUR system
+    fonts[size] = font
+    return font
 
 class StepRGB(StepMOParent):
     """ Stone Edge Pipeline Step RGB Object
@@ -67,6 +127,10 @@ class StepRGB(StepMOParent):
 		'Specifies the percentile for the minimum scaling'])
         self.paramlist.append(['maxpercent', 0.999,
 		'Specifies the percentile for the maximum scaling'])
+        self.paramlist.append(['percenttolerance', 0.0,
+		'Tolerance of the scaling percentiles, if > 0 they (and the trilogy noise level) ' +
+		'are found from a random subsample of about 1/percenttolerance^2 pixels ' +
+		'(0 for exact values)'])
         self.paramlist.append(['filterorder', 'sii|i-band|h-alpha|r-band|oiii|g-band',
         'Specifies the filters to be used in this step from reddest to bluest. ' + 
         'Filters should be separated by the pipe (|) character. ' + 
@@ -84,14 +148,334 @@ class StepRGB(StepMOParent):
         'Specifies whether nonexistent paths given as save folders should be created'])
         self.paramlist.append(['usetrilogy', False,
         'Specifies whether trilogy (https://www.stsci.edu/~dcoe/trilogy) ' +
-        'should be used for image scaling. ' +
-        'Requires scipy to be installed.'])
+        'should be used for image scaling.'])
         self.paramlist.append(['noiselum', [0.15,0.15,0.15],
         'Specifies the noise intensity for trilogy scaling. ' +
         'Can provide a single value for all channels or three comma-separated values for RGB.'])
         self.paramlist.append(['useastroalign', False,
         'Specifies whether astroalign should be used for image combination. ' +
         'Requires astroalign to be installed.'])
+        self.paramlist.append(['alignment', '',
+        'Alignment of the G and B channels to the R channel before scaling: ' +
+        'stars (from the SEP source tables, WCS if that fails), wcs or empty for none'])
+        self.paramlist.append(['aligntable', 'HTS',
+        'Name of the SEP source table used for alignment'])
+        self.paramlist.append(['alignsources', 100,
+        'Number of brightest sources used for alignment'])
+        self.paramlist.append(['aligntol', 3.0,
+        'Tolerance (pixels) to match sources for alignment'])
+        self.paramlist.append(['alignminmatch', 8,
+        'Minimal number of matched sources for alignment'])
+        self.paramlist.append(['previewsize', 0,
+        'Preview mode: if > 0 the images are block averaged to at most this ' +
+        'size (pixels) and the preview is rendered. Scaling values are found ' +
+        'from the block averaged images.'])
+        self.paramlist.append(['previewfull', False,
+        'Specifies whether the full resolution image is rendered in preview mode ' +
+        '(the preview is then saved as <name>_preview.jpg). With trilogy the noise ' +
+        'level and min values are scaled up by the block size for the full image, ' +
+        'otherwise the scaling values of the preview are used'])
+        self.paramlist.append(['thumbsize', 0,
+        'Size (pixels) of a thumbnail image (<name>_thumb.jpg), 0 for none'])
+        self.paramlist.append(['stretchcache', '',
+        'Cache of trilogy stretches (SQLite file, empty for no cache): ' +
+        'channels with the same stretchkeys reuse the stored shape of the log ' +
+        'function, min and max values are always found from the channel'])
+        self.paramlist.append(['stretchkeys', ['OBJECT', 'FILTER', 'EXPTIME'],
+        'Header keywords of a channel which must match to reuse a stretch'])
+        self.paramlist.append(['chunkrows', 256,
+        'Number of image rows scaled at a time'])
+        self.paramlist.append(['workers', 1,
+        'Number of threads to scale the image chunks (0 = one per core)'])
+
+    def align(self, datause, channels):
+        """ Aligns the G and B channels to the R channel (float data,
+            before scaling). Returns the list of channels.
+            With alignment = stars the transformation (rotation and shift)
+            is fitted from the SEP source tables (aligntable), if that
+            fails or with alignment = wcs it's fitted from the WCS of the
+            frames. Each channel is resampled once (bilinear), pixels
+            outside the channel are set to its median.
+        """
+        mode = self.getarg('alignment').lower()
+        if mode not in ['stars', 'wcs']:
+            return channels
+        def sources(data):
+            # Pixel positions of the brightest sources (or None)
+            tablename = self.getarg('aligntable')
+            if tablename.upper() not in data.tabnames:
+                return None
+            table = data.tableget(tablename)
+            xy = numpy.column_stack((numpy.asarray(table['X'], dtype=float),
+                                     numpy.asarray(table['Y'], dtype=float)))
+            return xy[:self.getarg('alignsources')]
+        aligned = [channels[0]]
+        xyref = sources(datause[0]) if mode == 'stars' else None
+        for i in [1, 2]:
+            if datause[i] is datause[0]:
+                aligned.append(channels[i])
+                continue
+            # Find the transformation from R pixels to channel pixels
+            transform = None
+            xy = sources(datause[i]) if xyref is not None else None
+            if xy is not None:
+                fit = fittransform(xyref, xy, self.getarg('aligntol'))
+                if fit is not None and fit[3] >= self.getarg('alignminmatch'):
+                    transform = fit[:3]
+                    self.log.debug('Align %s: %d sources, rms=%.2f pixels' %
+                                   (datause[i].filename, fit[3], fit[2]))
+            if transform is None:
+                transform = wcstransform(datause[i].header, datause[0].header, channels[0].shape)
+                if transform is not None:
+                    self.log.debug('Align %s: WCS, rms=%.2f pixels' %
+                                   (datause[i].filename, transform[2]))
+            if transform is None:
+                self.log.info('Could not align %s' % datause[i].filename)
+                aligned.append(channels[i])
+                continue
+            matrix, shift = transform[:2]
+            # Resample the channel: affine_transform uses y, x order
+            aligned.append(affine_transform(channels[i].astype(numpy.float32),
+                                            matrix[::-1, ::-1], shift[::-1],
+                                            output_shape=channels[0].shape, output=numpy.float32,
+                                            order=1, cval=percentiles(channels[i], [0.5], 0.01)[0]))
+        return aligned
+
+    def scaling(self, channels, headers = None, factor = 1, full = False):
+        """ Finds the scaling values from the channels (list of 3 images):
+            Returns minsv (3 min values), maxsv (3 max values for trilogy,
+            one value for all channels otherwise) and for trilogy a list of
+            the (k, r) parameters of the log function for each channel
+            (None otherwise). If headers (of the channels) are given,
+            the trilogy stretch cache is used. factor is the block size
+            of block averaged channels (preview), it is part of the cache
+            key. If full is set the trilogy values are for the full
+            resolution image: block averaging reduces the noise by factor,
+            so the noise level and the distance of the min value from the
+            mean are scaled up by factor.
+        """
+        # The min/max percentile values are found without sorting all
+        # the data, from a random subsample if percenttolerance is set
+        # Values are determined by parameters in the pipe configuration file
+        tolerance = self.getarg('percenttolerance')
+        # Find the final data values to use for scaling from the image data
+        # sv stands for "scalevalue"
+        if not self.getarg('usetrilogy'):
+            # Old scaling uses a constant max value for each channel (from all channels)
+            minsv = numpy.array([percentiles(channel, [self.getarg('minpercent')], tolerance)[0]
+                                 for channel in channels])
+            self.log.info(' Scale min r/g/b: %f/%f/%f' % (minsv[0],minsv[1],minsv[2]))
+            maxsv = percentiles(channels, [self.getarg('maxpercent')], tolerance)[0]
+            self.log.info(' Scale max: %f' % maxsv)
+            return minsv, maxsv, None
+        # Trilogy scaling uses log scaling constrained at three points
+        # Point 1 is the zero point -> scaled to 0
+        # Point 2 is the noise level (1 sigma above the sigma-clipped mean) -> scaled to noiselum
+        # Point 3 is a saturation level (user-defined) -> scaled to 1
+        # log function used is y = log10(k * (x - xo) + 1) / r
+
+        # Handling single float inputs and three-value inputs for noiselum
+        noiselum_param = self.getarg('noiselum')
+        if len(noiselum_param) == 3:
+            noiselum_list = noiselum_param
+        elif len(noiselum_param) == 1:
+            noiselum_list = noiselum_param * 3
+        else:
+            self.log.error('Invalid number of noiselums provided (should be 3 or 1): ' + 
+                        str(noiselum_param) +
+                        '. Setting noiselum to default value of 0.15 for all channels.')
+            noiselum_list = [0.15, 0.15, 0.15]
+
+        # Stretches of earlier observations with the same keywords are reused
+        # Cache errors (i.e. a missing cache folder) are not fatal
+        cache = None
+        if len(self.getarg('stretchcache')) and headers is not None:
+            try:
+                cache = StretchCache(os.path.expandvars(self.getarg('stretchcache')))
+            except (sqlite3.Error, OSError) as error:
+                self.log.warning('Unable to open stretch cache %s: %s - not using cache' %
+                                 (self.getarg('stretchcache'), repr(error)))
+
+        # Trilogy scaling defines a separate max value for each channel
+        # and needs the noise level: sort the values of one channel at a
+        # time, then the percentiles and the sigma-clipped statistics are
+        # found from indices of the sorted values
+        # A cached stretch only sets the shape of the log function (k
+        # relative to maxsv - minsv, and r), minsv and maxsv are always
+        # found from the channel (sky background and transparency change)
+        minsv, maxsv, krs = numpy.empty(3), numpy.empty(3), [None, None, None]
+        for i, channel in enumerate(channels):
+            stretch = None
+            if cache is not None:
+                key = '%s|NOISELUM=%g|BLOCK=%d|MINPCT=%g|MAXPCT=%g' % (
+                    cachekey(headers[i], self.getarg('stretchkeys')), noiselum_list[i],
+                    factor, self.getarg('minpercent'), self.getarg('maxpercent'))
+                if full:
+                    key += '|FULL'
+                try:
+                    stretch = cache.lookup(key)
+                except (sqlite3.Error, OSError) as error:
+                    self.log.warning('Stretch cache lookup failed: %s - not using cache' %
+                                     repr(error))
+                    cache = None
+            if stretch is not None and not full:
+                # The noise level is not needed: no sort
+                minsv[i], maxsv[i] = percentiles(channel, [self.getarg('minpercent'),
+                                                           self.getarg('maxpercent')], tolerance)
+            else:
+                values = numpy.sort(sample(channel, tolerance))
+                minsv[i] = values[int(len(values) * self.getarg('minpercent'))]
+                maxsv[i] = values[int(len(values) * self.getarg('maxpercent'))]
+                mean, std = clippedstats(values)
+                del values
+                if full:
+                    minsv[i] = mean + (minsv[i] - mean) * factor
+                    std *= factor
+                noisesv = mean + std
+            span = max(maxsv[i] - minsv[i], 1e-30)
+            if stretch is not None:
+                krs[i] = (stretch['t'] / span, stretch['r'])
+                self.log.debug('Using cached stretch for %s' % key)
+                continue
+            # Solve for k and r (see logyfit)
+            krs[i] = logyfit(minsv[i], noisesv, maxsv[i], noiselum_list[i])
+            if cache is not None:
+                try:
+                    cache.store(key, krs[i][0] * span, krs[i][1])
+                except (sqlite3.Error, OSError) as error:
+                    self.log.warning('Stretch cache store failed: %s - not using cache' %
+                                     repr(error))
+                    cache = None
+        self.log.info(' Scale min r/g/b: %f/%f/%f' % (minsv[0],minsv[1],minsv[2]))
+        self.log.info(' Scale max r/g/b: %f/%f/%f' % (maxsv[0],maxsv[1],maxsv[2]))
+        return minsv, maxsv, krs
+
+    def render(self, channels, minsv, maxsv, krs):
+        """ Returns the color image (uint8 cube) of the channels (list of
+            3 images) scaled with the values from scaling().
+        """
+        # Make new cube with the proper data type for color images (uint8)
+        nrows, ncols = channels[0].shape[:2]
+        imgcube = numpy.empty((nrows, ncols, 3), dtype='uint8')
+        # Scale and quantize in chunks of rows (with float64 buffers of
+        # chunkrows rows only) written straight into the cube
+        chunkrows = max(1, self.getarg('chunkrows'))
+        def renderchunk(row0):
+            row1 = min(nrows, row0 + chunkrows)
+            for i in range(3):
+                buf = numpy.array(channels[i][row0:row1], dtype=numpy.float64)
+                if krs is not None:
+                    # Trilogy: log10(k * (x - xo) + 1) / r (see logy)
+                    numpy.clip(buf, minsv[i], maxsv[i], out=buf)
+                    buf -= minsv[i]
+                    buf *= krs[i][0]
+                    buf += 1.
+                    numpy.log10(buf, out=buf)
+                    buf /= krs[i][1]
+                else:
+                    # Old scaling uses square root (sqrt) scaling for each filter
+                    buf -= minsv[i]
+                    buf /= maxsv - minsv[i]
+                    numpy.clip(buf, 0., 1., out=buf)
+                    numpy.sqrt(buf, out=buf)
+                buf *= 255.
+                imgcube[row0:row1, :, i] = buf
+        workers = self.getarg('workers')
+        workers = workers if workers > 0 else (os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # list() to raise exceptions from the workers
+            list(pool.map(renderchunk, range(0, nrows, chunkrows)))
+
+        if self.getarg('useastroalign') == True:
+            ''' Astroalign image alignment '''
+            try:
+                import astroalign
+            except:
+                self.log.error('Could not import astroalign')
+            else:
+                # Align G and B channels to R channel
+                try:
+                    aligned_img1, footprint1 = astroalign.register(imgcube[:,:,1], imgcube[:,:,0])
+                    aligned_img2, footprint2 = astroalign.register(imgcube[:,:,2], imgcube[:,:,0])
+                except:
+                    self.log.error('astroalign alignment failed')
+                else:
+                    imgcube[:,:,1] = aligned_img1
+                    imgcube[:,:,2] = aligned_img2
+        return imgcube
+
+    def addlabel(self, imgcolor, datause, filename):
+        """ Adds the label (object, observer, observatory and filters) to
+            the color image (PIL image).
+        """
+        draw = ImageDraw.Draw(imgcolor)
+        # Use a variable to make the positions and size of text relative
+        imgwidth, imgheight = imgcolor.size
+        # Open Sans-Serif Font with a size relative to the picture size
+        font = loadfont(imgheight//41)
+        # Use the beginning of the FITS filename as the object name
+        filename = os.path.split(filename)[-1]
+        try:
+            objectname = filename.split('_')[0]
+            objectname = objectname[0].upper()+objectname[1:]
+        except Exception:
+            objectname = 'Unknown.'
+        objectname = 'Object:  %s' % objectname
+        # Read labels at their respective position (kept relative to image size)
+        # Left corner: object, observer, observatory
+        # Right corner: Filters used for red, green, and blue colors
+        draw.text((imgwidth/100,imgheight/1.114), objectname, (255,255,255), font=font)
+        # Read FITS keywords for the observer, observatory, and filters
+        if 'OBSERVER' in datause[0].header:
+            observer = 'Observer:  %s' % datause[0].getheadval('OBSERVER')
+            draw.text((imgwidth/100,imgheight/1.073), observer, (255,255,255), font=font)
+        if 'OBSERVAT' in datause[0].header:
+            observatory = 'Observatory:  %s' % datause[0].getheadval('OBSERVAT')
+            draw.text((imgwidth/100,imgheight/1.035), observatory, (255,255,255), font=font)
+        if 'FILTER' in datause[0].header:
+            red = 'R:  %s' % datause[0].getheadval('FILTER')
+            draw.text((imgwidth/1.15,imgheight/1.114),red, (255,255,255), font=font)
+        if 'FILTER' in datause[1].header:
+            green = 'G:  %s' % datause[1].getheadval('FILTER')
+            draw.text((imgwidth/1.15,imgheight/1.073),green, (255,255,255), font=font)
+        if 'FILTER' in datause[2].header:
+            blue = 'B:  %s' % datause[2].getheadval('FILTER')
+            draw.text((imgwidth/1.15,imgheight/1.035),blue, (255,255,255), font=font)
+
+    def saveimage(self, imgcolor, imgname):
+        """ Saves the color image (PIL image) as imgname and copies it to
+            the folderpaths. The JPEG is only encoded once, the copies
+            are hard links to it (or copies of the file if the folder is
+            on another file system).
+        """
+        imgcolor.save(imgname)
+        self.log.info('Saving file %s' % imgname)
+
+        # Optional folder output setup
+        baseimgname = os.path.basename(imgname)
+        folderpaths_list = self.getarg('folderpaths').split(':')
+        for path in folderpaths_list:
+            if not len(path):
+                continue
+            path = time.strftime(path, time.localtime())
+            if not os.path.exists(path):
+                if self.getarg('createfolders'):
+                    os.makedirs(path)
+                    self.log.info('Creating directory %s' %path)
+                else:
+                    self.log.info('Invalid folder path %s' %path)
+            try:
+                copyname = os.path.join(path, baseimgname)
+                if os.path.abspath(copyname) == os.path.abspath(imgname):
+                    continue
+                if os.path.lexists(copyname):
+                    os.remove(copyname)
+                try:
+                    os.link(imgname, copyname)
+                except OSError:
+                    shutil.copyfile(imgname, copyname)
+            except:
+                self.log.exception('Could not save image to directory %s' %path)
 
     def run(self):
         """ Runs the combining algorithm. The self.datain is run
@@ -158,216 +542,54 @@ class StepRGB(StepMOParent):
         jpeg_dataout = DataFits(config = self.config)
         jpeg_dataout.header = datause[0].header
         jpeg_dataout.filename = datause[0].filename
-        img = datause[0].image
-        img1 = datause[1].image
-        img2 = datause[2].image
-
-        ''' Finding Min/Max scaling values '''
-        # Create a Data Cube with floats
-        datacube = numpy.zeros((img.shape[0], img.shape[1], 3), dtype=float)
-        # Enter the image data into the cube so an absolute max can be found
-        datacube[:,:,0] = img
-        datacube[:,:,1] = img1
-        datacube[:,:,2] = img2
-        # Find how many data points are in the data cube
-        datalength = img.shape[0] * img.shape[1] * 3
-        # Create a 1-dimensional array with all the data, then sort it	
-        datacube.shape=(datalength,)
-        datacube.sort()
-        # Now use arrays for each filter to find separate min values
-        oned_channels = [img.copy(), img1.copy(), img2.copy()]
-        # Shape and sort the arrays
-        arrlength = img.shape[0] * img.shape[1]
-        for arr in oned_channels:
-            arr.shape=(arrlength,)
-            arr.sort()
-        oned_channels = numpy.array(oned_channels)
-
-        # Find the min/max percentile values in the data for scaling
-        # Values are determined by parameters in the pipe configuration file
-        minindex = int(arrlength * self.getarg('minpercent'))
-        # Find the final data values to use for scaling from the image data
-        # sv stands for "scalevalue"
-        minsv = oned_channels[:, minindex]
-        self.log.info(' Scale min r/g/b: %f/%f/%f' % (minsv[0],minsv[1],minsv[2]))
-
-        if self.getarg('usetrilogy'):
-            # Trilogy scaling defines a separate max value for each channel
-            maxindex = int(arrlength * self.getarg('maxpercent'))
-            maxsv = oned_channels[:, maxindex]
-            self.log.info(' Scale max r/g/b: %f/%f/%f' % (maxsv[0],maxsv[1],maxsv[2]))
+        channels = [datause[0].image, datause[1].image, datause[2].image]
+        channels = self.align(datause, channels)
+
+        ''' Preview: block average the channels '''
+        factor = 1
+        if self.getarg('previewsize') > 0:
+            factor = max(1, -(-max(channels[0].shape) // self.getarg('previewsize')))
+        if factor > 1:
+            previews = [blockreduce(channel, factor) for channel in channels]
+            self.log.debug('Preview: %d x %d pixels (block size %d)' %
+                           (previews[0].shape[1], previews[0].shape[0], factor))
         else:
-            # Old scaling uses a constant max value for each channel
-            maxindex = int(datalength * self.getarg('maxpercent'))
-            maxsv = datacube[maxindex]
-            self.log.info(' Scale max: %f' % maxsv)
-        ''' Finished Finding scaling values	'''
-
-        ''' Combining Function '''
-        # Make new cube with the proper data type for color images (uint8)
-        imgcube = numpy.zeros((img.shape[0], img.shape[1], 3), dtype='uint8')
-
-        if self.getarg('usetrilogy'):
-            # Trilogy scaling uses log scaling constrained at three points
-            # Point 1 is the zero point -> scaled to 0
-            # Point 2 is the noise level (1 sigma above the sigma-clipped mean) -> scaled to noiselum
-            # Point 3 is a saturation level (user-defined) -> scaled to 1
-            # log function used is y = log10(k * (x - xo) + 1) / r
-            noisesv = numpy.empty(3)
-            for i, channel in enumerate(oned_channels):
-                clipped_channel = sigma_clip(channel)
-                noisesv[i] = numpy.mean(clipped_channel) + numpy.std(clipped_channel)
-
-            # Handling single float inputs and three-value inputs for noiselum
-            noiselum_param = self.getarg('noiselum')
-            if len(noiselum_param) == 3:
-                noiselum_list = noiselum_param
-            elif len(noiselum_param) == 1:
-                noiselum_list = noiselum_param * 3
-            else:
-                self.log.error('Invalid number of noiselums provided (should be 3 or 1): ' + 
-                            str(noiselum_param) +
-                            '. Setting noiselum to default value of 0.15 for all channels.')
-                noiselum_list = [0.15, 0.15, 0.15]
-            
-            # Solving for k and r must be done numerically
-            # We fit the log function by minimizing the RMSE at the three points
-            xarray = numpy.array([minsv, noisesv, maxsv])
-
-            def rmse(observed, expected):
-                return numpy.sqrt(numpy.mean(numpy.nan_to_num((observed - expected) ** 2, nan=100000.)))
+            previews = channels
 
-            def logy(x, xo, k, r):
-                return numpy.log10((k * (x - xo)) + 1) / r
+        ''' Finding Min/Max scaling values (from the preview) '''
+        headers = [data.header for data in datause]
+        minsv, maxsv, krs = self.scaling(previews, headers, factor)
 
-            def rmse_builder(x, noiselum):
-                return lambda kr: rmse(logy(x, x[0], kr[0], kr[1]), numpy.array([0, noiselum, 1]))
-
-            try:
-                from scipy.optimize import minimize
-            except:
-                self.log.error('Could not import scipy.optimize')
-
-            for i in range(3):
-                # Find parameters for normalization function
-                kr_res = minimize(rmse_builder(xarray[:, i], noiselum_list[i]), [0.001, 1], method='Nelder-Mead')
-                # Apply normalizaton function
-                imgcube[:,:,i] = logy(numpy.clip(datause[i].image, minsv[i], maxsv[i]), minsv[i], kr_res.x[0], kr_res.x[1]) * 255.
-
-        else:
-            # Old scaling uses square root (sqrt) scaling for each filter
-            # log or asinh scaling is also available
-            #astropy.vidualizations.SqrtStretch()
-            for i in range(3):
-                # Make normalization function
-                norm = simple_norm(datause[i].image, 'sqrt', min_cut = minsv[i], max_cut = maxsv)
-                # Apply it
-                imgcube[:,:,i] = norm(datause[i].image) * 255.
-
-
-        if self.getarg('useastroalign') == True:
-            ''' Astroalign image alignment '''
-            try:
-                import astroalign
-            except:
-                self.log.error('Could not import astroalign')
+        ''' Combining Function '''
+        # Render the full image and / or the preview, the main image is
+        # the full image if it's rendered
+        cubes = []
+        if factor == 1 or self.getarg('previewfull'):
+            if factor > 1:
+                # Scaling values for the noise of the full image
+                cubes.append(('', self.render(channels, *self.scaling(previews, headers,
+                                                                       factor, full = True))))
             else:
-                # Align G and B channels to R channel
-                try:
-                    aligned_img1, footprint1 = astroalign.register(imgcube[:,:,1], imgcube[:,:,0])
-                    aligned_img2, footprint2 = astroalign.register(imgcube[:,:,2], imgcube[:,:,0])
-                except:
-                    self.log.error('astroalign alignment failed')
-                else:
-                    imgcube[:,:,1] = aligned_img1
-                    imgcube[:,:,2] = aligned_img2
-
-
-        jpeg_dataout.image = imgcube
-        # Create variable containing all the scaled image data
-        imgcolor = Image.fromarray(jpeg_dataout.image, mode='RGB')
-        # Save colored image as a .tif file (without the labels)
-        imgcolortif = imgcube.copy()
-        imgcolortif.astype('uint16')
-        ### tiff.imsave('%s.tif' % jpeg_dataout.filenamebase, imgcolortif)
-        ''' End of combining function '''
-        
-        ''' Add a Label to the Image '''
-        draw = ImageDraw.Draw(imgcolor)
-        # Use a variable to make the positions and size of text relative
-        imgwidth = img.shape[1]
-        imgheight = img.shape[0]
-        # Open Sans-Serif Font with a size relative to the picture size
-        try:
-            # This should work on Linux
-            font = ImageFont.truetype('/usr/share/fonts/liberation/LiberationSans-Regular.ttf',imgheight//41)
-        except:
-            try:
-                # This should work on Mac
-                font = ImageFont.truetype('/Library/Fonts/Arial Unicode.ttf',imgheight//41)
-            except:
-                try:
-                    # This should work on Windows
-                    font = ImageFont.truetype('C:\\Windows\\Fonts\\arial.ttf',imgheight//41)
-                except:
-                    # This should work in Colab
-                    font = ImageFont.truetype('/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf',imgheight//41)
-                    # If this still doesn't work - then add more code to make it run on YOUR system
-        # Use the beginning of the FITS filename as the object name
-        filename = os.path.split(jpeg_dataout.filename)[-1]
-        try:
-            objectname = filename.split('_')[0]
-            objectname = objectname[0].upper()+objectname[1:]
-        except Exception:
-            objectname = 'Unknown.'
-        objectname = 'Object:  %s' % objectname
-        # Read labels at their respective position (kept relative to image size)
-        # Left corner: object, observer, observatory
-        # Right corner: Filters used for red, green, and blue colors
-        draw.text((imgwidth/100,imgheight/1.114), objectname, (255,255,255), font=font)
-        # Read FITS keywords for the observer, observatory, and filters
-        if 'OBSERVER' in jpeg_dataout.header:
-            observer = 'Observer:  %s' % jpeg_dataout.getheadval('OBSERVER')
-            draw.text((imgwidth/100,imgheight/1.073), observer, (255,255,255), font=font)
-        if 'OBSERVAT' in jpeg_dataout.header:
-            observatory = 'Observatory:  %s' % jpeg_dataout.getheadval('OBSERVAT')
-            draw.text((imgwidth/100,imgheight/1.035), observatory, (255,255,255), font=font)
-        if 'FILTER' in datause[0].header:
-            red = 'R:  %s' % datause[0].getheadval('FILTER')
-            draw.text((imgwidth/1.15,imgheight/1.114),red, (255,255,255), font=font)
-        if 'FILTER' in datause[1].header:
-            green = 'G:  %s' % datause[1].getheadval('FILTER')
-            draw.text((imgwidth/1.15,imgheight/1.073),green, (255,255,255), font=font)
-        if 'FILTER' in datause[2].header:
-            blue = 'B:  %s' % datause[2].getheadval('FILTER')
-            draw.text((imgwidth/1.15,imgheight/1.035),blue, (255,255,255), font=font)
+                cubes.append(('', self.render(channels, minsv, maxsv, krs)))
+        if factor > 1:
+            cubes.append(('_preview' if len(cubes) else '', self.render(previews, minsv, maxsv, krs)))
+        jpeg_dataout.image = cubes[0][1]
 
+        ''' Save images with labels and thumbnail '''
         # Make image name
         imgname = jpeg_dataout.filenamebegin
         if imgname[-1] in '_-,.': imgname=imgname[:-1]
-        imgname +='.jpg'
-        # Save the completed image
-        imgcolor.save(imgname)
-        self.log.info('Saving file %sjpg' %jpeg_dataout.filenamebegin)
-
-        # Optional folder output setup
-        baseimgname = os.path.basename(imgname)
-        folderpaths_list = self.getarg('folderpaths').split(':')
-        for path in folderpaths_list:
-            path = time.strftime(path, time.localtime())
-            if not os.path.exists(path):
-                if self.getarg('createfolders'):
-                    os.makedirs(path)
-                    self.log.info('Creating directory %s' %path)
-                else:
-                    self.log.info('Invalid folder path %s' %path)
-            try:
-                imgcolor.save(os.path.join(path, baseimgname))
-            except:
-                self.log.exception('Could not save image to directory %s' %path)
+        for suffix, imgcube in cubes:
+            # Create variable containing all the scaled image data
+            imgcolor = Image.fromarray(imgcube, mode='RGB')
+            if self.getarg('thumbsize') > 0 and imgcube is cubes[-1][1]:
+                # Thumbnail (without label) from the smallest image
+                imgthumb = imgcolor.copy()
+                imgthumb.thumbnail((self.getarg('thumbsize'), self.getarg('thumbsize')), Image.LANCZOS)
+                self.saveimage(imgthumb, imgname + '_thumb.jpg')
+            self.addlabel(imgcolor, datause, jpeg_dataout.filename)
+            self.saveimage(imgcolor, imgname + suffix + '.jpg')
 
-        
-        ''' End of Label Code '''
         # Set complete flag
         jpeg_dataout.setheadval('COMPLETE',1,
                                     'Data Reduction Pipe: Complete Data Flag')
@@ -433,4 +655,26 @@ if __name__ == '__main__':
     2014-08-06 Added 'if' functions to the label printing so that if keywords do not exist in the header(s), they are skipped rather than raising an error --NS
     2014-08-11 This file was essentially just renamed. The file called steprgb.py now uses raw inputs to determine the scaling values.  --NS
     2020-09-21 Major changes made to image selection algorithm and image scaling algorithm, new options for image alignment and saving JPEGs to other folders added. --JL
+    2026-10-18 Scaling percentiles are found by selection (no sorting), new
+               percenttolerance parameter to find them and the trilogy
+               noise level from a subsample --agent
+    2026-10-18 Split run into scaling, render, addlabel and saveimage, added
+               preview mode (previewsize, previewfull) and thumbnails,
+               removed the unused uint16 copy of the cube (imgcolortif) --agent
+    2026-10-18 Scaling and conversion to uint8 in one pass over chunks of
+               rows (chunkrows, workers), replaces simple_norm --agent
+    2026-10-18 Trilogy k, r are solved directly (logyfit) instead of the
+               Nelder-Mead fit, fast sigma clipping of the sorted values,
+               optional cache of stretches (stretchcache, stretchkeys) --agent
+    2026-10-18 Added alignment of the float channels from the SEP source
+               tables or the WCS (alignment parameters) --agent
+    2026-10-18 Fonts are loaded once per process (loadfont), JPEGs are
+               linked or copied to the folderpaths instead of encoded
+               again, empty folderpaths are skipped --agent
+    2026-10-18 Stretch cache key includes the preview block size and the
+               min/max percentiles, cache errors are not fatal --agent
+    2026-10-18 Trilogy noise level and min values of the full image in
+               preview mode (previewfull) are scaled up by the block size --agent
+    2026-10-18 Stretch cache only keeps the shape of the log function, min
+               and max values are found from each image --agent
 """
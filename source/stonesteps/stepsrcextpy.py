@@ -49,6 +49,7 @@ import pylab as plt # pylab library for plotting
 from lmfit import minimize, Parameters # For brightness correction fit
 from darepype.drp import StepParent # pipestep stepparent object
 from darepype.drp.datafits import DataFits
+from stonetools import septiles # tiled parallel SEP
 
 
 class StepSrcExtPy(StepParent):
@@ -120,159 +121,79 @@ class StepSrcExtPy(StepParent):
                                 'extraction threshold for source extration'])
         self.paramlist.append(['ext_bfactor', 10.0,
                                 'brightness factor for creating highlevel threshold'])
+        self.paramlist.append(['ext_brightfromlow', False,
+                                'no high threshold extraction: the bright source list is the low threshold '
+                                'sources with filtered peak above the high threshold (low threshold '
+                                'deblending and measurements, not the same as a high threshold extraction)'])
         self.paramlist.append(['ext_deblend', 256,
                                 'deblend threshold for source extration'])
         self.paramlist.append(['phot_kronf', 2.5,
                                 'factor multiplied into kronrad to get radius for integration'])
         self.paramlist.append(['save_background', True,
                                 'option to save the background as a seprate hdu'])
+        self.paramlist.append(['ext_tilesize', 0,
+                                'size of tiles for background and extraction (0 = whole frame)'])
+        self.paramlist.append(['ext_tilemargin', 64,
+                                'margin around tiles in pixels (larger than the sources)'])
+        self.paramlist.append(['ext_workers', 0,
+                                'number of threads for tiles (0 = one per core)'])
         #self.paramlist.append(['byte_swap', False,
         # 	                    'says if the bytes should be swapped or not for the image'])
         # confirm end of setup
         self.log.debug('Setup: done')
 
-    def run(self):
-        """ Runs the calibrating algorithm. The calibrated data is
-            returned in self.dataout
+    def extract(self, image_sub, thresh, err, deblend_nthresh):
+        """ Runs sep.extract on the whole frame or in tiles (if ext_tilesize
+            is set) and returns the sources.
+        """
+        if self.getarg('ext_tilesize') > 0:
+            return septiles.extract(image_sub, thresh, err, self.getarg('ext_tilesize'),
+                                    self.getarg('ext_tilemargin'), self.getarg('ext_workers'),
+                                    deblend_nthresh=deblend_nthresh)
+        return sep.extract(image_sub, thresh, err=err, deblend_nthresh=deblend_nthresh)
+
+    def measure(self, image_sub, sources, bkg_rms, kfactor):
+        """ Measures the flux (Kron ellipse) and half-flux radius of the
+            sources from sep.extract. Returns objects, flux, flux error and
+            half-flux radius, all sorted by descending flux.
         """
-        ### Preparation
-        binning = self.datain.getheadval('XBIN')
-        ### Perform Source Extraction
-        # Open data out of fits file for use in SEP
-        psimage = self.datain.image.copy()
-        # Byteswap if required
-        maxexp = np.max(np.abs(np.frexp(psimage)[1]))
-        self.log.debug('Initial max exponent value: %d' % maxexp)
-        self.log.debug('Isnative: %s' % repr(psimage.dtype.isnative))
-        #if not psimage.dtype.isnative:
-        if maxexp > 19:
-            self.log.debug("Performing byte swap")
-            image = psimage.byteswap(inplace=True)
-        else:
-            self.log.debug("No byte swap required")
-            image = psimage
-
-        self.log.debug("Initial data type: %s" % psimage.dtype)
-        if psimage.dtype != np.float64:
-            self.log.debug("Converting to float64")
-            image = image.byteswap(inplace=True).newbyteorder()
-        else:
-            self.log.debug("No dtype swap required")
-
-        #These variables are used for the background analysis. 
-        #We grab the values from the paramlist
-        maskthresh = self.getarg('bkg_maskthreshold')
-        backwh= self.getarg('bkg_wh')
-        filwh= self.getarg('bkg_filterwh')
-        bw, bh = backwh[0], backwh[1]
-        fw, fh = filwh[0], filwh[1]
-        fthresh = self.getarg('bkg_fthreshold')
-
-        #Create the background image and it's error
-        bkg = sep.Background(image, maskthresh=maskthresh,bw=bw, bh=bh, fw=fw,
-        fh=fh, fthresh=fthresh) 
-
-        bkg_image=bkg.back()
-
-        bkg_rms =bkg.rms()
-        self.log.debug('Background image global')
-        if bkg.globalback < np.nanmin(image) or bkg.globalback > np.nanmax(image):
-            self.log.warn('Background has out of bounds values - image may not reduce')
-        #Subtract the background from the image
-        image_sub = image - bkg_image
-        #Calculate the Median and STD of the Subtracted Image
-        imsubmed = np.nanmedian(image_sub)
-        imsubmad = mad_std(image_sub)
-        
-        # save background image ###############################
-#         apple = DataFits(config = self.config)
-#         apple.image = bkg_image
-#         apple.save(os.path.join(os.path.split(self.datain.filename)[0],'bgimg.fits'))
-#         apple = DataFits(config = self.config)
-#         apple.image = image_sub
-#         apple.save(os.path.join(os.path.split(self.datain.filename)[0],'imgsub.fits'))
-
-		#Create variables that are used during source Extraction and Flux Calculation
-        #Some defined in the param are grabbed now
-        extract_thresh = self.getarg('ext_thresh')
-        bright_factor= self.getarg('ext_bfactor')
-        deblend_nthresh = self.getarg('ext_deblend')
-        kfactor = self.getarg('phot_kronf')
-        extract_err = bkg_rms
-        #Extract sources from the subtracted image. It extracts a low threshold list and a high threshold list
-        sources = sep.extract(image_sub, extract_thresh, err=extract_err, deblend_nthresh= deblend_nthresh)
-        sourcesb= sep.extract(image_sub, extract_thresh*bright_factor, err=extract_err, deblend_nthresh= deblend_nthresh)
-
         ### Sort sources by descending isophotal flux. (Taken from Dr. Harper's Explore SEP Notebook)
         ind = np.argsort(sources['flux'])
         reverser = np.arange(len(ind) - 1,-1,-1)
         rev_ind = np.take_along_axis(ind, reverser, axis = 0)
-        
         objects = np.take_along_axis(sources, rev_ind, axis = 0)
 
-        indb = np.argsort(sourcesb['flux'])
-        reverserbri = np.arange(len(indb) - 1,-1,-1)
-        rev_indb = np.take_along_axis(indb, reverserbri, axis = 0)
-        objectsb = np.take_along_axis(sourcesb, rev_indb, axis = 0)
-        
         #Correcting instances of floating point errors in theta from SEP
         #Other issues will be flagged with an invalid aperture parameters error
         objects['theta'] = np.where(abs(objects['theta'] - np.pi/2) < 0.001, np.pi/2, objects['theta'])
-        objectsb['theta'] = np.where(abs(objectsb['theta'] - np.pi/2) < 0.001, np.pi/2, objectsb['theta'])
 
-        ###Do basic uncalibrated measurments of flux for use in step astrometry. 
+        ###Do basic uncalibrated measurments of flux for use in step astrometry.
         '''
         First we calculate flux using Ellipses. In order to do this we need to calculate
-        the Kron Radius for the ellipses the Extract process identified using the ellipse 
-        parameters it gives. 
+        the Kron Radius for the ellipses the Extract process identified using the ellipse
+        parameters it gives.
         R is equal to 6 as that is the default used in Source Extractor
         '''
-        kronrad, krflag = sep.kron_radius(image_sub, objects['x'], objects['y'], 
+        kronrad, krflag = sep.kron_radius(image_sub, objects['x'], objects['y'],
         	objects['a'], objects['b'], objects['theta'], r=6.0)
 
-        kronradb, krflagb= sep.kron_radius(image_sub, objectsb['x'], objectsb['y'], 
-            objectsb['a'],objectsb['b'], objectsb['theta'], r=6.0)
-
         #Using this Kron radius we calculate the flux
         #This is equivalent to FLUX_AUTO in SExtractor
-        flux_elip, fluxerr_elip, flag = sep.sum_ellipse(image_sub, objects['x'], objects['y'], objects['a'], 
+        flux_elip, fluxerr_elip, flag = sep.sum_ellipse(image_sub, objects['x'], objects['y'], objects['a'],
         objects['b'], objects['theta'], r= kfactor*kronrad, err=bkg_rms, subpix=1)
-        flux_elipb, fluxerr_elipb, flag = sep.sum_ellipse(image_sub, objectsb['x'], 
-        objectsb['y'], objectsb['a'], objectsb['b'], objectsb['theta'],
-        r= kfactor*kronradb, err=bkg_rms, subpix=1)
 
         #Now we want to calculate the Half-flux Radius. This will be reported later
         #First in order to establish a zone to integrate over we need an Rmax
         dx = (objects['xmax'] - objects['xmin']) / 2
         dy = (objects['ymax'] - objects['ymin']) / 2
-
-        dxb = (objectsb['xmax'] - objectsb['xmin']) / 2
-        dyb = (objectsb['ymax'] - objectsb['ymin']) / 2
-
-
         rmax = np.sqrt(dx*dx + dy*dy)
-        rmaxb= np.sqrt(dxb*dxb + dyb*dyb)
         '''Frac is the percentage of flux we want contained within the radius,
         since we want half flux radius, frac is .5 '''
-        
         frac=0.5
         rh, rh_flag = sep.flux_radius(image_sub, objects['x'], objects['y'], rmax, frac)
-        rhb, rhb_flag = sep.flux_radius(image_sub, objectsb['x'], objectsb['y'], rmaxb, frac)
 
-   
         #Sort the individual arrays so that the final table is sorted by flux
-        #create sorting index by using flux. This is for the boosted threshold
-        indb = np.argsort(flux_elipb)
-        reverserb = np.arange(len(indb) - 1,-1,-1)
-        rev_indb = np.take_along_axis(indb, reverserb, axis = 0)
-        flux_elipb = np.take_along_axis(flux_elipb, rev_indb, axis = 0)
-        #now apply it to all the axis
-        fluxerr_elipb = np.take_along_axis(fluxerr_elipb, rev_indb, axis = 0)
-        objectsb = np.take_along_axis(objectsb, rev_indb, axis = 0)
-        rhb = np.take_along_axis(rhb, rev_indb, axis = 0)
-
-        #now for normal threshold
-
+        #create sorting index by using flux
         ind = np.argsort(flux_elip)
         reverser = np.arange(len(ind) - 1,-1,-1)
         rev_ind = np.take_along_axis(ind, reverser, axis = 0)
@@ -281,8 +202,88 @@ class StepSrcExtPy(StepParent):
         fluxerr_elip = np.take_along_axis(fluxerr_elip, rev_ind, axis = 0)
         objects = np.take_along_axis(objects, rev_ind, axis = 0)
         rh = np.take_along_axis(rh, rev_ind, axis = 0)
+        return objects, flux_elip, fluxerr_elip, rh
+
+    def run(self):
+        """ Runs the calibrating algorithm. The calibrated data is
+            returned in self.dataout
+        """
+        ### Preparation
+        binning = self.datain.getheadval('XBIN')
+        ### Perform Source Extraction
+        # Make the working image for SEP: native byte order float32. The input
+        # image (i.e. big endian from a FITS file) is converted in one copy, the
+        # background is subtracted in place (the copy is kept as IMSUB).
+        image = self.datain.image
+        self.log.debug('Input data type: %s' % image.dtype)
+        image_sub = np.array(image, dtype=np.float32)
+
+        #These variables are used for the background analysis. 
+        #We grab the values from the paramlist
+        maskthresh = self.getarg('bkg_maskthreshold')
+        backwh= self.getarg('bkg_wh')
+        filwh= self.getarg('bkg_filterwh')
+        bw, bh = backwh[0], backwh[1]
+        fw, fh = filwh[0], filwh[1]
+        fthresh = self.getarg('bkg_fthreshold')
 
+        #Create the background and it's error image (for the whole frame the
+        #background image is only made if it's saved)
+        tilesize = self.getarg('ext_tilesize')
+        tilemargin = self.getarg('ext_tilemargin')
+        workers = self.getarg('ext_workers')
+        if tilesize > 0:
+            bkg_image, bkg_rms, globalback = septiles.background(image_sub, tilesize,
+                tilemargin, workers, maskthresh=maskthresh, bw=bw, bh=bh, fw=fw, fh=fh,
+                fthresh=fthresh)
+        else:
+            bkg = sep.Background(image_sub, maskthresh=maskthresh,bw=bw, bh=bh, fw=fw,
+            fh=fh, fthresh=fthresh) 
+            bkg_image = None
+            bkg_rms =bkg.rms()
+            globalback = bkg.globalback
+        self.log.debug('Background image global')
+        if globalback < np.nanmin(image_sub) or globalback > np.nanmax(image_sub):
+            self.log.warn('Background has out of bounds values - image may not reduce')
+        #Subtract the background from the image (in place)
+        if bkg_image is None:
+            bkg.subfrom(image_sub)
+        else:
+            image_sub -= bkg_image
         
+        # save background image ###############################
+#         apple = DataFits(config = self.config)
+#         apple.image = bkg_image
+#         apple.save(os.path.join(os.path.split(self.datain.filename)[0],'bgimg.fits'))
+#         apple = DataFits(config = self.config)
+#         apple.image = image_sub
+#         apple.save(os.path.join(os.path.split(self.datain.filename)[0],'imgsub.fits'))
+
+		#Create variables that are used during source Extraction and Flux Calculation
+        #Some defined in the param are grabbed now
+        extract_thresh = self.getarg('ext_thresh')
+        bright_factor= self.getarg('ext_bfactor')
+        deblend_nthresh = self.getarg('ext_deblend')
+        kfactor = self.getarg('phot_kronf')
+        extract_err = bkg_rms
+        #Extract sources from the subtracted image. It extracts a low threshold list and a high threshold list
+        sources = self.extract(image_sub, extract_thresh, extract_err, deblend_nthresh)
+        objects, flux_elip, fluxerr_elip, rh = self.measure(image_sub, sources, bkg_rms, kfactor)
+        if self.getarg('ext_brightfromlow'):
+            # The bright list is taken from the low threshold list: sources with
+            # filtered peak above the high threshold (thresh is the low threshold
+            # at the object location), the measurements are reused. The sources are
+            # not deblended again at the high threshold, so this is an approximation
+            # of the high threshold list
+            bright = objects['cpeak'] >= bright_factor * objects['thresh']
+            objectsb, flux_elipb, fluxerr_elipb, rhb = (objects[bright], flux_elip[bright],
+                                                        fluxerr_elip[bright], rh[bright])
+            self.log.debug('Bright from low: %d of %d sources above high threshold' %
+                           (np.count_nonzero(bright), len(objects)))
+        else:
+            sourcesb= self.extract(image_sub, extract_thresh*bright_factor, extract_err, deblend_nthresh)
+            objectsb, flux_elipb, fluxerr_elipb, rhb = self.measure(image_sub, sourcesb, bkg_rms, kfactor)
+
         # Select only the stars in the image: circular image and S/N > 10
         #Establish an elongation limit
         elim=1.5
@@ -362,8 +363,8 @@ class StepSrcExtPy(StepParent):
 
         sourceb_table= fits.BinTableHDU.from_columns(cb)
         ### Make output data
-        # Copy data from datain
-        self.dataout = self.datain.copy()  
+        # Use datain (no copy of the images)
+        self.dataout = self.datain
         #This is making a third table which includes all of objects and more for future use
         self.dataout.tableset(objects, tablename='SEP_objects')
         self.dataout.tableaddcol('rh', rh, 'SEP_objects')
@@ -378,6 +379,8 @@ class StepSrcExtPy(StepParent):
         #If save Background are true, this saves it as an HDU
         if self.getarg('save_background'):
             dataname = "BACKGROUND"
+            if bkg_image is None:
+                bkg_image = bkg.back()
             self.dataout.imageset(bkg_image, imagename=dataname)
             self.dataout.setheadval('HISTORY', 'BACKGROUND', 
                                     dataname=dataname)
@@ -425,4 +428,11 @@ if __name__ == '__main__':
 
 '''HISTORY:
 2018-09-019 - Started based on Amanda's code. - Marc Berthoud
+2026-10-18 - Added ext_singlepass option, moved source measurements to measure() - agent
+2026-10-18 - Memory lean: float32 working image, no byteswap guessing, in place
+             background subtraction, peak RSS in log - agent
+2026-10-18 - Added tiled parallel background and extraction (stonetools.septiles) - agent
+2026-10-18 - Removed peak RSS from log (process wide, not per frame) - agent
+2026-10-18 - Renamed ext_singlepass to ext_brightfromlow, it does not re-deblend
+             at the high threshold - agent
 '''
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+""" CALIBRATION CACHE - Version 1.0.0
+
+    This module keeps calibration masters (bias, dark, flat ...) in memory
+    so they are shared between input files, pipe step objects and pipeline
+    runs in the same process. Pipe steps that use StepLoadAux to find their
+    masters can use StepLoadAuxCache instead, it caches:
+    - The master files: Loaded DataFits objects, keyed by the resolved
+      filepathname and modification time of the file. The least recently
+      used masters are dropped if the memory limit is reached.
+    - The file matching: The glob of the aux file parameter and the
+      headers of the files found. Globs are re-run if one of the folders
+      changes (i.e. a new master has been written). The files selected
+      by the fitkeys before DATE-OBS (i.e. NAXIS1, XBIN, EXPTIME, FILTER)
+      are kept for each set of their values. DATE-OBS, which is different
+      for each frame, is applied to the kept files.
+    - If the auxindex parameter is set, files and headers are taken from
+      the master index file (see stonetools.masterindex) instead of
+      globbing the folders and reading the headers from the FITS files.
+
+    The cache is a single object (calcache) for the whole process. Cached
+    master data objects are shared, they must not be changed by the steps.
+
+    @author: agent
+"""
+
+import os # os library
+import glob # glob library
+import time # time library
+import logging # logging object library
+import threading # to lock the cache
+import collections # for ordered dictionary
+from astropy.io import fits # to make headers
+from darepype.drp import DataParent # Pipeline Data object
+from darepype.drp import DataFits # Pipeline FITS data object
+from darepype.drp import StepMIParent # To check if we have datain or [datain, datain, ...]
+from darepype.tools.steploadaux import StepLoadAux # pipestep steploadaux object
+from stonetools.masterindex import MasterIndex # index of master files
+
+class CalCache(object):
+    """ Process-wide cache for calibration master files
+    """
+
+    def __init__(self, maxbytes = 2048 * 2**20):
+        """ Constructor: Initialize the cache
+            - maxbytes: memory limit for cached data
+        """
+        self.maxbytes = maxbytes
+        self.log = logging.getLogger('stoneedge.pipe.calcache')
+        self.lock = threading.RLock()
+        # Loaded master data: (realpath, mtime) -> (data object, nbytes)
+        #   ordered from least to most recently used
+        self.data = collections.OrderedDict()
+        self.nbytes = 0
+        # File headers: realpath -> (mtime, header data object)
+        self.heads = {}
+        # Globs: pattern -> (folder state, list of filenames)
+        self.globs = {}
+        # Matches: key -> (folder state, list of selected header objects)
+        self.matches = {}
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def filekey(self, filename):
+        """ Returns the cache key (resolved path, mtime) for a file
+        """
+        realpath = os.path.realpath(filename)
+        return realpath, os.path.getmtime(realpath)
+
+    def load(self, filename, config = None):
+        """ Returns the loaded data object for filename. The file is only
+            read if it's not in the cache or has changed.
+        """
+        key = self.filekey(filename)
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                self.log.debug('Load: Using cached %s' % filename)
+                return self.data[key][0]
+        # Load the file (outside the lock, it may take a while)
+        data = DataParent(config = config).load(filename)
+        nbytes = sum([img.nbytes for img in getattr(data, 'imgdata', []) if img is not None])
+        with self.lock:
+            self.misses += 1
+            # Remove older versions of the same file
+            for oldkey in [k for k in self.data if k[0] == key[0]]:
+                self.nbytes -= self.data.pop(oldkey)[1]
+            self.data[key] = (data, nbytes)
+            self.nbytes += nbytes
+            self.evict()
+        self.log.debug('Load: Loaded %s (%.1f MB cached in %d files)' %
+                       (filename, self.nbytes / 2.**20, len(self.data)))
+        return data
+
+    def derive(self, name, filenames, func):
+        """ Returns a value computed from master files (i.e. a normalized
+            flat), func(*filenames) is only called if the value is not in
+            the cache or one of the files has changed. The value must be a
+            numpy array or a tuple of them, it is shared: don't change it.
+        """
+        key = (name,) + tuple([self.filekey(f) for f in filenames])
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key][0]
+        value = func(*filenames)
+        if isinstance(value, tuple):
+            nbytes = sum([getattr(v, 'nbytes', 0) for v in value])
+        else:
+            nbytes = getattr(value, 'nbytes', 0)
+        with self.lock:
+            self.misses += 1
+            # Remove values from older versions of the files
+            for oldkey in [k for k in self.data if k[0] == name and
+                           [f[0] for f in k[1:]] == [f[0] for f in key[1:]]]:
+                self.nbytes -= self.data.pop(oldkey)[1]
+            self.data[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self.evict()
+        return value
+
+    def evict(self):
+        """ Removes least recently used files until the cache fits into
+            maxbytes (the most recent file is always kept).
+        """
+        with self.lock:
+            while self.nbytes > self.maxbytes and len(self.data) > 1:
+                key, (data, nbytes) = self.data.popitem(last = False)
+                self.nbytes -= nbytes
+                self.log.debug('Evict: Removed %s from cache' % key[0])
+
+    def folderstate(self, pattern):
+        """ Returns the modification times of all folders matching the
+            folder part of a glob pattern. Any new file in the folders
+            changes the state.
+        """
+        folders = sorted(glob.glob(os.path.dirname(pattern) or '.'))
+        return tuple([(f, os.path.getmtime(f)) for f in folders])
+
+    def glob(self, pattern):
+        """ Returns glob.glob(pattern), the result is cached until one of
+            the folders changes.
+        """
+        state = self.folderstate(pattern)
+        with self.lock:
+            if pattern in self.globs and self.globs[pattern][0] == state:
+                return list(self.globs[pattern][1])
+        filelist = glob.glob(pattern)
+        with self.lock:
+            self.globs[pattern] = (state, filelist)
+        return list(filelist)
+
+    def loadhead(self, filename, config = None):
+        """ Returns a data object with the header of filename (cached)
+        """
+        realpath, mtime = self.filekey(filename)
+        with self.lock:
+            if realpath in self.heads and self.heads[realpath][0] == mtime:
+                return self.heads[realpath][1]
+        head = DataParent(config = config).loadhead(filename)
+        with self.lock:
+            self.heads[realpath] = (mtime, head)
+        return head
+
+    def sethead(self, filename, mtime, headstring, config = None):
+        """ Sets the header for filename from a header string (i.e.
+            from the master index) unless it is already cached. The header
+            is not used if mtime doesn't match the file.
+        """
+        realpath = os.path.realpath(filename)
+        with self.lock:
+            if realpath in self.heads and self.heads[realpath][0] == mtime:
+                return
+        head = DataFits(config = config)
+        header = fits.Header.fromstring(headstring)
+        head.imgheads = [header]
+        head.imgdata = [None]
+        try:
+            head.imgnames = [header['EXTNAME'].upper()]
+        except:
+            head.imgnames = ['PRIMARY HEADER']
+        head.filename = filename
+        with self.lock:
+            self.heads[realpath] = (mtime, head)
+
+    def getmatch(self, key, pattern):
+        """ Returns the cached match result for key or None if there is
+            none or the folders of pattern changed.
+        """
+        state = self.folderstate(pattern)
+        with self.lock:
+            if key in self.matches and self.matches[key][0] == state:
+                return self.matches[key][1]
+        return None
+
+    def setmatch(self, key, pattern, result):
+        """ Stores the match result for key
+        """
+        state = self.folderstate(pattern)
+        with self.lock:
+            self.matches[key] = (state, result)
+
+    def clear(self):
+        """ Empties the cache
+        """
+        with self.lock:
+            self.data.clear()
+            self.nbytes = 0
+            self.heads.clear()
+            self.globs.clear()
+            self.matches.clear()
+
+# Cache object for the process
+calcache = CalCache()
+
+class StepLoadAuxCache(StepLoadAux):
+    """ StepLoadAux with cached file matching and master loading.
+        Use instead of StepLoadAux, call loadauxsetup() in setup() as usual.
+    """
+
+    def loadauxsetup(self, auxpar = 'aux'):
+        """ Sets up the parameters for auxpar (see StepLoadAux) and the
+            memory limit for the calibration cache.
+        """
+        super(StepLoadAuxCache, self).loadauxsetup(auxpar)
+        if 'cachesize' not in [ par[0] for par in self.paramlist] :
+            self.paramlist.append(['cachesize', 2048,
+                'Memory limit (MB) for calibration masters kept in memory ' +
+                '(shared by all steps in the process)'])
+            self.paramlist.append(['auxindex', '',
+                'SQLite index file of master files and headers ' +
+                '(default = \'\' to glob and read the FITS files)'])
+
+    def auxglob(self, pattern):
+        """ Returns the files matching pattern. Uses the master index if
+            auxindex is set, the headers of the files are added to the
+            cache.
+        """
+        indexfile = os.path.expandvars(self.getarg('auxindex'))
+        if len(indexfile) == 0:
+            return calcache.glob(pattern)
+        auxlist = []
+        for filename, mtime, headstring in MasterIndex(indexfile).files(pattern):
+            calcache.sethead(filename, mtime, headstring, self.config)
+            auxlist.append(filename)
+        return auxlist
+
+    def selectaux(self, auxheadlist, fitkeys, data):
+        """ Selects the aux files (header objects in auxheadlist) which
+            fit data for the fitkeys (as StepLoadAux.loadauxname). Returns
+            the selected headers and True, or the headers left before the
+            first fitkey without any fitting file and False.
+        """
+        for key in fitkeys:
+            newheadlist = []
+            # Look through auxfiles, transfer good ones
+            if key in 'DATE-OBS': # SPECIAL CASE DATE-OBS:
+                # get time for data
+                datime = time.mktime(time.strptime(data.getheadval('DATE-OBS'),
+                                                   '%Y-%m-%dT%H:%M:%S'))
+                # get time offset (from data) for each auxfile
+                auxtimes = []
+                for auxhead in auxheadlist:
+                    auxtime = time.mktime(time.strptime(auxhead.getheadval('DATE-OBS'),
+                                                        '%Y-%m-%dT%H:%M:%S'))
+                    auxtimes.append(abs(auxtime-datime))
+                # only keep auxfiles which are within daterange of closest auxfile
+                mindiff = min(auxtimes)
+                timerange = self.getarg('daterange') * 86400
+                for auxi in range(len(auxheadlist)):
+                    if auxtimes[auxi] - mindiff < timerange:
+                        newheadlist.append(auxheadlist[auxi])
+            else: # Normal Keyword compare
+                for auxhead in auxheadlist:
+                    # Check if the auxfile fits (compare with data)
+                    if auxhead.getheadval(key) == data.getheadval(key) :
+                        # it fits -> add to newheadlist
+                        newheadlist.append(auxhead)
+            # stop if no files left
+            if len(newheadlist) == 0:
+                return auxheadlist, False
+            auxheadlist = newheadlist
+        return auxheadlist, True
+
+    def loadauxname(self, auxpar = '', data = None, multi = False):
+        """ Same as StepLoadAux.loadauxname() but globs and headers are
+            taken from the calibration cache. The files selected by the
+            fitkeys before the first DATE-OBS fitkey are remembered for
+            each combination of their values, DATE-OBS (different for
+            each file) and the following fitkeys are applied to them.
+        """
+        ### Setup
+        # Set auxpar
+        if len(auxpar) == 0:
+            auxpar = self.auxpar
+        # Get parameters
+        auxfile = os.path.expandvars(self.getarg(auxpar + 'file'))
+        fitkeys  = self.getarg(auxpar + 'fitkeys')
+        if len(fitkeys) == 1 and len(fitkeys[0]) == 0:
+            fitkeys = []
+        # Get datain object (depends on step being SingleInput or MultiInput)
+        if data == None:
+            if issubclass(self.__class__, StepMIParent):
+                data = self.datain[0]
+            else:
+                data = self.datain
+        ### Look for previous selection with the fitkeys before DATE-OBS
+        ncache = len(fitkeys)
+        for i, key in enumerate(fitkeys):
+            if isinstance(key, str) and key in 'DATE-OBS':
+                ncache = i
+                break
+        try:
+            keyvals = tuple([str(data.getheadval(key)) for key in fitkeys[:ncache]])
+        except KeyError:
+            keyvals = None
+        matchkey = (self.name, auxpar, auxfile, self.getarg('bkup'+auxpar),
+                    tuple(fitkeys), keyvals)
+        cached = None
+        if keyvals != None:
+            cached = calcache.getmatch(matchkey, auxfile)
+        if cached != None:
+            self.log.debug('LoadAuxName: Using cached selection for %s (%d files)' %
+                           (auxpar, len(cached)))
+            auxheadlist, matched = cached, True
+        else:
+            ### Look for files - return in special cases
+            self.log.debug("Looking for files under %s" % auxfile)
+            # Glob the list of files
+            auxlist = self.auxglob(auxfile)
+            # If no file found - look in backup folder
+            if len(auxlist) < 1:
+                self.log.warn('No files found under %s - looking in backup' % auxfile)
+                auxback = os.path.expandvars(self.getarg('bkup'+auxpar))
+                if len(auxback):
+                    auxfile = auxback
+                    auxlist = self.auxglob(auxfile)
+            # Throw exception if no file found
+            if len(auxlist) < 1:
+                msg = 'No %s files found under %s' % (auxpar, auxfile)
+                self.log.error(msg)
+                raise ValueError(msg)
+            # Return unique file, or all files if fitkeys is empty
+            if len(auxlist) == 1 or len(fitkeys) == 0:
+                if len(auxlist) == 1:
+                    self.log.info('LoadAuxName: Found unique file = %s' % auxlist[0])
+                else:
+                    self.log.info('LoadAuxName: No fitkeys: Return first %sfile match = %s' %
+                                  (auxpar, auxlist[0]) )
+                data.setheadval('HISTORY','%s: Best %sfile = %s' %
+                                (self.name, auxpar, os.path.split(auxlist[0])[1],))
+                if multi:
+                    return auxlist
+                else:
+                    return auxlist[0]
+            ### Select files with Fitkeys
+            # check format (make first element uppercase)
+            try:
+                _ = fitkeys[0].upper()
+            except AttributeError:
+                # AttributeError if it's not a string
+                self.log.error('LoadAuxFile: fitkeys config parameter is ' +
+                               'incorrect format - need list of strings')
+                raise TypeError('fitkeys config parameter is incorrect format' +
+                                ' - need list of strings')
+            # Get all headers from auxlist into a auxheadlist (pipedata objects)
+            auxheadlist = [calcache.loadhead(auxnam, self.config) for auxnam in auxlist]
+            # Look through the keywords before DATE-OBS
+            auxheadlist, matched = self.selectaux(auxheadlist, fitkeys[:ncache], data)
+            # Remember the selection (only if there was a match)
+            if keyvals != None and matched:
+                calcache.setmatch(matchkey, auxfile, auxheadlist)
+        # Look through DATE-OBS and the following keywords
+        if matched:
+            auxheadlist, matched = self.selectaux(auxheadlist, fitkeys[ncache:], data)
+        ### Select file to return
+        if multi:
+            # Return all filenames
+            auxname = [aux.filename for aux in auxheadlist]
+            # Return message
+            if len(auxname) > 3:
+                listnames = "%d files: %s to %s" % (len(auxname),auxname[0],auxname[-1])
+            else:
+                listnames = ' '.join(auxname)
+            if matched:
+                self.log.info('LoadAuxName: Matching %s found are <%s>' %
+                              (auxpar, listnames) )
+            else:
+                self.log.warn('LoadAuxName: NO MATCH finding aux files')
+                self.log.warn('Returning files <%s>' % listnames )
+        else:
+            # Return first filename
+            auxname = auxheadlist[0].filename
+            # Select best file
+            if matched:
+                self.log.info('LoadAuxName: Matching %s found is <%s>' %
+                              (auxpar, auxname) )
+            else:
+                self.log.warn('LoadAuxName: NO MATCH finding aux file')
+                self.log.warn('Returning first file <%s>' % auxname )
+            listnames = auxname # just so we can use it below
+        data.setheadval('HISTORY','%s: Best %s = %s' %
+                        (self.name, auxpar, listnames))
+        # Return selected file
+        return auxname
+
+    def loadauxdata(self, auxname):
+        """ Returns the data object for the master file auxname from
+            the calibration cache. The object is shared, don't change it.
+        """
+        calcache.maxbytes = self.getarg('cachesize') * 2**20
+        return calcache.load(auxname, self.config)
+
+""" === History ===
+2026-10-18 New module for a process-wide calibration master cache
+2026-10-18 Use master index file if auxindex is set
+2026-10-18 Match cache keeps the files selected by the fitkeys before
+           DATE-OBS, DATE-OBS is applied to them for each frame
+"""
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+""" STACK COMBINE - Version 1.0.0
+
+    This module combines a stack of FITS images (i.e. to make master bias,
+    dark and flat frames) without loading the whole stack into memory.
+
+    The images are read in tiles of rows from memory-mapped files (the
+    BSCALE/BZERO scaling is applied per tile), so only one tile of each
+    image is in memory at a time. The number of rows per tile follows from
+    the memory limit.
+    Before combining, each image can be corrected with a master bias and
+    a master dark (the dark is scaled by the ratio of EXPTIME values) and
+    scaled by a factor computed from the corrected full image (i.e. the
+    10000/median scaling of flats).
+
+    The results are the same as ccdproc.combine with the same options:
+    - median, average, sum: NaN values are ignored (as in ccdproc)
+    - sigmaclip: Average after removing values that are more than sigma
+      standard deviations from the mean (one iteration, the clipping is
+      done before scaling, as sigma_clip=True in ccdproc.combine).
+    Calculations are done in float64.
+
+    Tiles are read, corrected and combined by a pool of worker threads
+    (numpy releases the GIL for the heavy work), the memory limit is
+    shared by the workers. The scale factors need full images, fewer
+    workers are used for them if the memory limit requires it.
+
+    @author: agent
+"""
+
+import os # os library
+import logging # logging object library
+from concurrent.futures import ThreadPoolExecutor # thread pool
+import numpy as np # numpy library
+from astropy.io import fits # to read FITS files
+
+# Combination methods
+methods = ['median', 'average', 'sum', 'sigmaclip']
+
+def openfits(filename):
+    """ Opens a FITS file memory-mapped without scaling the image data
+        (astropy can't memory-map scaled data, see readrows)
+    """
+    return fits.open(filename, memmap = True, do_not_scale_image_data = True)
+
+def readrows(hdu, row0, row1):
+    """ Returns rows row0 to row1 of the image in hdu as float64 array
+        with BSCALE, BZERO and BLANK applied (as astropy does).
+    """
+    raw = hdu.data[row0:row1]
+    tile = raw.astype(np.float64)
+    bscale = hdu.header.get('BSCALE', 1)
+    bzero = hdu.header.get('BZERO', 0)
+    if bscale != 1:
+        tile *= bscale
+    if bzero != 0:
+        tile += bzero
+    if 'BLANK' in hdu.header and raw.dtype.kind in 'iu':
+        tile[raw == hdu.header['BLANK']] = np.nan
+    return tile
+
+class StackCombiner(object):
+    """ Combines a stack of images from FITS files in tiles of rows
+    """
+
+    def __init__(self, filelist, memlimit = 1024, bias = None, dark = None,
+                 workers = 1):
+        """ Constructor: Open the files
+            - filelist: list of FITS file names of the images
+            - memlimit: memory limit in MB for the image tiles
+            - bias: file name of master bias to subtract (optional)
+            - dark: file name of master dark to subtract (optional),
+                    it's scaled by the image EXPTIME / dark EXPTIME
+            - workers: number of threads (0 for one per core)
+        """
+        self.log = logging.getLogger('stoneedge.pipe.combine')
+        self.memlimit = memlimit
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        # Open the images with memory mapping
+        self.hduls = [openfits(f) for f in filelist]
+        self.shape = self.hduls[0][0].shape
+        for hdul, fname in zip(self.hduls, filelist):
+            if hdul[0].shape != self.shape:
+                self.close()
+                raise ValueError('Image %s has shape %s, expected %s' %
+                                 (fname, repr(hdul[0].shape), repr(self.shape)))
+        # Open the masters
+        self.bias = None
+        self.dark = None
+        self.darkscales = None
+        if bias:
+            self.bias = openfits(bias)
+        if dark:
+            self.dark = openfits(dark)
+            darkexp = float(self.dark[0].header['EXPTIME'])
+            self.darkscales = [float(hdul[0].header['EXPTIME']) / darkexp
+                               for hdul in self.hduls]
+        # Map the data now, so the worker threads don't do it at the same time
+        for hdul in self.hduls + [self.bias, self.dark]:
+            if hdul is not None:
+                hdul[0].data
+        # Scale factors (set by setscale)
+        self.scales = None
+
+    def close(self):
+        """ Closes all files
+        """
+        for hdul in self.hduls + [self.bias, self.dark]:
+            if hdul is not None:
+                hdul.close()
+
+    def read(self, index, row0, row1):
+        """ Returns rows row0 to row1 of image index (as float64) with bias
+            and dark subtracted.
+        """
+        tile = readrows(self.hduls[index][0], row0, row1)
+        if self.bias is not None:
+            tile -= readrows(self.bias[0], row0, row1)
+        if self.dark is not None:
+            tile -= readrows(self.dark[0], row0, row1) * self.darkscales[index]
+        return tile
+
+    def setscale(self, func):
+        """ Computes the scale factor of each image as func(image). The
+            images are corrected and then given to func, one image per
+            worker at a time. Each worker needs about three full images
+            (the corrected image and the copies made by func, i.e. by
+            np.median), the number of workers is limited so they fit
+            into memlimit (at least one worker is used).
+        """
+        framebytes = np.prod(self.shape) * 8
+        nworkers = int(max(1, min(self.workers, self.memlimit * 2**20 // (3 * framebytes))))
+        # The corrected image is read in chunks of rows (about 16 MB), so
+        # the float64 temporaries of read are small
+        chunk = int(max(1, 2**24 // (np.prod(self.shape[1:]) * 8)))
+        def scaleimage(index):
+            image = np.empty(self.shape, dtype = np.float64)
+            for row0 in range(0, self.shape[0], chunk):
+                row1 = min(self.shape[0], row0 + chunk)
+                image[row0:row1] = self.read(index, row0, row1)
+            return func(image)
+        self.log.debug('SetScale: %d images with %d workers' % (len(self.hduls), nworkers))
+        with ThreadPoolExecutor(max_workers = nworkers) as pool:
+            self.scales = np.array(list(pool.map(scaleimage, range(len(self.hduls)))))
+        self.log.debug('SetScale: Scale factors = %s' % repr(self.scales))
+
+    def tilerows(self, method):
+        """ Returns the number of rows per tile to stay within memlimit
+            with all workers running. Tiles are made smaller if needed
+            so each worker gets at least one tile.
+        """
+        # Memory use factor for copies made while combining
+        factor = 3 if method in ['median', 'sigmaclip'] else 2
+        rowbytes = np.prod(self.shape[1:]) * 8 * len(self.hduls) * factor
+        nrows = self.memlimit * 2**20 // (rowbytes * self.workers)
+        nrows = min(nrows, -(-self.shape[0] // self.workers))
+        return int(max(1, min(self.shape[0], nrows)))
+
+    def combine(self, method = 'median', sigma = 3.0):
+        """ Combines the images, returns the result as float64 array
+            - method: one of median, average, sum, sigmaclip
+            - sigma: clipping threshold for sigmaclip (in standard deviations)
+        """
+        if method not in methods:
+            raise ValueError('Unknown combine method %s - options are %s' %
+                             (method, ', '.join(methods)))
+        result = np.empty(self.shape, dtype = np.float64)
+        nrows = self.tilerows(method)
+        self.log.debug('Combine: %s of %d images in tiles of %d rows with %d workers' %
+                       (method, len(self.hduls), nrows, self.workers))
+        def combinetile(row0):
+            row1 = min(self.shape[0], row0 + nrows)
+            stack = np.empty((len(self.hduls), row1 - row0) + tuple(self.shape[1:]),
+                             dtype = np.float64)
+            for i in range(len(self.hduls)):
+                stack[i] = self.read(i, row0, row1)
+            if method == 'sigmaclip':
+                # Clip on unscaled data, values are set to NaN
+                with np.errstate(invalid = 'ignore'):
+                    center = np.nanmean(stack, axis = 0)
+                    deviation = np.nanstd(stack, axis = 0)
+                    clip = ((stack < center - sigma * deviation) |
+                            (stack > center + sigma * deviation))
+                stack[clip] = np.nan
+            if self.scales is not None:
+                stack *= self.scales.reshape((-1,) + (1,) * (stack.ndim - 1))
+            result[row0:row1] = self.reduce(stack, method)
+        with ThreadPoolExecutor(max_workers = self.workers) as pool:
+            # list() to raise exceptions from the workers
+            list(pool.map(combinetile, range(0, self.shape[0], nrows)))
+        return result
+
+    def reduce(self, stack, method):
+        """ Combines a stack along the first axis, NaNs are ignored. The
+            faster non-NaN functions are used if there are no NaNs.
+        """
+        hasnan = np.isnan(stack).any()
+        with np.errstate(invalid = 'ignore'):
+            if method == 'median':
+                return np.nanmedian(stack, axis = 0) if hasnan else np.median(stack, axis = 0)
+            elif method == 'sum':
+                return np.nansum(stack, axis = 0) if hasnan else np.sum(stack, axis = 0)
+            else:
+                return np.nanmean(stack, axis = 0) if hasnan else np.mean(stack, axis = 0)
+
+def combinefiles(filelist, method = 'median', memlimit = 1024, bias = None,
+                 dark = None, scale = None, sigma = 3.0, workers = 1):
+    """ Combines the images in filelist, returns a float64 array
+        - method: one of median, average, sum, sigmaclip
+        - memlimit: memory limit in MB for the image tiles
+        - bias, dark: file names of master bias / dark to subtract (optional)
+        - scale: function to compute the scale factor of each corrected
+                 image (optional), i.e. lambda img: 10000.0 / np.median(img)
+        - sigma: clipping threshold for sigmaclip
+        - workers: number of threads (0 for one per core)
+    """
+    combiner = StackCombiner(filelist, memlimit, bias, dark, workers)
+    try:
+        if scale is not None:
+            combiner.setscale(scale)
+        return combiner.combine(method, sigma)
+    finally:
+        combiner.close()
+
+""" === History ===
+2026-10-18 New module for memory limited combination of image stacks
+2026-10-18 Added worker threads for tiles and scale factors
+2026-10-18 Scale factors: corrected image read in chunks, number of workers
+           limited by memlimit
+"""
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+""" CONTACT SHEET - Version 1.0.0
+
+    This module makes a contact sheet: a mosaic of small versions of
+    the color images of a night with the name of each image below it,
+    for the daily summary (see PipeRenderRGB.py).
+
+    @author: agent
+"""
+
+import os # os library
+import logging # logging object library
+from PIL import Image # image library
+from PIL import ImageDraw # to add labels
+from PIL import ImageFont # default label font
+
+log = logging.getLogger('stoneedge.pipe.contactsheet')
+
+def contactsheet(imagefiles, outfile, tilesize = 256, ncols = 6, labels = None):
+    """ Makes a contact sheet of the images in imagefiles (JPEG or other
+        PIL formats) and saves it as outfile. Each image is shrunk to fit
+        in tilesize x tilesize pixels, ncols images per row. Labels (one
+        per image) are written below the images, the default is the file
+        name without extension. Images which can't be read are skipped.
+        Returns the number of images on the sheet.
+    """
+    if labels is None:
+        labels = [os.path.splitext(os.path.basename(f))[0] for f in imagefiles]
+    font = ImageFont.load_default()
+    labelheight = 16
+    tiles = []
+    for filename, label in zip(imagefiles, labels):
+        try:
+            with Image.open(filename) as image:
+                # draft lets the JPEG decoder skip the full resolution
+                image.draft('RGB', (tilesize, tilesize))
+                image = image.convert('RGB')
+                image.thumbnail((tilesize, tilesize))
+        except Exception as error:
+            log.warning('Could not read %s (%s)' % (filename, repr(error)))
+            continue
+        tiles.append((image, label))
+    if not len(tiles):
+        log.warning('No images for contact sheet %s' % outfile)
+        return 0
+    ncols = max(1, min(ncols, len(tiles)))
+    nrows = -(-len(tiles) // ncols)
+    cellh = tilesize + labelheight
+    sheet = Image.new('RGB', (ncols * tilesize, nrows * cellh))
+    draw = ImageDraw.Draw(sheet)
+    for index, (image, label) in enumerate(tiles):
+        x0, y0 = (index % ncols) * tilesize, (index // ncols) * cellh
+        sheet.paste(image, (x0 + (tilesize - image.size[0]) // 2,
+                            y0 + (tilesize - image.size[1]) // 2))
+        draw.text((x0 + 4, y0 + tilesize + 2), label, (255, 255, 255), font = font)
+    sheet.save(outfile)
+    log.info('Contact sheet %s with %d images' % (outfile, len(tiles)))
+    return len(tiles)
+
+""" === History ===
+2026-10-18 New module for the contact sheet of the nightly color images
+"""
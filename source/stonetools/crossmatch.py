@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+""" CROSS MATCH - Version 1.0.0
+
+    This module matches sky positions (i.e. extracted sources with
+    reference catalog stars). It replaces SkyCoord.match_to_catalog_sky
+    which builds a new search tree and SkyCoord objects for each call.
+
+    A CrossMatcher is made for one set of positions (the catalog): the
+    positions are turned into unit vectors and put into a KD-tree once.
+    Queries then return:
+    - nearest: the nearest catalog entry and its distance for each query
+      position (same result as match_to_catalog_sky)
+    - within: all catalog entries within a radius of each query position
+    - pairs: all (query, catalog) pairs within a radius as flat arrays
+    - catalognearest: the nearest query position within a radius for
+      each catalog entry (the tree is on the catalog, so the tree of a
+      reference catalog is reused for the sources of all frames)
+    Distances are computed from the chord length between unit vectors,
+    which is accurate at all angles.
+
+    The reference catalog (stonetools.refcat) keeps one CrossMatcher per
+    catalog tile, the frames of all filters of a field use the same trees.
+
+    @author: agent
+"""
+
+import numpy as np # numpy library
+from scipy.spatial import cKDTree # KD-tree
+
+def radec2xyz(ra, dec):
+    """ Returns unit vectors (N x 3 array) for ra, dec in degrees
+    """
+    ra = np.radians(np.asarray(ra, dtype = np.float64))
+    dec = np.radians(np.asarray(dec, dtype = np.float64))
+    cosdec = np.cos(dec)
+    return np.column_stack((cosdec * np.cos(ra), cosdec * np.sin(ra), np.sin(dec)))
+
+def chord2deg(chord):
+    """ Returns angular distances (degrees) for chord lengths of unit vectors
+    """
+    return np.degrees(2. * np.arcsin(np.clip(np.asarray(chord) / 2., 0., 1.)))
+
+def deg2chord(angle):
+    """ Returns the chord length of unit vectors for an angle in degrees
+    """
+    return 2. * np.sin(np.radians(min(float(angle), 180.)) / 2.)
+
+def maketree(ra, dec):
+    """ Returns the KD-tree of the unit vectors of positions (degrees),
+        to match the same positions with several catalogs (see pairs)
+    """
+    return cKDTree(radec2xyz(ra, dec))
+
+class CrossMatcher(object):
+    """ Matches positions to a catalog with a KD-tree of unit vectors
+    """
+
+    def __init__(self, ra, dec, workers = 1):
+        """ Constructor: Build the tree for the catalog positions (degrees)
+            - workers: number of threads for queries (-1 for all cores)
+        """
+        self.xyz = radec2xyz(ra, dec)
+        if len(self.xyz) == 0:
+            raise ValueError('CrossMatcher: Catalog is empty')
+        self.tree = cKDTree(self.xyz)
+        self.workers = workers
+
+    def __len__(self):
+        """ Returns the number of catalog entries
+        """
+        return len(self.xyz)
+
+    def nearest(self, ra, dec):
+        """ Returns (index, distance) for the nearest catalog entry of each
+            position: index into the catalog and distance in degrees.
+        """
+        chord, index = self.tree.query(radec2xyz(ra, dec), k = 1, workers = self.workers)
+        return index, chord2deg(chord)
+
+    def within(self, ra, dec, radius):
+        """ Returns a list with an array of catalog indices within radius
+            (degrees) for each position.
+        """
+        lists = self.tree.query_ball_point(radec2xyz(ra, dec), deg2chord(radius),
+                                           workers = self.workers)
+        return [np.array(l, dtype = np.intp) for l in lists]
+
+    def pairs(self, ra, dec, radius, qtree = None):
+        """ Returns (query index, catalog index, distance) arrays for all
+            pairs within radius (degrees), distance in degrees.
+            qtree is the tree of the positions (see maketree), it's made
+            from ra, dec if not given.
+        """
+        if qtree is None:
+            qtree = maketree(ra, dec)
+        sdm = qtree.sparse_distance_matrix(self.tree, deg2chord(radius),
+                                           output_type = 'ndarray')
+        return sdm['i'], sdm['j'], chord2deg(sdm['v'])
+
+    def catalognearest(self, ra, dec, radius, qtree = None):
+        """ Returns (index, distance) for each catalog entry: index of the
+            nearest position ra, dec within radius (degrees) and distance
+            in degrees. Entries without position within radius have index
+            0 and distance inf. qtree is the tree of the positions (see
+            pairs).
+        """
+        index = np.zeros(len(self.xyz), dtype = np.intp)
+        distance = np.full(len(self.xyz), np.inf)
+        if len(ra) == 0:
+            return index, distance
+        qi, ci, dist = self.pairs(ra, dec, radius, qtree)
+        # Nearest pair for each catalog entry
+        order = np.lexsort((dist, ci))
+        first = np.ones(len(order), dtype = bool)
+        first[1:] = ci[order][1:] != ci[order][:-1]
+        order = order[first]
+        index[ci[order]] = qi[order]
+        distance[ci[order]] = dist[order]
+        return index, distance
+
+""" === History ===
+2026-10-18 New module for KD-tree cross matching
+2026-10-18 Removed getmatcher (the cache never hit for different frames),
+           added catalognearest for trees on reference catalog tiles
+2026-10-18 Added maketree, the tree of the query positions can be reused
+           for several catalogs (pairs, catalognearest)
+"""
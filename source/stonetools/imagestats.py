@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+""" IMAGE STATS - Version 1.0.0
+
+    This module has fast image statistics for display scaling (i.e. in
+    StepRGB). Order statistics are found by selection (numpy.partition)
+    instead of sorting the data. With a tolerance they are taken from a
+    random subsample of the data, which is much faster for large images.
+
+    @author: agent
+"""
+
+import numpy # numpy library
+
+def sample(data, tolerance, seed = 0):
+    """ Returns a 1D array (native byte order) with the values of data (an
+        array or a list of arrays which are combined). If tolerance > 0 a
+        random subsample of about 1/tolerance**2 values is returned (drawn
+        from each array in proportion to its size). The returned array
+        can be changed.
+    """
+    arrays = data if isinstance(data, (list, tuple)) else [data]
+    dtype = numpy.result_type(*arrays).newbyteorder('=')
+    total = sum([array.size for array in arrays])
+    if tolerance > 0 and total > 1. / tolerance**2:
+        nsample = 1. / tolerance**2
+        rng = numpy.random.default_rng(seed)
+        return numpy.concatenate([array.ravel()[rng.integers(0, array.size,
+                                                             int(nsample * array.size / total))]
+                                  for array in arrays], dtype = dtype)
+    if len(arrays) == 1:
+        return arrays[0].astype(dtype).ravel()
+    return numpy.concatenate([array.ravel() for array in arrays], dtype = dtype)
+
+def percentiles(data, fractions, tolerance = 0.):
+    """ Returns the values at fractions (0 to 1) of the sorted data (an
+        array or a list of arrays which are combined): the value at index
+        int(N * fraction) of the sorted values. No full sort is done.
+        With tolerance > 0 the values are found in a random subsample
+        (see sample), the error of the fractions is then about tolerance/2.
+    """
+    values = sample(data, tolerance)
+    indices = [min(int(len(values) * fraction), len(values) - 1) for fraction in fractions]
+    values.partition(indices)
+    return values[indices]
+
+def clippedstats(values, sigma = 3., maxiters = 5):
+    """ Returns the mean and standard deviation of sorted values (1D)
+        after iterative clipping at sigma standard deviations around the
+        median. Same result as astropy.stats.sigma_clip with default
+        settings, but as the values are sorted the clipped values are at
+        the ends and each iteration only needs to find two indices.
+    """
+    lo, hi = 0, len(values)
+    for _ in range(maxiters):
+        window = values[lo:hi]
+        n = len(window)
+        center = (window[(n - 1) // 2] + window[n // 2]) / 2.
+        std = window.std()
+        newlo = lo + numpy.searchsorted(window, center - sigma * std, 'left')
+        newhi = lo + numpy.searchsorted(window, center + sigma * std, 'right')
+        if newlo == lo and newhi == hi:
+            break
+        lo, hi = newlo, newhi
+    window = values[lo:hi]
+    return window.mean(), window.std()
+
+def blockreduce(image, factor):
+    """ Returns the image (2D) averaged in blocks of factor x factor
+        pixels (float32, native byte order). Rows and columns at the end
+        which don't fill a block are dropped.
+    """
+    ny, nx = image.shape[0] // factor, image.shape[1] // factor
+    blocks = image[:ny * factor, :nx * factor].reshape(ny, factor, nx, factor)
+    return blocks.mean(axis = (1, 3), dtype = numpy.float32)
+
+""" === History ===
+2026-10-18 New module with fast percentiles for image scaling
+2026-10-18 Added blockreduce for preview images
+2026-10-18 Added clippedstats (fast sigma clipping of sorted values)
+"""
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+""" MASTER INDEX - Version 1.0.0
+
+    This module keeps an index of calibration master files and their FITS
+    headers in an SQLite database file. StepLoadAuxCache uses it (if the
+    auxindex parameter is set) to find master files and their headers
+    without globbing large folders and opening the FITS files.
+
+    The index is kept up to date automatically: for each folder the
+    modification time is stored. If a folder changes (i.e. the masterbias,
+    masterdark or masterflat pipe modes saved new masters), the folder is
+    scanned again and only headers of new or changed files are read. Files
+    that were removed are dropped from the index.
+
+    Several processes can use the same index file, SQLite handles the
+    locking. The index can be rebuilt at any time by deleting the file.
+
+    Command line use to update the index for some folders:
+      python masterindex.py MasterIndex.sqlite folder1 [folder2 ...]
+
+    @author: agent
+"""
+
+import os # os library
+import glob # glob library
+import fnmatch # to match filenames
+import sqlite3 # database library
+import logging # logging object library
+import argparse # argument parsing
+from astropy.io import fits # to read FITS headers
+
+# File name patterns of files that are added to the index
+indexpatterns = ['*.fits', '*.fits.gz', '*.fit', '*.fts']
+
+class MasterIndex(object):
+    """ Index of master files and their headers in an SQLite file
+    """
+
+    def __init__(self, dbfile):
+        """ Constructor: Set the database file, the tables are made if
+            necessary.
+        """
+        self.dbfile = dbfile
+        self.log = logging.getLogger('stoneedge.pipe.masterindex')
+        with self.connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS folders ' +
+                         '(folder TEXT PRIMARY KEY, mtime REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS files ' +
+                         '(path TEXT PRIMARY KEY, folder TEXT, mtime REAL, ' +
+                         'size INTEGER, header TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS filesfolder ON files (folder)')
+
+    def connect(self):
+        """ Returns a new connection to the database (connections are not
+            shared between threads or processes).
+        """
+        return sqlite3.connect(self.dbfile, timeout = 60)
+
+    def update(self, folder):
+        """ Updates the index for folder if the folder has changed since
+            the last update. Returns the number of headers read.
+        """
+        folder = os.path.abspath(folder)
+        try:
+            mtime = os.path.getmtime(folder)
+        except OSError:
+            return 0
+        with self.connect() as conn:
+            row = conn.execute('SELECT mtime FROM folders WHERE folder = ?',
+                               (folder,)).fetchone()
+            if row is not None and row[0] == mtime:
+                return 0
+            # Get files in the index
+            known = dict([(path, (fmtime, size)) for path, fmtime, size in
+                          conn.execute('SELECT path, mtime, size FROM files WHERE folder = ?',
+                                       (folder,))])
+        # Scan the folder (outside a transaction, reading headers takes a while)
+        found = {}
+        newrows = []
+        for entry in os.scandir(folder):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            if not any([fnmatch.fnmatch(entry.name, pat) for pat in indexpatterns]):
+                continue
+            stat = entry.stat()
+            found[entry.path] = True
+            if known.get(entry.path) == (stat.st_mtime, stat.st_size):
+                continue
+            try:
+                header = fits.getheader(entry.path)
+            except Exception as error:
+                self.log.warning('Update: Unable to read header of %s (%s)' %
+                                 (entry.path, repr(error)))
+                continue
+            newrows.append((entry.path, folder, stat.st_mtime, stat.st_size,
+                            header.tostring()))
+        removed = [(path,) for path in known if path not in found]
+        with self.connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', newrows)
+            conn.executemany('DELETE FROM files WHERE path = ?', removed)
+            conn.execute('INSERT OR REPLACE INTO folders VALUES (?, ?)', (folder, mtime))
+        if len(newrows) or len(removed):
+            self.log.info('Update: %s: %d new/changed and %d removed files' %
+                          (folder, len(newrows), len(removed)))
+        return len(newrows)
+
+    def files(self, pattern):
+        """ Returns a list of (filepathname, mtime, headerstring) for all
+            files matching the glob pattern. The folders are updated first.
+        """
+        folders = [os.path.abspath(f) for f in sorted(glob.glob(os.path.dirname(pattern) or '.'))
+                   if os.path.isdir(f)]
+        for folder in folders:
+            self.update(folder)
+        filepattern = os.path.basename(pattern)
+        result = []
+        with self.connect() as conn:
+            for folder in folders:
+                for path, mtime, header in conn.execute(
+                        'SELECT path, mtime, header FROM files WHERE folder = ? ORDER BY path',
+                        (folder,)):
+                    if fnmatch.fnmatch(os.path.basename(path), filepattern):
+                        result.append((path, mtime, header))
+        return result
+
+if __name__ == '__main__':
+    """ Update the index for folders given on the command line
+    """
+    parser = argparse.ArgumentParser(description='Update the master file index')
+    parser.add_argument('dbfile', help='index database file')
+    parser.add_argument('folders', nargs='+', help='folders to update')
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
+    index = MasterIndex(args.dbfile)
+    for folder in args.folders:
+        index.update(folder)
+
+""" === History ===
+2026-10-18 New module for an SQLite index of master files
+"""
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+""" NOVA CLIENT - Version 1.0.0
+
+    This module is a small client for the astrometry.net web API (nova,
+    see http://nova.astrometry.net/api_help). Unlike the astroquery
+    AstrometryNet object, every call returns right away: a file (image
+    or source list) is uploaded with upload(), then the submission and
+    job status are queried with jobs() and jobstatus() and the solution
+    is downloaded with wcsheader(). This allows to upload many frames
+    and to wait for all of them at the same time.
+
+    The client object can be used from several threads (the session key
+    is only set by login()).
+
+    @author: agent
+"""
+
+import io # to read downloaded files
+import json # to encode API requests
+import logging # logging object library
+import requests # http request library
+from astropy.io import fits # to read WCS files
+
+class NovaClient(object):
+    """ Client for the astrometry.net (nova) web API
+    """
+
+    def __init__(self, apikey, apiurl = 'http://nova.astrometry.net/', timeout = 60):
+        """ Constructor: Set API key and server URL
+            - timeout: timeout (seconds) for each http request
+        """
+        self.apikey = apikey
+        self.apiurl = apiurl.rstrip('/') + '/'
+        self.timeout = timeout
+        self.session = None
+        self.log = logging.getLogger('stoneedge.pipe.novaclient')
+
+    def request(self, service, args = None, filename = None):
+        """ Sends a request to an API service (i.e. 'upload'), args are
+            sent as request-json form field (the session is added), the
+            file is uploaded if filename is given. Returns the response
+            dictionary, raises RuntimeError if the status is error.
+        """
+        url = self.apiurl + 'api/' + service
+        if args is None:
+            response = requests.get(url, timeout = self.timeout)
+        else:
+            args = dict(args)
+            if self.session is not None:
+                args['session'] = self.session
+            data = {'request-json': json.dumps(args)}
+            if filename is None:
+                response = requests.post(url, data = data, timeout = self.timeout)
+            else:
+                with open(filename, 'rb') as upfile:
+                    response = requests.post(url, data = data, timeout = self.timeout,
+                                             files = {'file': (filename, upfile,
+                                                               'application/octet-stream')})
+        response.raise_for_status()
+        result = response.json()
+        if result.get('status') == 'error':
+            raise RuntimeError('Astrometry.net %s: %s' % (service, result.get('errormessage', '')))
+        return result
+
+    def login(self):
+        """ Logs in with the API key and keeps the session key
+        """
+        self.session = self.request('login', {'apikey': self.apikey})['session']
+        self.log.debug('Login: Session %s' % self.session)
+
+    def upload(self, filename, **args):
+        """ Uploads an image or source list (FITS table with X, Y columns,
+            then args has to include image_width and image_height) file.
+            Other args are the solve parameters (i.e. center_ra, radius).
+            Returns the submission id.
+        """
+        subid = self.request('upload', args, filename)['subid']
+        self.log.debug('Upload: %s -> submission %s' % (filename, subid))
+        return subid
+
+    def jobs(self, subid):
+        """ Returns the list of job ids of a submission (empty until
+            the submission is processed)
+        """
+        return [job for job in self.request('submissions/%s' % subid)['jobs']
+                if job is not None]
+
+    def jobstatus(self, jobid):
+        """ Returns the status of a job: 'solving', 'success' or 'failure'
+        """
+        return self.request('jobs/%s' % jobid)['status']
+
+    def wcsheader(self, jobid):
+        """ Returns the WCS solution of a successful job as header
+        """
+        response = requests.get(self.apiurl + 'wcs_file/%s' % jobid, timeout = self.timeout)
+        response.raise_for_status()
+        return fits.Header.fromfile(io.BytesIO(response.content))
+
+""" === History ===
+2026-10-18 New module with a non-blocking astrometry.net web API client
+"""
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+""" REFERENCE CATALOG - Version 1.0.0
+
+    This module gives local access to reference star catalogs (the Guide
+    Star Catalog GSC 2.4.1 by default) for the flux calibration steps.
+
+    The sky is split into tiles: declination bands of tilesize degrees,
+    each band is split in right ascension into tiles of about tilesize
+    degrees (wider in RA near the poles). A cone query finds the tiles
+    that overlap the cone, gets missing tiles from the fetcher (one cone
+    query around each tile) and returns the stars inside the cone.
+
+    Tiles are saved in the cache folder as numpy .npz files with one array
+    per catalog column (i.e. ra, dec, SDSSrMag, SDSSrMagErr ...) and are
+    kept in memory. All filters and repeated visits of the same field use
+    the same tiles, so the catalog server is only asked once per sky area.
+
+    The fetcher can be replaced, i.e. by FileFetcher to use a local
+    catalog file (offline operation and tests).
+
+    @author: agent
+"""
+
+import os # os library
+import math # math library
+import logging # logging object library
+import threading # to lock the tile cache
+import collections # for ordered dictionary
+import numpy as np # numpy library
+import astropy.table # to return tables
+import astropy.io.ascii # to read CSV catalogs
+from stonetools.crossmatch import CrossMatcher, maketree # KD-trees of tile stars and sources
+
+# URL for the Guide Star Catalog 2.4.1 cone search (CSV output)
+gscurl = 'http://gsss.stsci.edu/webservices/vo/CatalogSearch.aspx'
+
+def angdist(ra1, dec1, ra2, dec2):
+    """ Returns the angular distance in degrees (all values in degrees)
+    """
+    ra1, dec1, ra2, dec2 = [np.radians(v) for v in (ra1, dec1, ra2, dec2)]
+    sind = np.sin((dec2 - dec1) / 2.)
+    sinr = np.sin((ra2 - ra1) / 2.)
+    hav = sind**2 + np.cos(dec1) * np.cos(dec2) * sinr**2
+    return np.degrees(2. * np.arcsin(np.sqrt(np.clip(hav, 0., 1.))))
+
+def tablecolumns(table):
+    """ Returns the numeric columns of an astropy table as dictionary of
+        numpy arrays (masked values become NaN).
+    """
+    columns = {}
+    for name in table.colnames:
+        col = table[name]
+        if col.dtype.kind not in 'iuf':
+            continue
+        if hasattr(col, 'filled'):
+            col = col.filled(np.nan) if col.dtype.kind == 'f' else col.filled(0)
+        columns[name] = np.asarray(col)
+    return columns
+
+class GSCFetcher(object):
+    """ Gets catalog data from the Guide Star Catalog web service
+    """
+
+    def __init__(self, url = gscurl, catalog = 'GSC241', timeout = 120):
+        """ Constructor: Set url and catalog name
+        """
+        self.url = url
+        self.catalog = catalog
+        self.timeout = timeout
+        self.log = logging.getLogger('stoneedge.pipe.refcat')
+
+    def fetch(self, ra, dec, radius):
+        """ Returns the catalog entries within radius of ra, dec (degrees)
+            as a dictionary of column arrays.
+        """
+        import requests # http request library (only needed here)
+        query = '%s?RA=%.6f&DEC=%.6f&DSN=+&FORMAT=CSV&CAT=%s&SR=%.6f&' % (
+            self.url, ra, dec, self.catalog, radius)
+        self.log.debug('Running URL = %s' % query)
+        result = requests.get(query, timeout = self.timeout)
+        result.raise_for_status()
+        table = astropy.io.ascii.read(result.text)
+        return tablecolumns(table)
+
+class FileFetcher(object):
+    """ Gets catalog data from a local catalog file (any format that
+        astropy.table.Table.read can read, it needs ra and dec columns)
+    """
+
+    def __init__(self, filename):
+        """ Constructor: Read the catalog file
+        """
+        self.filename = filename
+        if filename.endswith('.csv'):
+            table = astropy.io.ascii.read(filename)
+        else:
+            table = astropy.table.Table.read(filename)
+        self.columns = tablecolumns(table)
+
+    def fetch(self, ra, dec, radius):
+        """ Returns the catalog entries within radius of ra, dec (degrees)
+            as a dictionary of column arrays.
+        """
+        inside = angdist(ra, dec, self.columns['ra'], self.columns['dec']) <= radius
+        return dict([(name, col[inside]) for name, col in self.columns.items()])
+
+class RefCatalog(object):
+    """ Reference catalog with local tile cache
+    """
+
+    def __init__(self, fetcher, cachefolder = '', tilesize = 1.0, maxtiles = 200):
+        """ Constructor: Set up the tiling
+            - fetcher: object with fetch(ra, dec, radius) method
+            - cachefolder: folder for saved tiles ('' = memory only)
+            - tilesize: size of the tiles (degrees)
+            - maxtiles: number of tiles kept in memory
+        """
+        self.fetcher = fetcher
+        self.cachefolder = cachefolder
+        self.tilesize = float(tilesize)
+        self.maxtiles = maxtiles
+        self.nbands = int(math.ceil(180. / self.tilesize))
+        self.tiles = collections.OrderedDict() # tileid -> column dictionary
+        self.matchers = collections.OrderedDict() # tileid -> CrossMatcher of the tile
+        self.lock = threading.Lock()
+        self.log = logging.getLogger('stoneedge.pipe.refcat')
+
+    def bandlimits(self, band):
+        """ Returns the declination limits of a band
+        """
+        decmin = -90. + band * self.tilesize
+        return decmin, min(90., decmin + self.tilesize)
+
+    def bandtiles(self, band):
+        """ Returns the number of tiles in RA for a band
+        """
+        decmin, decmax = self.bandlimits(band)
+        # use the edge closest to the equator, tiles are at most tilesize wide
+        cosmax = 1.0 if decmin <= 0. <= decmax else max(math.cos(math.radians(decmin)),
+                                                          math.cos(math.radians(decmax)))
+        return max(1, int(math.ceil(360. * cosmax / self.tilesize)))
+
+    def tilelimits(self, tileid):
+        """ Returns (ramin, ramax, decmin, decmax) of a tile
+        """
+        band, ratile = tileid
+        decmin, decmax = self.bandlimits(band)
+        width = 360. / self.bandtiles(band)
+        return ratile * width, (ratile + 1) * width, decmin, decmax
+
+    def conetiles(self, ra, dec, radius):
+        """ Returns the ids (band, ratile) of the tiles which overlap with
+            the cone
+        """
+        tileids = []
+        decmin = max(-90., dec - radius)
+        decmax = min(90., dec + radius)
+        bandmin = min(self.nbands - 1, int((decmin + 90.) / self.tilesize))
+        bandmax = min(self.nbands - 1, int((decmax + 90.) / self.tilesize))
+        for band in range(bandmin, bandmax + 1):
+            ntiles = self.bandtiles(band)
+            width = 360. / ntiles
+            # Half width of the cone in RA in this band
+            bmin, bmax = self.bandlimits(band)
+            maxdec = max(abs(max(bmin, decmin)), abs(min(bmax, decmax)))
+            if decmax >= 90. or decmin <= -90. or maxdec >= 90.:
+                halfwidth = 180.
+            else:
+                halfwidth = radius / math.cos(math.radians(maxdec))
+            if halfwidth >= 180.:
+                tileids += [(band, i) for i in range(ntiles)]
+                continue
+            first = int(math.floor((ra - halfwidth) / width))
+            last = int(math.floor((ra + halfwidth) / width))
+            tileids += sorted(set([(band, i % ntiles) for i in range(first, last + 1)]))
+        return tileids
+
+    def tilefile(self, tileid):
+        """ Returns the filepathname for a saved tile
+        """
+        return os.path.join(self.cachefolder, 'T%.3g' % self.tilesize,
+                            'B%04d' % tileid[0], 'T%04d_%04d.npz' % tileid)
+
+    def fetchtile(self, tileid):
+        """ Gets the data of a tile from the fetcher
+        """
+        ramin, ramax, decmin, decmax = self.tilelimits(tileid)
+        # Cone around tile center which contains the whole tile
+        racent = (ramin + ramax) / 2.
+        deccent = (decmin + decmax) / 2.
+        ras = np.array([ramin, racent, ramax] * 3)
+        decs = np.repeat([decmin, deccent, decmax], 3)
+        radius = 1.01 * np.max(angdist(racent, deccent, ras, decs))
+        self.log.info('FetchTile: Getting tile %s (RA=%.2f DEC=%.2f R=%.2f)' %
+                      (repr(tileid), racent, deccent, radius))
+        columns = self.fetcher.fetch(racent, deccent, radius)
+        # Keep entries inside the tile
+        if len(columns):
+            ra = np.mod(columns['ra'], 360.)
+            inside = ((ra >= ramin) & (ra < ramax) &
+                      (columns['dec'] >= decmin) &
+                      ((columns['dec'] < decmax) | (decmax >= 90.)))
+            columns = dict([(name, col[inside]) for name, col in columns.items()])
+        return columns
+
+    def gettile(self, tileid):
+        """ Returns the columns of a tile: from memory, from the cache
+            folder or from the fetcher (in that order).
+        """
+        with self.lock:
+            if tileid in self.tiles:
+                self.tiles.move_to_end(tileid)
+                return self.tiles[tileid]
+        columns = None
+        filename = ''
+        if len(self.cachefolder):
+            filename = self.tilefile(tileid)
+            if os.path.exists(filename):
+                with np.load(filename) as npz:
+                    columns = dict([(name, npz[name]) for name in npz.files])
+        if columns is None:
+            columns = self.fetchtile(tileid)
+            if len(filename):
+                # Write to temporary file first, other processes may read it
+                os.makedirs(os.path.dirname(filename), exist_ok = True)
+                tmpname = '%s.%d.tmp.npz' % (filename[:-4], os.getpid())
+                np.savez(tmpname, **columns)
+                os.replace(tmpname, filename)
+        with self.lock:
+            self.tiles[tileid] = columns
+            while len(self.tiles) > self.maxtiles:
+                self.tiles.popitem(last = False)
+        return columns
+
+    def getmatcher(self, tileid):
+        """ Returns the CrossMatcher (KD-tree) of the stars of a tile, the
+            trees of the tiles in memory are kept. Returns None for an
+            empty tile.
+        """
+        with self.lock:
+            if tileid in self.matchers:
+                self.matchers.move_to_end(tileid)
+                return self.matchers[tileid]
+        tile = self.gettile(tileid)
+        matcher = None
+        if len(tile) and len(tile['ra']):
+            matcher = CrossMatcher(tile['ra'], tile['dec'])
+        with self.lock:
+            self.matchers[tileid] = matcher
+            while len(self.matchers) > self.maxtiles:
+                self.matchers.popitem(last = False)
+        return matcher
+
+    def cone(self, ra, dec, radius, srcra = None, srcdec = None, maxdist = 0.):
+        """ Returns an astropy table with the catalog entries within
+            radius of ra, dec (all in degrees).
+            If source positions srcra, srcdec (degrees) are given, the
+            table, an array with the index of the nearest source within
+            maxdist (degrees) and an array with its distance (degrees) for
+            each table entry are returned (index 0 and distance inf for
+            entries without source within maxdist). The sources are
+            matched with the KD-trees of the tiles (see getmatcher), the
+            tree of the sources is made once for all tiles.
+        """
+        match = srcra is not None
+        tileids = [tileid for tileid in self.conetiles(ra, dec, radius)
+                   if len(self.gettile(tileid)) and len(self.gettile(tileid)['ra'])]
+        if len(tileids) == 0:
+            if match:
+                return astropy.table.Table(), np.zeros(0, dtype = np.intp), np.zeros(0)
+            return astropy.table.Table()
+        tiles = [self.gettile(tileid) for tileid in tileids]
+        names = [name for name in tiles[0] if all([name in t for t in tiles])]
+        columns = dict([(name, np.concatenate([t[name] for t in tiles])) for name in names])
+        inside = angdist(ra, dec, columns['ra'], columns['dec']) <= radius
+        table = astropy.table.Table([columns[name][inside] for name in names], names = names)
+        self.log.debug('Cone: %d entries within %.2f deg of RA=%.4f DEC=%.4f' %
+                       (len(table), radius, ra, dec))
+        if not match:
+            return table
+        qtree = maketree(srcra, srcdec) if len(srcra) else None
+        matches = [self.getmatcher(tileid).catalognearest(srcra, srcdec, maxdist, qtree)
+                   for tileid in tileids]
+        index = np.concatenate([m[0] for m in matches])[inside]
+        distance = np.concatenate([m[1] for m in matches])[inside]
+        return table, index, distance
+
+# Catalogs for the process: (source, cachefolder, tilesize) -> RefCatalog
+catalogs = {}
+
+def getcatalog(source = 'gsc', cachefolder = '', tilesize = 1.0):
+    """ Returns the reference catalog object for source ('gsc' for the
+        Guide Star Catalog or the filepathname of a local catalog file).
+        Catalog objects are shared in the process.
+    """
+    key = (source, cachefolder, tilesize)
+    if key not in catalogs:
+        if source.lower() == 'gsc':
+            fetcher = GSCFetcher()
+        else:
+            fetcher = FileFetcher(source)
+        catalogs[key] = RefCatalog(fetcher, cachefolder, tilesize)
+    return catalogs[key]
+
+""" === History ===
+2026-10-18 New module for tiled, cached reference catalog access
+2026-10-18 cone matches sources with KD-trees kept for each tile
+2026-10-18 Tree of the sources made once per cone
+"""
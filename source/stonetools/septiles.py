@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+""" SEP TILES - Version 1.0.0
+
+    This module runs the SEP background estimation and source extraction
+    in tiles on a pool of worker threads (SEP releases the GIL), so large
+    frames (i.e. 4096 x 4096 HDR frames) use all cores.
+
+    The frame is split into core tiles. Each tile is processed with a
+    margin of surrounding pixels:
+    - Background: the tiles and margins are aligned to the background
+      mesh (bw x bh boxes) so the meshes are the same as for the whole
+      frame. The background and rms of the core of each tile are used.
+      The margin (several meshes) makes the spline interpolation and the
+      mesh filter at the tile borders the same as for the whole frame.
+    - Extraction: sources are extracted in each tile with margin, a source
+      is kept by the tile whose core contains its center. Sources in the
+      overlap regions are therefore kept once. The margin must be larger
+      than the sources (objects reaching into the margin of a tile are
+      extracted as in the whole frame).
+    The positions of the extracted sources are in frame coordinates.
+
+    @author: agent
+"""
+
+import os # os library
+import logging # logging object library
+from concurrent.futures import ThreadPoolExecutor # thread pool
+import numpy as np # numpy library
+import sep # source extraction library
+
+# Fields of sep.extract results with x and y pixel positions
+xfields = ['x', 'xmin', 'xmax', 'xpeak', 'xcpeak']
+yfields = ['y', 'ymin', 'ymax', 'ypeak', 'ycpeak']
+
+log = logging.getLogger('stoneedge.pipe.septiles')
+
+def tilelimits(size, tilesize, margin, step = 1):
+    """ Returns a list of (core start, core end, start, end) along an axis
+        of length size. Tile sizes and margins are rounded up to multiples
+        of step.
+    """
+    tilesize = -(-max(tilesize, 1) // step) * step
+    margin = -(-margin // step) * step
+    limits = []
+    for start in range(0, size, tilesize):
+        end = min(size, start + tilesize)
+        limits.append((start, end, max(0, start - margin), min(size, end + margin)))
+    return limits
+
+def tiles(shape, tilesize, margin, bw = 1, bh = 1):
+    """ Returns a list of (core slice, padded slice) tuples for the tiles of
+        an image with shape (rows, columns), core and padded slices are
+        (row slice, column slice) tuples.
+    """
+    result = []
+    for y0, y1, py0, py1 in tilelimits(shape[0], tilesize, margin, bh):
+        for x0, x1, px0, px1 in tilelimits(shape[1], tilesize, margin, bw):
+            result.append(((slice(y0, y1), slice(x0, x1)),
+                           (slice(py0, py1), slice(px0, px1))))
+    return result
+
+def getworkers(workers):
+    """ Returns the number of worker threads (0 for one per core)
+    """
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+def background(image, tilesize, margin, workers = 1, bw = 64, bh = 64, **kwargs):
+    """ Returns background, rms (float32 arrays) and global background
+        (median of the tiles) of image. Tiles are rounded to the mesh
+        size bw x bh. Other keyword arguments are passed to sep.Background.
+    """
+    back = np.empty(image.shape, dtype = np.float32)
+    rms = np.empty(image.shape, dtype = np.float32)
+    def tileback(tile):
+        core, pad = tile
+        bkg = sep.Background(np.ascontiguousarray(image[pad]), bw = bw, bh = bh, **kwargs)
+        # Core position inside the padded tile
+        inner = tuple([slice(c.start - p.start, c.stop - p.start) for c, p in zip(core, pad)])
+        back[core] = bkg.back()[inner]
+        rms[core] = bkg.rms()[inner]
+        return bkg.globalback
+    tilelist = tiles(image.shape, tilesize, margin, bw, bh)
+    log.debug('Background: %d tiles with %d workers' % (len(tilelist), getworkers(workers)))
+    with ThreadPoolExecutor(max_workers = getworkers(workers)) as pool:
+        globalbacks = list(pool.map(tileback, tilelist))
+    return back, rms, float(np.median(globalbacks))
+
+def extract(image, thresh, err, tilesize, margin, workers = 1, **kwargs):
+    """ Returns the sources of image from sep.extract run in tiles, other
+        keyword arguments are passed to sep.extract. Sources are kept by
+        the tile whose core contains their center.
+    """
+    def tileextract(tile):
+        core, pad = tile
+        objects = sep.extract(np.ascontiguousarray(image[pad]), thresh,
+                              err = np.ascontiguousarray(err[pad]), **kwargs)
+        for field in xfields:
+            objects[field] += pad[1].start
+        for field in yfields:
+            objects[field] += pad[0].start
+        # Keep sources with center in the core (pixel i covers i-0.5 to i+0.5)
+        keep = np.ones(len(objects), dtype = bool)
+        for axis, field in [(0, 'y'), (1, 'x')]:
+            if core[axis].start > 0:
+                keep &= objects[field] >= core[axis].start - 0.5
+            if core[axis].stop < image.shape[axis]:
+                keep &= objects[field] < core[axis].stop - 0.5
+        return objects[keep]
+    tilelist = tiles(image.shape, tilesize, margin)
+    log.debug('Extract: %d tiles with %d workers' % (len(tilelist), getworkers(workers)))
+    with ThreadPoolExecutor(max_workers = getworkers(workers)) as pool:
+        objectlists = list(pool.map(tileextract, tilelist))
+    return np.concatenate(objectlists)
+
+""" === History ===
+2026-10-18 New module for tiled parallel SEP background and extraction
+"""
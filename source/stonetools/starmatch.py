@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+""" STAR MATCH - Version 1.0.0
+
+    This module finds the transformation between two frames of the same
+    field (i.e. the g, r and i frames of one observation) from their
+    source lists (the SEP tables of StepSrcExtPy) or from their WCS.
+
+    fittransform matches the source lists and fits a rotation and shift,
+    it's used by StepAstrometryGroup to derive the WCS of frames and by
+    StepRGB to align the color channels. wcstransform fits an affine
+    transformation from the WCS of the frames.
+
+    @author: agent
+"""
+
+import numpy as np # numpy library
+from scipy.spatial import cKDTree # to match sources
+from astropy import wcs # to get WCS coordinates
+
+def fittransform(xy, xyref, tol = 3.0):
+    """ Fits a rotation and shift which maps positions xy to xyref
+        (N x 2 and M x 2 arrays, not matched). Sources are matched within
+        tol pixels. Returns (rotation matrix, shift, rms residual, number
+        of matches) or None.
+    """
+    if len(xy) < 2 or len(xyref) < 2:
+        return None
+    # Shift: peak of the histogram of all position differences
+    diffs = (xyref[None, :, :] - xy[:, None, :]).reshape(-1, 2)
+    lim = np.max(np.abs(diffs)) + tol
+    nbins = max(1, int(2 * lim / tol))
+    hist, xedges, yedges = np.histogram2d(diffs[:, 0], diffs[:, 1], bins=nbins,
+                                          range=[[-lim, lim], [-lim, lim]])
+    ix, iy = np.unravel_index(np.argmax(hist), hist.shape)
+    peak = np.array([(xedges[ix] + xedges[ix+1]) / 2, (yedges[iy] + yedges[iy+1]) / 2])
+    near = np.hypot(*(diffs - peak).T) < tol
+    shift = np.mean(diffs[near], axis=0)
+    rot = np.identity(2)
+    # Match and fit rotation + shift (a few iterations)
+    tree = cKDTree(xyref)
+    for iteration in range(3):
+        dist, index = tree.query(xy.dot(rot.T) + shift, distance_upper_bound=tol)
+        matched = np.isfinite(dist)
+        if np.count_nonzero(matched) < 2:
+            return None
+        p = xy[matched]
+        q = xyref[index[matched]]
+        pc = p - p.mean(axis=0)
+        qc = q - q.mean(axis=0)
+        angle = np.arctan2(np.sum(pc[:, 0] * qc[:, 1] - pc[:, 1] * qc[:, 0]),
+                           np.sum(pc[:, 0] * qc[:, 0] + pc[:, 1] * qc[:, 1]))
+        rot = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        shift = q.mean(axis=0) - p.mean(axis=0).dot(rot.T)
+    resid = p.dot(rot.T) + shift - q
+    rms = np.sqrt(np.mean(np.sum(resid**2, axis=1)))
+    return rot, shift, rms, len(p)
+
+def wcstransform(header, headerref, shape):
+    """ Fits an affine transformation (matrix, shift) which maps pixel
+        positions x, y of the frame with headerref to the frame with
+        header, from a grid over the frame (shape) of headerref. Returns
+        (matrix, shift, rms residual) or None if a header has no
+        celestial WCS.
+    """
+    w, wref = wcs.WCS(header), wcs.WCS(headerref)
+    if not (w.has_celestial and wref.has_celestial):
+        return None
+    ny, nx = shape[-2:]
+    gx, gy = np.meshgrid(np.linspace(0, nx - 1, 10), np.linspace(0, ny - 1, 10))
+    grid = np.column_stack((gx.ravel(), gy.ravel()))
+    ra, dec = wref.celestial.all_pix2world(grid, 0).T
+    xy = np.column_stack(w.celestial.all_world2pix(ra, dec, 0))
+    # Least squares: xy = grid . matrix.T + shift
+    coefs = np.linalg.lstsq(np.column_stack((grid, np.ones(len(grid)))), xy, rcond=None)[0]
+    matrix, shift = coefs[:2].T, coefs[2]
+    resid = grid.dot(matrix.T) + shift - xy
+    rms = np.sqrt(np.mean(np.sum(resid**2, axis=1)))
+    return matrix, shift, rms
+
+""" === History ===
+2026-10-18 New module: fittransform (from StepAstrometryGroup) and
+           wcstransform for StepRGB channel alignment
+"""
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+""" STRETCH CACHE - Version 1.0.0
+
+    This module keeps the shape of the trilogy log function of StepRGB
+    in an SQLite database file: t = k * (maxsv - minsv) and r (see
+    steprgb.logyfit), which don't depend on the data levels. Repeat
+    observations of a target (same object, filter and exposure time)
+    then reuse the stretch of the first observation with their own min
+    and max scaling values: the color images of a target look the same
+    from night to night, also with a different sky background.
+
+    Stretches are stored with a key string made of the values of the
+    cache keywords of a channel (see wcscache.cachekey) and the scaling
+    settings (noise luminosity, preview block size, min and max
+    percentiles). The cache can be reset at any time by deleting the file.
+
+    @author: agent
+"""
+
+import time # time library
+import sqlite3 # database library
+import logging # logging object library
+
+class StretchCache(object):
+    """ Cache of trilogy stretch parameters in an SQLite file
+    """
+
+    def __init__(self, dbfile):
+        """ Constructor: Set the database file, the table is made if
+            necessary.
+        """
+        self.dbfile = dbfile
+        self.log = logging.getLogger('stoneedge.pipe.stretchcache')
+        with self.connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS logstretches ' +
+                         '(key TEXT PRIMARY KEY, t REAL, r REAL, time REAL)')
+
+    def connect(self):
+        """ Returns a new connection to the database (connections are not
+            shared between threads or processes).
+        """
+        return sqlite3.connect(self.dbfile, timeout = 60)
+
+    def lookup(self, key):
+        """ Returns the stretch stored for key as dictionary with t and
+            r. Returns None if there is no such stretch.
+        """
+        with self.connect() as conn:
+            row = conn.execute('SELECT t, r FROM logstretches WHERE key = ?',
+                               (key,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['t', 'r'], row))
+
+    def store(self, key, t, r):
+        """ Stores a stretch, replaces the stretch stored for key
+        """
+        with self.connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO logstretches (key, t, r, time) ' +
+                         'VALUES (?, ?, ?, ?)',
+                         (key, float(t), float(r), time.time()))
+        self.log.debug('Store: Stretch for %s' % key)
+
+""" === History ===
+2026-10-18 New module for a cache of StepRGB trilogy stretches
+2026-10-18 Only the shape of the log function (t, r) is kept, new table
+           logstretches
+"""
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+""" WCS CACHE - Version 1.0.0
+
+    This module keeps astrometric solutions (WCS headers) in an SQLite
+    database file. The astrometry steps use it to find a solution from
+    an earlier night for the same target and setup (i.e. object name,
+    binning and camera) near the same pointing. The stored solution is
+    then used as prior for a fast verification run of astrometry.net
+    instead of a full search.
+
+    Solutions are stored with a key string made of the values of the
+    cache keywords (i.e. OBJECT=M5|XBIN=2|INSTRUME=SBIG) and the RA/Dec
+    of the image center. A new solution replaces stored solutions with
+    the same key and almost the same pointing.
+
+    Several processes can use the same cache file, SQLite handles the
+    locking. The cache can be reset at any time by deleting the file.
+
+    @author: agent
+"""
+
+import time # time library
+import sqlite3 # database library
+import logging # logging object library
+import numpy as np # numpy library
+from astropy.io import fits # to make headers
+from astropy import wcs # to get pixel scales
+from stonetools.refcat import angdist # angular distance
+
+def cachekey(header, keywords):
+    """ Returns the cache key string for a FITS header: values of the
+        keywords (missing keywords are empty).
+    """
+    return '|'.join(['%s=%s' % (key.upper(), str(header.get(key, '')).strip())
+                     for key in keywords])
+
+def pixelscale(header):
+    """ Returns the mean pixel scale (arcsec/pixel) of a WCS header
+    """
+    scales = wcs.utils.proj_plane_pixel_scales(wcs.WCS(header).celestial)
+    return float(np.mean(scales)) * 3600.
+
+class WCSCache(object):
+    """ Cache of WCS solutions in an SQLite file
+    """
+
+    def __init__(self, dbfile, mergeradius = 0.05):
+        """ Constructor: Set the database file, the table is made if
+            necessary.
+            - mergeradius: new solutions replace solutions with the same
+                           key within this distance (degrees)
+        """
+        self.dbfile = dbfile
+        self.mergeradius = mergeradius
+        self.log = logging.getLogger('stoneedge.pipe.wcscache')
+        with self.connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS solutions ' +
+                         '(id INTEGER PRIMARY KEY, key TEXT, ra REAL, dec REAL, ' +
+                         'scale REAL, header TEXT, time REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS solutionskey ON solutions (key)')
+
+    def connect(self):
+        """ Returns a new connection to the database (connections are not
+            shared between threads or processes).
+        """
+        return sqlite3.connect(self.dbfile, timeout = 60)
+
+    def lookup(self, key, ra, dec, radius):
+        """ Returns the stored solution with key which is closest to ra,
+            dec (degrees) and within radius (degrees) as dictionary with
+            ra, dec, scale (arcsec/pixel), distance and header (astropy
+            header). Returns None if there is no such solution.
+        """
+        with self.connect() as conn:
+            rows = conn.execute('SELECT ra, dec, scale, header FROM solutions WHERE key = ?',
+                                (key,)).fetchall()
+        if len(rows) == 0:
+            return None
+        dists = angdist(ra, dec, np.array([r[0] for r in rows]), np.array([r[1] for r in rows]))
+        best = int(np.argmin(dists))
+        if dists[best] > radius:
+            return None
+        rra, rdec, scale, header = rows[best]
+        return {'ra': rra, 'dec': rdec, 'scale': scale, 'distance': float(dists[best]),
+                'header': fits.Header.fromstring(header)}
+
+    def store(self, key, ra, dec, header):
+        """ Stores a solution (WCS header, the image center ra, dec in
+            degrees), solutions with the same key near ra, dec are replaced.
+        """
+        with self.connect() as conn:
+            rows = conn.execute('SELECT id, ra, dec FROM solutions WHERE key = ?',
+                                (key,)).fetchall()
+            if len(rows):
+                dists = angdist(ra, dec, np.array([r[1] for r in rows]),
+                                np.array([r[2] for r in rows]))
+                conn.executemany('DELETE FROM solutions WHERE id = ?',
+                                 [(r[0],) for r, d in zip(rows, dists) if d <= self.mergeradius])
+            conn.execute('INSERT INTO solutions (key, ra, dec, scale, header, time) ' +
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (key, ra, dec, pixelscale(header), header.tostring(), time.time()))
+        self.log.debug('Store: Solution for %s at RA=%.4f DEC=%.4f' % (key, ra, dec))
+
+""" === History ===
+2026-10-18 New module for a cache of WCS solutions
+"""